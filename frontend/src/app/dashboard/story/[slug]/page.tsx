@@ -14,7 +14,7 @@ import {
   HoverCardTrigger,
 } from "@/components/ui/hover-card";
 import { NavigationLink } from "@/components/navigation/navigation-link";
-import Image from "next/image";
+import StoryImage from "@/components/story/story-image";
 
 // Add revalidation time for Incremental Static Regeneration (ISR)
 // This will cache the page for 60 seconds before revalidating
@@ -163,8 +163,10 @@ const StoryContent = async ({ storyId }: { storyId: string }) => {
               <HoverCard>
                 <HoverCardTrigger asChild>
                   <div className="cursor-pointer transition-opacity hover:opacity-90 relative group">
-                    <Image
-                      src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${storyId}/banner.png`}
+                    <StoryImage
+                      storyId={storyId}
+                      nodeId="banner"
+                      prompt={story.image_prompt}
                       alt={story.title || "Story Image"}
                       width={256}
                       height={256}
@@ -188,8 +190,10 @@ const StoryContent = async ({ storyId }: { storyId: string }) => {
 
             {/* For mobile screens - show image and prompt directly */}
             <div className="md:hidden flex flex-col">
-              <Image
-                src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${storyId}/banner.png`}
+              <StoryImage
+                storyId={storyId}
+                nodeId="banner"
+                prompt={story.image_prompt}
                 alt={story.title || "Story Image"}
                 width={224}
                 height={224}
@@ -8,6 +8,7 @@ import { auth } from "@/auth";
 import { redirect } from "next/navigation";
 import { NavigationLink } from "@/components/navigation/navigation-link";
 import TerminalChoice from "@/components/node/terminal-choice";
+import { expandStory } from "@/lib/story";
 
 // Replace force-dynamic with controlled revalidation
 // export const dynamic = "force-dynamic";
@@ -119,6 +120,11 @@ const ChoiceContent = async ({ nodeId }: { nodeId: string }) => {
     markChoiceAsExplored(nodeId);
   }
 
+  // Generate the branches ahead of the player, whoever's story it is
+  if (!choice.isTerminal) {
+    expandStory(choice.storyId as string, nodeId, isUserStory);
+  }
+
   if (choice.isTerminal) {
     return <TerminalChoice choice={choice} />;
   }
@@ -2,6 +2,7 @@
 
 import React from "react";
 import { SelectStory } from "@/db/schema";
+import { fallBackToOriginal, getImageUrl } from "@/lib/images";
 import { useNavigationProgress } from "../navigation/navigation-progress-provider";
 import { useRouter } from "next/navigation";
 
@@ -40,7 +41,8 @@ const SampleStories = ({ stories }: props) => {
               <div className="flex gap-4">
                 <div className="w-1/6">
                   <img
-                    src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${story.id}/banner.png`}
+                    src={getImageUrl(story.id, "banner", story.image_prompt, "thumb")}
+                    onError={fallBackToOriginal(story.id, "banner")}
                     alt={story.title as string}
                     className="w-24 h-24 object-cover rounded"
                   />
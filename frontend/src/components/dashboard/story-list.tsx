@@ -1,5 +1,6 @@
 "use client";
 import { SelectStory } from "@/db/schema";
+import { fallBackToOriginal, getImageUrl } from "@/lib/images";
 import { useQuery, useQueryClient } from "@tanstack/react-query";
 import React, { useEffect, useState, useTransition } from "react";
 import { Button } from "../ui/button";
@@ -157,7 +158,8 @@ const StoryCard = ({ story }: { story: Story }) => {
       <div className="flex flex-col md:flex-row gap-4 md:gap-8">
         <div className="w-full md:w-1/5 flex justify-center md:justify-start">
           <img
-            src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${story.id}/banner.png`}
+            src={getImageUrl(story.id, "banner", story.image_prompt, "thumb")}
+            onError={fallBackToOriginal(story.id, "banner")}
             alt={story.title as string}
             className="w-full max-w-[200px] md:w-32 md:h-32 object-cover rounded"
           />
@@ -5,6 +5,17 @@ import { Volume2, VolumeX, Play, Pause } from "lucide-react";
 import { Slider } from "@/components/ui/slider";
 import { cn } from "@/lib/utils";
 
+// Extension of the narration the Kokoro service uploads for its AUDIO_FORMAT.
+// Stories narrated before it was compressed only have a wav.
+const AUDIO_EXTENSION = process.env.NEXT_PUBLIC_AUDIO_EXTENSION || "mp3";
+const AUDIO_TYPES: Record<string, string> = {
+  mp3: "audio/mpeg",
+  ogg: "audio/ogg",
+  wav: "audio/wav",
+};
+const AUDIO_SOURCES =
+  AUDIO_EXTENSION === "wav" ? ["wav"] : [AUDIO_EXTENSION, "wav"];
+
 interface Props {
   muted?: boolean;
   story_id: string;
@@ -56,7 +67,9 @@ const RetroAudioPlayer = ({
       audio.removeEventListener("pause", handlePause);
       audio.removeEventListener("play", handlePlay);
     };
-  }, []);
+    // Sources don't reload on their own when they change, so a new node
+    // loads its clip here
+  }, [story_id, node_id]);
 
   // Handle user interactions to enable audio
   useEffect(() => {
@@ -133,11 +146,16 @@ const RetroAudioPlayer = ({
 
   return (
     <div className="font-mono text-green-500 bg-black/80 p-2 sm:p-3 md:p-4 rounded-lg border border-green-500/30 w-full sm:w-[200px]">
-      <audio
-        ref={audioRef}
-        src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${story_id}/${node_id}.wav`}
-        preload="auto"
-      />
+      <audio ref={audioRef} preload="auto">
+        {/* The browser moves on to the wav if the compressed clip is missing */}
+        {AUDIO_SOURCES.map((extension) => (
+          <source
+            key={extension}
+            src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${story_id}/${node_id}.${extension}`}
+            type={AUDIO_TYPES[extension]}
+          />
+        ))}
+      </audio>
 
       <div className="flex items-center space-x-2 sm:space-x-3 md:space-x-4">
         <button
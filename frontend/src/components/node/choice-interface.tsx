@@ -8,7 +8,7 @@ import { HoverCard } from "@radix-ui/react-hover-card";
 import { HoverCardContent, HoverCardTrigger } from "../ui/hover-card";
 import { NavigationLink } from "../navigation/navigation-link";
 import { useNavigationProgress } from "../navigation/navigation-progress-provider";
-import Image from "next/image";
+import StoryImage from "../story/story-image";
 
 type ChoiceInterfaceProps = {
   title: string;
@@ -68,8 +68,11 @@ const ChoiceInterface = ({
             <HoverCard>
               <HoverCardTrigger asChild>
                 <div className="w-[200px] h-[192px] rounded overflow-hidden relative">
-                  <Image
-                    src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${storyId}/${choiceId}.png`}
+                  <StoryImage
+                    storyId={storyId}
+                    nodeId={choiceId}
+                    prompt={imagePrompt}
+                    variant="thumb"
                     alt="Story Banner"
                     width={200}
                     height={192}
@@ -92,8 +95,10 @@ const ChoiceInterface = ({
           {/* For mobile screens - show image and prompt directly */}
           <div className="md:hidden flex flex-col gap-2 w-full">
             <div className="w-full h-[144px] sm:h-[192px] rounded overflow-hidden">
-              <Image
-                src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${storyId}/${choiceId}.png`}
+              <StoryImage
+                storyId={storyId}
+                nodeId={choiceId}
+                prompt={imagePrompt}
                 alt="Story Banner"
                 width={400}
                 height={192}
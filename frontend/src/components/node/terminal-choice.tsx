@@ -7,7 +7,7 @@ import AutoAudioPlayer from "./audio-player";
 import { HoverCard } from "@radix-ui/react-hover-card";
 import { HoverCardContent, HoverCardTrigger } from "../ui/hover-card";
 import { useNavigationProgress } from "../navigation/navigation-progress-provider";
-import Image from "next/image";
+import StoryImage from "../story/story-image";
 
 type TerminalChoiceProps = {
   choice: SelectStoryChoice;
@@ -46,8 +46,11 @@ const TerminalChoice = ({ choice }: TerminalChoiceProps) => {
             <HoverCard>
               <HoverCardTrigger asChild>
                 <div className="w-[200px] h-[192px] rounded overflow-hidden relative">
-                  <Image
-                    src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${choice.storyId}/${choice.id}.png`}
+                  <StoryImage
+                    storyId={choice.storyId}
+                    nodeId={choice.id}
+                    prompt={choice.image_prompt}
+                    variant="thumb"
                     alt="Story Banner"
                     width={200}
                     height={192}
@@ -70,8 +73,10 @@ const TerminalChoice = ({ choice }: TerminalChoiceProps) => {
           {/* For mobile screens - show image and prompt directly */}
           <div className="md:hidden flex flex-col gap-2 w-full">
             <div className="w-full h-[144px] sm:h-[192px] rounded overflow-hidden">
-              <Image
-                src={`https://restate-story.s3.ap-southeast-1.amazonaws.com/${choice.storyId}/${choice.id}.png`}
+              <StoryImage
+                storyId={choice.storyId}
+                nodeId={choice.id}
+                prompt={choice.image_prompt}
                 alt="Story Banner"
                 width={400}
                 height={192}
@@ -0,0 +1,33 @@
+"use client";
+
+import Image, { ImageProps } from "next/image";
+import { fallBackToOriginal, getImageUrl } from "@/lib/images";
+
+type StoryImageProps = Omit<ImageProps, "src" | "onError"> & {
+  storyId: string;
+  nodeId: string;
+  prompt: string;
+  variant?: "full" | "thumb";
+};
+
+// A story image served from its compressed variant, falling back to the
+// original PNG for stories generated before the variants existed
+const StoryImage = ({
+  storyId,
+  nodeId,
+  prompt,
+  variant = "full",
+  alt,
+  ...props
+}: StoryImageProps) => {
+  return (
+    <Image
+      src={getImageUrl(storyId, nodeId, prompt, variant)}
+      onError={fallBackToOriginal(storyId, nodeId)}
+      alt={alt}
+      {...props}
+    />
+  );
+};
+
+export default StoryImage;
@@ -0,0 +1,45 @@
+import type { SyntheticEvent } from "react";
+
+export const ASSET_URL = "https://restate-story.s3.ap-southeast-1.amazonaws.com";
+
+// Format of the compressed variants the image service uploads
+const IMAGE_FORMAT = process.env.NEXT_PUBLIC_IMAGE_FORMAT || "webp";
+
+// 32-bit FNV-1a hash of the image prompt, computed the same way as the image
+// service so we can find a node's variants without a lookup
+export function getImageVersion(prompt: string): string {
+  const bytes = new TextEncoder().encode(prompt);
+  let version = 0x811c9dc5;
+  for (let i = 0; i < bytes.length; i++) {
+    version = Math.imul(version ^ bytes[i], 0x01000193);
+  }
+  return (version >>> 0).toString(16).padStart(8, "0");
+}
+
+export function getOriginalImageUrl(storyId: string, nodeId: string): string {
+  return `${ASSET_URL}/${storyId}/${nodeId}.png`;
+}
+
+// The compressed variants are keyed by their prompt and never change, so
+// browsers can cache them for good
+export function getImageUrl(
+  storyId: string,
+  nodeId: string,
+  prompt: string,
+  variant: "full" | "thumb" = "full"
+): string {
+  const suffix = variant === "thumb" ? `thumb.${IMAGE_FORMAT}` : IMAGE_FORMAT;
+  return `${ASSET_URL}/${storyId}/${nodeId}.${getImageVersion(prompt)}.${suffix}`;
+}
+
+// Stories generated before the variants existed only have the original PNG
+export function fallBackToOriginal(storyId: string, nodeId: string) {
+  return (event: SyntheticEvent<HTMLImageElement>) => {
+    const image = event.currentTarget;
+    const original = getOriginalImageUrl(storyId, nodeId);
+    if (image.src !== original) {
+      image.srcset = "";
+      image.src = original;
+    }
+  };
+}
@@ -96,6 +96,37 @@ export async function generateStory(prompt: string) {
   }
 }
 
+export async function expandStory(
+  storyId: string,
+  nodeId: string,
+  markExplored: boolean
+) {
+  // Stories generated a few levels at a time grow as the player advances,
+  // so every visit asks for the branches below this node to be generated
+  try {
+    const response = await fetch(
+      `${process.env.RESTATE_ENDPOINT}/story_tree/${storyId}/expand/send`,
+      {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${process.env.RESTATE_TOKEN}`,
+        },
+        body: JSON.stringify({
+          node_id: nodeId,
+          mark_explored: markExplored,
+        }),
+      }
+    );
+
+    if (!response.ok) {
+      console.error("Failed to expand story", response);
+    }
+  } catch (error) {
+    console.error("Error expanding story:", error);
+  }
+}
+
 export async function deleteStory(storyId: string) {
   await db.delete(storiesTable).where(eq(storiesTable.id, storyId));
   revalidatePath("/dashboard");
@@ -1,12 +1,23 @@
+import io
+import os
+
 import modal
 import boto3
 from pydantic import BaseModel
 
+MUSIC_MODEL = "facebook/musicgen-medium"
+
+# MusicGen's EnCodec tokenizer emits 50 audio tokens per second, so the
+# requested duration is turned into a token budget capped at MAX_NEW_TOKENS
+TOKENS_PER_SECOND = 50
+DEFAULT_DURATION_SECONDS = float(os.getenv("MUSIC_DURATION_SECONDS", "15"))
+MAX_NEW_TOKENS = int(os.getenv("MUSIC_MAX_NEW_TOKENS", "1500"))
+
 
 def download_model():
     from transformers import pipeline
 
-    pipeline("text-to-audio", model="facebook/musicgen-medium")
+    pipeline("text-to-audio", model=MUSIC_MODEL)
 
 
 image = (
@@ -28,38 +39,68 @@ class AudioRequest(BaseModel):
     storyId: str
     callback_url: str
     callback_token: str
+    duration_seconds: float = DEFAULT_DURATION_SECONDS
 
 
-@app.function(image=image, gpu="A10g", secrets=[s3_secret])
-@modal.web_endpoint(method="POST")
-def generate_audio(request: AudioRequest):
-    # Use a pipeline as a high-level helper
-    from transformers import pipeline
-    from scipy.io import wavfile
-    import tempfile
-    import os
-    import requests
+def get_token_budget(duration_seconds: float) -> int:
+    return max(1, min(int(duration_seconds * TOKENS_PER_SECOND), MAX_NEW_TOKENS))
 
-    print(request)
 
-    pipe = pipeline("text-to-audio", model="facebook/musicgen-medium")
-    audio = pipe(
-        request.prompt,
-        forward_params={"do_sample": True},
-    )
+def encode_wav(audio, rate: int) -> bytes:
+    """Write the pipeline's (channels, samples) output to an in-memory wav"""
+    import numpy as np
+    from scipy.io import wavfile
 
-    # Write to temporary wav file
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-        wavfile.write(temp_file.name, audio["sampling_rate"], audio["audio"])
+    # Half precision samples aren't a valid wav sample type
+    samples = np.squeeze(np.asarray(audio, dtype=np.float32))
+    if samples.ndim == 2:
+        samples = samples.T
+
+    buffer = io.BytesIO()
+    wavfile.write(buffer, rate, samples)
+    return buffer.getvalue()
+
+
+@app.cls(image=image, gpu="A10g", secrets=[s3_secret])
+class MusicGenerator:
+    @modal.enter()
+    def load_pipeline(self):
+        import torch
+        from transformers import pipeline
+
+        # Built once per container instead of reloading the model per request
+        if torch.cuda.is_available():
+            self.pipe = pipeline(
+                "text-to-audio",
+                model=MUSIC_MODEL,
+                device=0,
+                torch_dtype=torch.float16,
+            )
+        else:
+            self.pipe = pipeline("text-to-audio", model=MUSIC_MODEL)
+
+    @modal.web_endpoint(method="POST")
+    def generate_audio(self, request: AudioRequest):
+        import requests
+
+        print(f"Received request for {request.storyId}")
+
+        audio = self.pipe(
+            request.prompt,
+            forward_params={
+                "do_sample": True,
+                "max_new_tokens": get_token_budget(request.duration_seconds),
+            },
+        )
 
-        # Upload to S3
         s3 = boto3.client("s3")
         s3.put_object(
             Bucket=os.getenv("AWS_BUCKET_NAME"),
             Key=f"{request.storyId}/theme_song.wav",
-            Body=open(temp_file.name, "rb").read(),
+            Body=encode_wav(audio["audio"], audio["sampling_rate"]),
+            ContentType="audio/wav",
         )
 
-    headers = {"Authorization": f"Bearer {request.callback_token}"}
+        headers = {"Authorization": f"Bearer {request.callback_token}"}
 
-    requests.post(request.callback_url, headers=headers)
+        requests.post(request.callback_url, headers=headers)
@@ -1,5 +1,17 @@
+import hashlib
+import io
+import json
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
 import modal
 
+from callbacks import notify_callback
+
 kokoro_volume = modal.Volume.from_name("kokoro-volume", create_if_missing=True)
 
 
@@ -7,13 +19,113 @@ image = (
     modal.Image.debian_slim()
     .apt_install("git", "ffmpeg", "espeak-ng", "git-lfs")
     .pip_install(
-        "torch", "transformers", "scipy", "boto3", "fastapi", "phonemizer", "munch"
+        "torch",
+        "transformers",
+        "scipy",
+        "boto3",
+        "fastapi",
+        "phonemizer",
+        "munch",
+        "soundfile",
     )
     .pip_install("requests", "ipython")
 )
 
 app = modal.App("kokoro-tts", image=image)
 
+SAMPLE_RATE = 22050
+
+# Clips are uploaded as mp3, which every browser plays, or as opus or wav. The
+# compression level is libsndfile's bitrate knob, from 0 for the highest
+# bitrate to 1 for the smallest files.
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "mp3")
+AUDIO_COMPRESSION_LEVEL = float(os.getenv("AUDIO_COMPRESSION_LEVEL", "0.9"))
+
+# Encoding and uploads of a story's clips overlap with synthesis of the next
+UPLOAD_CONCURRENCY = 8
+
+# A story's clips are synthesized shortest first in batches of this many, so
+# each batch is padded to a similar length. Kokoro reads at most 510 tokens.
+SYNTHESIS_BATCH_SIZE = int(os.getenv("SYNTHESIS_BATCH_SIZE", "8"))
+MAX_TOKENS = 510
+
+# In streaming mode a node is synthesized a sentence at a time and the audio
+# so far is uploaded to {story_id}/partial/{node_id} after every sentence, so
+# playback can start before the full clip replaces it
+STREAM_AUDIO = os.getenv("AUDIO_STREAMING", "false").lower() == "true"
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+# Narration is cached under a hash of its text, voice, model and encoding so
+# repeated text becomes a server side copy instead of another inference
+MODEL_VERSION = "kokoro-v0_19"
+TTS_CACHE = os.getenv("TTS_CACHE", "true").lower() == "true"
+TTS_CACHE_PREFIX = "tts-cache"
+FORMAT_EXTENSIONS = {"wav": "wav", "opus": "ogg", "mp3": "mp3"}
+
+
+@dataclass
+class EncodedAudio:
+    body: bytes
+    extension: str
+    content_type: str
+
+
+def encode_audio(
+    audio,
+    rate: int = SAMPLE_RATE,
+    audio_format: str = AUDIO_FORMAT,
+    compression_level: float = AUDIO_COMPRESSION_LEVEL,
+) -> EncodedAudio:
+    """Encode a clip straight from its samples into an in-memory file"""
+    import soundfile as sf
+    from scipy.io import wavfile
+    from scipy.signal import resample_poly
+
+    buffer = io.BytesIO()
+    if audio_format == "wav":
+        wavfile.write(buffer, rate=rate, data=audio)
+        return EncodedAudio(buffer.getvalue(), "wav", "audio/wav")
+
+    if audio_format == "opus":
+        # Opus only supports a handful of sample rates, 24kHz is closest
+        if rate != 24000:
+            audio = resample_poly(audio, 24000, rate)
+            rate = 24000
+        sf.write(
+            buffer,
+            audio,
+            rate,
+            format="OGG",
+            subtype="OPUS",
+            compression_level=compression_level,
+        )
+        return EncodedAudio(buffer.getvalue(), "ogg", "audio/ogg")
+
+    if audio_format == "mp3":
+        sf.write(
+            buffer,
+            audio,
+            rate,
+            format="MP3",
+            subtype="MPEG_LAYER_III",
+            compression_level=compression_level,
+        )
+        return EncodedAudio(buffer.getvalue(), "mp3", "audio/mpeg")
+
+    raise ValueError(f"Unsupported audio format {audio_format}")
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(text.strip()) if sentence]
+
+
+def get_cache_key(text: str, voice: str) -> str:
+    normalized = " ".join(text.split())
+    encoding = f"{AUDIO_FORMAT}:{AUDIO_COMPRESSION_LEVEL}"
+    payload = f"{MODEL_VERSION}:{voice}:{encoding}:{normalized}"
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return f"{TTS_CACHE_PREFIX}/{digest}.{FORMAT_EXTENSIONS[AUDIO_FORMAT]}"
+
 
 @app.function(volumes={"/kokoro_volume": kokoro_volume})
 def download_kokoro():
@@ -30,6 +142,12 @@ def download_kokoro():
     concurrency_limit=2,
 )
 class KokoroGenerator:
+    cache_hits = 0
+    cache_misses = 0
+    # Seconds this container has spent synthesizing, which the benchmark
+    # compares instead of wall clock since the per node path can fan out
+    gpu_seconds = 0.0
+
     @modal.enter()
     def load_model(self):
         import os
@@ -38,37 +156,389 @@ class KokoroGenerator:
 
         os.chdir("/kokoro_volume")
         sys.path.append(".")
-        from kokoro import generate
+        from kokoro import generate, length_to_mask, phonemize, tokenize
         from models import build_model
 
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.MODEL = build_model("kokoro-v0_19.pth", device)
+        self.MODEL = build_model(f"{MODEL_VERSION}.pth", device)
         self.VOICE_NAME = "bm_lewis"
         self.VOICEPACK = torch.load(
             f"voices/{self.VOICE_NAME}.pt", weights_only=True
         ).to(device)
         self.generate_fn = generate
+        self.phonemize_fn = phonemize
+        self.tokenize_fn = tokenize
+        self.mask_fn = length_to_mask
 
-    @modal.web_endpoint(method="POST", requires_proxy_auth=True)
-    def generate_audio(self, node: dict):
-        import boto3
-        import os
-        import tempfile
-        from scipy.io import wavfile
-
+    def synthesize(self, text: str, ps: str | None = None):
+        start = time.perf_counter()
         audio, out_ps = self.generate_fn(
-            self.MODEL, node["prompt"], self.VOICEPACK, lang="b"
+            self.MODEL, text, self.VOICEPACK, lang="b", ps=ps
         )
+        self.gpu_seconds += time.perf_counter() - start
+        return audio
+
+    def forward_batch(self, token_lists: list[list[int]]) -> list:
+        """
+        Kokoro's forward pass over a batch of token sequences. The text side,
+        PL-BERT, the duration predictor and the text encoder, runs as one
+        padded tensor that is masked and packed so padding never reaches a
+        real token. The frame side is decoded clip by clip, since its instance
+        norms span the whole clip and padded frames would change the audio.
+        """
+        import torch
+        from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+        model = self.MODEL
+        device = self.VOICEPACK.device
+        with torch.no_grad():
+            lengths = [len(tokens) + 2 for tokens in token_lists]
+            batch = torch.zeros(len(token_lists), max(lengths), dtype=torch.long)
+            for i, tokens in enumerate(token_lists):
+                batch[i, : lengths[i]] = torch.LongTensor([0, *tokens, 0])
+            batch = batch.to(device)
+            input_lengths = torch.LongTensor(lengths).to(device)
+            text_mask = self.mask_fn(input_lengths).to(device)
+            # Each clip gets the style Kokoro picks for its token count
+            ref_s = torch.cat([self.VOICEPACK[len(tokens)] for tokens in token_lists])
+            s = ref_s[:, 128:]
+
+            bert_dur = model.bert(batch, attention_mask=(~text_mask).int())
+            d_en = model.bert_encoder(bert_dur).transpose(-1, -2)
+            d = model.predictor.text_encoder(d_en, s, input_lengths, text_mask)
+            packed = pack_padded_sequence(
+                d, input_lengths.cpu(), batch_first=True, enforce_sorted=False
+            )
+            x, _ = pad_packed_sequence(model.predictor.lstm(packed)[0], batch_first=True)
+            duration = torch.sigmoid(model.predictor.duration_proj(x)).sum(axis=-1)
+            pred_dur = torch.round(duration).clamp(min=1).long()
+            t_en = model.text_encoder(batch, input_lengths, text_mask)
+
+            clips = []
+            for i, length in enumerate(lengths):
+                # Each token is repeated over the frames it was predicted to last
+                alignment = torch.repeat_interleave(
+                    torch.eye(length, device=device), pred_dur[i, :length], dim=1
+                ).unsqueeze(0)
+                en = d[i : i + 1, :length].transpose(-1, -2) @ alignment
+                F0_pred, N_pred = model.predictor.F0Ntrain(en, s[i : i + 1])
+                asr = t_en[i : i + 1, :, :length] @ alignment
+                audio = model.decoder(asr, F0_pred, N_pred, ref_s[i : i + 1, :128])
+                clips.append(audio.squeeze().cpu().numpy())
+        return clips
+
+    def synthesize_batch(self, texts: list[str]):
+        """
+        Phonemize and tokenize every text up front, then synthesize them in
+        batches of similar length, shortest first, yielding each clip with its
+        index as soon as its batch is ready.
+        """
+        tokens = [
+            self.tokenize_fn(self.phonemize_fn(text, "b"))[:MAX_TOKENS]
+            for text in texts
+        ]
+        order = sorted(range(len(texts)), key=lambda i: len(tokens[i]))
+        for start in range(0, len(order), SYNTHESIS_BATCH_SIZE):
+            indices = order[start : start + SYNTHESIS_BATCH_SIZE]
+            started = time.perf_counter()
+            clips = self.forward_batch([tokens[i] for i in indices])
+            self.gpu_seconds += time.perf_counter() - started
+            yield from zip(indices, clips)
+
+    def put_audio(self, name: str, audio) -> str:
+        import boto3
 
-        with tempfile.NamedTemporaryFile(suffix=".wav") as tmp_file:
-            wavfile.write(tmp_file.name, rate=22050, data=audio)
-            tmp_file.flush()
-            tmp_file.seek(0)
-            audio_bytes = tmp_file.read()
+        encoded = encode_audio(audio)
 
+        key = f"{name}.{encoded.extension}"
         s3 = boto3.client("s3")
         s3.put_object(
             Bucket=os.getenv("AWS_BUCKET_NAME"),
-            Key=f"{node['story_id']}/{node['node_id']}.wav",
-            Body=audio_bytes,
+            Key=key,
+            Body=encoded.body,
+            ContentType=encoded.content_type,
+        )
+        print(f"Uploaded {key}: {len(encoded.body)} bytes")
+        return key
+
+    def upload_clip(self, node: dict, audio) -> str:
+        key = self.put_audio(f"{node['story_id']}/{node['node_id']}", audio)
+        self.store_in_cache(node, key)
+        notify_callback(node, key)
+        return key
+
+    def copy_from_cache(self, node: dict) -> str | None:
+        """Copies previously synthesized narration of this text to the node"""
+        import boto3
+        from botocore.exceptions import ClientError
+
+        if not TTS_CACHE:
+            return None
+
+        bucket = os.getenv("AWS_BUCKET_NAME")
+        cache_key = get_cache_key(node["prompt"], self.VOICE_NAME)
+        key = f"{node['story_id']}/{node['node_id']}.{FORMAT_EXTENSIONS[AUDIO_FORMAT]}"
+        try:
+            boto3.client("s3").copy_object(
+                Bucket=bucket,
+                CopySource={"Bucket": bucket, "Key": cache_key},
+                Key=key,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                print(f"Error reading TTS cache: {e}")
+            self.cache_misses += 1
+            return None
+
+        self.cache_hits += 1
+        print(f"TTS cache hit for {key}, hit rate {self.cache_stats()['hit_rate']:.2f}")
+        notify_callback(node, key)
+        return key
+
+    def store_in_cache(self, node: dict, key: str):
+        import boto3
+
+        if not TTS_CACHE:
+            return
+
+        bucket = os.getenv("AWS_BUCKET_NAME")
+        try:
+            boto3.client("s3").copy_object(
+                Bucket=bucket,
+                CopySource={"Bucket": bucket, "Key": key},
+                Key=get_cache_key(node["prompt"], self.VOICE_NAME),
+            )
+        except Exception as e:
+            print(f"Failed to cache narration for {key}: {e}")
+
+    @modal.method()
+    def cache_stats(self) -> dict:
+        """TTS cache hits and misses since this container started"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+        }
+
+    def upload_prefix(self, name: str, audio) -> str | None:
+        """The partial clip is only a head start, so a failed upload is skipped"""
+        try:
+            return self.put_audio(name, audio)
+        except Exception as e:
+            print(f"Failed to upload partial clip {name}: {e}")
+            return None
+
+    def stream_clip(self, node: dict) -> str:
+        """
+        Synthesize a node a sentence at a time, uploading the audio so far in
+        the background after each one, then upload the full clip and remove
+        the partial one.
+        """
+        import boto3
+        import numpy as np
+
+        start = time.perf_counter()
+        sentences = split_sentences(node["prompt"])
+        partial_name = f"{node['story_id']}/partial/{node['node_id']}"
+
+        chunks = []
+        prefixes = []
+        # A single worker keeps the partial uploads in order
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for sentence in sentences[:-1]:
+                chunks.append(self.synthesize(sentence))
+                if len(chunks) == 1:
+                    print(f"First audio after {time.perf_counter() - start:.2f}s")
+                prefixes.append(
+                    executor.submit(
+                        self.upload_prefix, partial_name, np.concatenate(chunks)
+                    )
+                )
+            chunks.append(self.synthesize(sentences[-1]))
+
+        key = self.upload_clip(node, np.concatenate(chunks))
+
+        partial_key = next(
+            (prefix.result() for prefix in prefixes if prefix.result()), None
+        )
+        if partial_key is not None:
+            boto3.client("s3").delete_object(
+                Bucket=os.getenv("AWS_BUCKET_NAME"), Key=partial_key
+            )
+        return key
+
+    @modal.method()
+    def narrate(self, node: dict):
+        gpu_seconds = self.gpu_seconds
+        key = self.copy_from_cache(node)
+        if key is None:
+            if node.get("stream", STREAM_AUDIO) and len(split_sentences(node["prompt"])) > 1:
+                key = self.stream_clip(node)
+            else:
+                key = self.upload_clip(node, self.synthesize(node["prompt"]))
+
+        return {"keys": [key], "gpu_seconds": self.gpu_seconds - gpu_seconds}
+
+    @modal.method()
+    def narrate_batch(self, nodes: list[dict]):
+        """
+        Narrate every node of a story in one call. Clips are encoded and
+        uploaded in the background while the next one is synthesized.
+        """
+        gpu_seconds = self.gpu_seconds
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            cached = list(executor.map(self.copy_from_cache, nodes))
+            nodes = [node for node, key in zip(nodes, cached) if key is None]
+            texts = [node["prompt"] for node in nodes]
+
+            uploads = [
+                executor.submit(self.upload_clip, nodes[index], audio)
+                for index, audio in self.synthesize_batch(texts)
+            ]
+
+        keys = [key for key in cached if key is not None]
+        return {
+            "keys": keys + [upload.result() for upload in uploads],
+            "gpu_seconds": self.gpu_seconds - gpu_seconds,
+        }
+
+
+# The endpoints only spawn the narration on a GPU container and answer with a
+# 202, so callers aren't held open or queued behind clips being synthesized.
+# The body carries the call id so the benchmark can collect each result.
+def accepted(call):
+    from fastapi import Response
+
+    return Response(
+        content=json.dumps({"call_id": call.object_id}),
+        media_type="application/json",
+        status_code=202,
+    )
+
+
+@app.function()
+@modal.web_endpoint(method="POST", requires_proxy_auth=True)
+def generate_audio(node: dict):
+    return accepted(KokoroGenerator().narrate.spawn(node))
+
+
+@app.function()
+@modal.web_endpoint(method="POST", requires_proxy_auth=True)
+def generate_audio_batch(request: dict):
+    return accepted(KokoroGenerator().narrate_batch.spawn(request["nodes"]))
+
+
+def post_jobs(url: str, headers: dict, bodies: list[dict]) -> list[str]:
+    """
+    Posts every body at once, like the workflow's dispatcher does, and
+    returns the id of each spawned call
+    """
+    import requests
+
+    def post(body: dict) -> str:
+        response = requests.post(url, json=body, headers=headers, timeout=60)
+        response.raise_for_status()
+        return response.json()["call_id"]
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return list(executor.map(post, bodies))
+
+
+def collect_results(call_ids: list[str], timeout: float = 900) -> list[dict]:
+    """Waits for every spawned call, which returns once its clips are in S3"""
+    deadline = time.perf_counter() + timeout
+    return [
+        modal.FunctionCall.from_id(call_id).get(
+            timeout=max(deadline - time.perf_counter(), 0)
+        )
+        for call_id in call_ids
+    ]
+
+
+@app.function(secrets=[modal.Secret.from_name("aws-secret")], timeout=3600)
+def benchmark_endpoints(
+    texts: list[str], per_node_url: str, batch_url: str, headers: dict
+) -> dict:
+    """
+    Narrate a story through the per-node endpoint, one request per node, and
+    through the batch endpoint in a single request. The per-node requests can
+    fan out over several containers, so throughput is clips per GPU second,
+    the time each call spent synthesizing, alongside the wall clock seconds
+    until every clip was in S3.
+    """
+    import boto3
+
+    s3 = boto3.client("s3")
+    bucket = os.getenv("AWS_BUCKET_NAME")
+    run = uuid.uuid4().hex[:8]
+    extension = FORMAT_EXTENSIONS[AUDIO_FORMAT]
+    cache_keys = [get_cache_key(text, "bm_lewis") for text in texts]
+
+    def clear(keys: list[str]):
+        for key in keys:
+            s3.delete_object(Bucket=bucket, Key=key)
+
+    # Warm up a container so neither path pays for its cold start
+    warmup = {"story_id": f"benchmark-{run}", "node_id": "warmup", "prompt": texts[0]}
+    collect_results(post_jobs(per_node_url, headers, [warmup]))
+    keys = [f"benchmark-{run}/warmup.{extension}"]
+
+    results = {}
+    for name, url in [("per_node", per_node_url), ("batch", batch_url)]:
+        nodes = [
+            {"story_id": f"benchmark-{run}/{name}", "node_id": f"node_{i}", "prompt": text}
+            for i, text in enumerate(texts)
+        ]
+        bodies = nodes if name == "per_node" else [{"nodes": nodes}]
+        # Neither path should be served from the other's cached narration
+        clear(cache_keys)
+
+        start = time.perf_counter()
+        calls = collect_results(post_jobs(url, headers, bodies))
+        elapsed = time.perf_counter() - start
+        gpu_seconds = sum(call["gpu_seconds"] for call in calls)
+
+        keys.extend(key for call in calls for key in call["keys"])
+        results[name] = {
+            "requests": len(bodies),
+            "seconds": elapsed,
+            "gpu_seconds": gpu_seconds,
+            "clips_per_gpu_second": len(nodes) / gpu_seconds,
+        }
+
+    clear(keys + cache_keys)
+    return results
+
+
+@app.local_entrypoint()
+def benchmark(clips: int = 16):
+    """
+    Compare both narration endpoints over HTTP on a story sized set of texts.
+    The endpoints need a proxy auth token in MODAL_PROXY_TOKEN_ID and
+    MODAL_PROXY_TOKEN_SECRET.
+    """
+    sentences = [
+        "The lantern flickered as the door creaked open.",
+        "Somewhere beyond the ridge, a horn sounded three times and then fell silent.",
+        "You step onto the bridge, the old ropes groaning under your weight while the river roars far below, and for a moment you wonder whether the stranger told you the truth.",
+    ]
+    # Every text is distinct so repeats aren't served from the TTS cache
+    texts = [
+        f"Chapter {i + 1}. " + " ".join(sentences[: i % len(sentences) + 1])
+        for i in range(clips)
+    ]
+    headers = {
+        "Modal-Key": os.environ["MODAL_PROXY_TOKEN_ID"],
+        "Modal-Secret": os.environ["MODAL_PROXY_TOKEN_SECRET"],
+    }
+
+    results = benchmark_endpoints.remote(
+        texts, generate_audio.web_url, generate_audio_batch.web_url, headers
+    )
+    for name, result in results.items():
+        print(
+            f"{name}: {result['requests']} requests, {result['seconds']:.2f}s "
+            f"until every clip was uploaded, {result['gpu_seconds']:.2f} GPU seconds, "
+            f"{result['clips_per_gpu_second']:.2f} clips per GPU second"
         )
@@ -1,15 +1,25 @@
+import hashlib
+import io
 import json
+import os
+import queue
 import subprocess
+import threading
+import time
 import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict
 
 import modal
 
+from callbacks import notify_callback
+
 image = (
     modal.Image.debian_slim(python_version="3.11")
     .apt_install("git")
-    .pip_install("comfy-cli==1.2.7", "requests", "boto3")
+    .pip_install("comfy-cli==1.2.7", "requests", "boto3", "websocket-client", "fastapi")
     .run_commands("comfy --skip-prompt install --nvidia")
     .run_commands("comfy node install was-node-suite-comfyui ComfyUI-GGUF")
     .run_commands(  # needs to be empty for Volume mount to work
@@ -21,6 +31,435 @@ app = modal.App(name="comfyui-api", image=image)
 
 vol = modal.Volume.from_name("comfyui-models", create_if_missing=True)
 
+# Address of the ComfyUI server started by `comfy launch`
+COMFY_HOST = "127.0.0.1:8188"
+COMFY_OUTPUT_DIR = "/root/comfy/ComfyUI/output"
+
+# Prompts that arrive within the batch window of each other are rendered as a
+# single batched latent, up to the max batch size
+MAX_BATCH_SIZE = int(os.getenv("IMAGE_MAX_BATCH_SIZE", "8"))
+BATCH_WINDOW_SECONDS = int(os.getenv("IMAGE_BATCH_WINDOW_MS", "250")) / 1000
+# How long a request waits for its batch before giving up on it
+RENDER_TIMEOUT_SECONDS = int(os.getenv("IMAGE_RENDER_TIMEOUT_SECONDS", "1500"))
+
+# Compressed variants that are uploaded next to the original PNG. Their keys
+# carry a version derived from the image prompt, which with the seed derived
+# from it determines the image, so a regenerated node with a new prompt gets
+# new keys and the variants can be cached as immutable. The PNG stays under
+# the node's key, which the workflow waits on, so it's only cached briefly.
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp")
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "256"))
+CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "public, max-age=3600")
+VARIANT_CACHE_CONTROL = os.getenv(
+    "IMAGE_VARIANT_CACHE_CONTROL", "public, max-age=31536000, immutable"
+)
+
+# Rendered images are cached under a hash of their prompt, seed, workflow and
+# resolution so a repeat request becomes a server side copy. Every hit
+# refreshes an entry's last modified time and the least recently used
+# entries are evicted once the cache outgrows its budget.
+IMAGE_CACHE = os.getenv("IMAGE_CACHE", "true").lower() == "true"
+IMAGE_CACHE_PREFIX = "image-cache"
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(20 * 1024**3)))
+
+
+@dataclass
+class ImageVariant:
+    suffix: str
+    body: bytes
+    content_type: str
+
+
+def encode_variants(
+    png: bytes,
+    image_format: str = IMAGE_FORMAT,
+    quality: int = IMAGE_QUALITY,
+    thumbnail_size: int = THUMBNAIL_SIZE,
+) -> list[ImageVariant]:
+    """
+    Encode the full size image and a thumbnail in a compressed format. The
+    original PNG is returned last since the workflow waits on its key.
+    """
+    from PIL import Image, features
+
+    if image_format == "avif" and not features.check("avif"):
+        print("AVIF isn't supported by this Pillow build, falling back to WebP")
+        image_format = "webp"
+
+    image = Image.open(io.BytesIO(png))
+    image.load()
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+
+    variants = []
+    for suffix, variant in [(image_format, image), (f"thumb.{image_format}", thumbnail)]:
+        body = io.BytesIO()
+        variant.save(body, format=image_format.upper(), quality=quality)
+        variants.append(ImageVariant(suffix, body.getvalue(), f"image/{image_format}"))
+
+    return variants + [ImageVariant("png", png, "image/png")]
+
+
+def get_image_version(prompt: str) -> str:
+    """
+    32-bit FNV-1a hash of the prompt, which the frontend and the story
+    service compute the same way to find a node's variants
+    """
+    version = 0x811C9DC5
+    for byte in prompt.encode("utf-8"):
+        version = ((version ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return f"{version:08x}"
+
+
+def get_variant_key(name: str, version: str, suffix: str) -> str:
+    if suffix == "png":
+        return f"{name}.png"
+    return f"{name}.{version}.{suffix}"
+
+
+def get_cache_control(suffix: str) -> str:
+    return CACHE_CONTROL if suffix == "png" else VARIANT_CACHE_CONTROL
+
+
+def get_default_seed(prompt: str) -> int:
+    """Requests without a seed get one derived from their prompt"""
+    return int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12], 16)
+
+
+def get_image_cache_key(prompt: str, seed: int, version: str, resolution: str) -> str:
+    payload = f"{version}:{resolution}:{seed}:{prompt}"
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return f"{IMAGE_CACHE_PREFIX}/{digest}"
+
+
+def select_evictions(objects: list[Dict], max_bytes: int) -> list[str]:
+    """
+    Keys of the least recently used cache entries to delete so the cache
+    fits in max_bytes. An entry is every variant stored under one hash.
+    """
+    entries: Dict[str, Dict] = {}
+    for obj in objects:
+        name = obj["Key"].split(".", 1)[0]
+        entry = entries.setdefault(name, {"keys": [], "size": 0, "last_used": None})
+        entry["keys"].append(obj["Key"])
+        entry["size"] += obj["Size"]
+        if entry["last_used"] is None or obj["LastModified"] > entry["last_used"]:
+            entry["last_used"] = obj["LastModified"]
+
+    total = sum(entry["size"] for entry in entries.values())
+    evicted = []
+    for entry in sorted(entries.values(), key=lambda entry: entry["last_used"]):
+        if total <= max_bytes:
+            break
+        evicted.extend(entry["keys"])
+        total -= entry["size"]
+    return evicted
+
+
+@app.function(
+    secrets=[modal.Secret.from_name("aws-secret")],
+    schedule=modal.Period(hours=1),
+)
+def evict_image_cache(max_bytes: int = IMAGE_CACHE_MAX_BYTES) -> int:
+    import boto3
+
+    s3 = boto3.client("s3")
+    bucket = os.getenv("AWS_BUCKET_NAME")
+
+    objects = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{IMAGE_CACHE_PREFIX}/"):
+        objects.extend(page.get("Contents", []))
+
+    evicted = select_evictions(objects, max_bytes)
+    # delete_objects takes at most 1000 keys per request
+    for start in range(0, len(evicted), 1000):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in evicted[start : start + 1000]]},
+        )
+
+    print(f"Evicted {len(evicted)} of {len(objects)} cached image objects")
+    return len(evicted)
+
+
+@dataclass
+class FluxTemplate:
+    """
+    The Flux workflow parsed once at startup, with the nodes we patch per
+    batch looked up by type instead of by their ids in the file
+    """
+
+    workflow: Dict
+    prompt_node: str
+    latent_node: str
+    noise_node: str
+    save_node: str
+
+    @classmethod
+    def from_workflow(cls, workflow: Dict) -> "FluxTemplate":
+        # Preview nodes only write a second copy of every image to disk
+        workflow = {
+            node_id: node
+            for node_id, node in workflow.items()
+            if node.get("class_type") != "PreviewImage"
+        }
+
+        def find(class_type: str) -> str:
+            return next(
+                node_id
+                for node_id, node in workflow.items()
+                if node.get("class_type") == class_type
+            )
+
+        return cls(
+            workflow=workflow,
+            prompt_node=find("CLIPTextEncode"),
+            latent_node=find("EmptyLatentImage"),
+            noise_node=find("RandomNoise"),
+            save_node=find("SaveImage"),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "FluxTemplate":
+        return cls.from_workflow(json.loads(Path(path).read_text()))
+
+    @property
+    def version(self) -> str:
+        return hashlib.sha256(
+            json.dumps(self.workflow, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+
+    @property
+    def resolution(self) -> str:
+        latent = self.workflow[self.latent_node]["inputs"]
+        return f"{latent['width']}x{latent['height']}"
+
+    def build(self, prompts: list[str], seeds: list[int], prefix: str) -> Dict:
+        """
+        Swap the prompt encoder and noise for our batch nodes and size the
+        latent to match, so every prompt gets its own image and seed in one
+        pass. Only the patched nodes are copied, the template itself is
+        never modified.
+        """
+        workflow = dict(self.workflow)
+
+        prompt = self.workflow[self.prompt_node]
+        workflow[self.prompt_node] = {
+            "inputs": {"prompts": json.dumps(prompts), "clip": prompt["inputs"]["clip"]},
+            "class_type": "BatchCLIPTextEncode",
+        }
+
+        workflow[self.noise_node] = {
+            "inputs": {"seeds": json.dumps(seeds)},
+            "class_type": "BatchRandomNoise",
+        }
+
+        latent = self.workflow[self.latent_node]
+        workflow[self.latent_node] = {
+            **latent,
+            "inputs": {**latent["inputs"], "batch_size": len(prompts)},
+        }
+
+        save = self.workflow[self.save_node]
+        workflow[self.save_node] = {
+            **save,
+            "inputs": {**save["inputs"], "filename_prefix": prefix},
+        }
+        return workflow
+
+
+@dataclass
+class RenderedImage:
+    image: bytes
+    batch_size: int
+    latency: float
+    gpu_seconds: float
+
+
+@dataclass
+class PendingImage:
+    prompt: str
+    seed: int
+    submitted_at: float = field(default_factory=time.perf_counter)
+    future: Future = field(default_factory=Future)
+
+
+class ImageBatcher:
+    """
+    Collects prompts from concurrent requests and renders them together.
+    A batch is run once it's full or the window since its first prompt has
+    passed, and each request gets back only its own image. Every request in
+    a batch is resolved, with an error if the batch didn't produce its image.
+    """
+
+    def __init__(
+        self,
+        render: Callable[[list[str], list[int]], list[bytes]],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        window_seconds: float = BATCH_WINDOW_SECONDS,
+        timeout: float = RENDER_TIMEOUT_SECONDS,
+    ):
+        self.render = render
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+        self.timeout = timeout
+        self.queue: queue.Queue[PendingImage] = queue.Queue()
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, prompt: str, seed: int) -> RenderedImage:
+        pending = PendingImage(prompt, seed)
+        self.queue.put(pending)
+        return pending.future.result(timeout=self.timeout)
+
+    def next_batch(self) -> list[PendingImage]:
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batch(self, batch: list[PendingImage]):
+        start = time.perf_counter()
+        try:
+            images = self.render(
+                [pending.prompt for pending in batch],
+                [pending.seed for pending in batch],
+            )
+            if len(images) != len(batch):
+                raise RuntimeError(
+                    f"Rendered {len(images)} images for a batch of {len(batch)} prompts"
+                )
+
+            finished = time.perf_counter()
+            gpu_seconds = finished - start
+            print(f"Rendered a batch of {len(batch)} images in {gpu_seconds:.2f}s")
+            for pending, image in zip(batch, images):
+                pending.future.set_result(
+                    RenderedImage(
+                        image=image,
+                        batch_size=len(batch),
+                        latency=finished - pending.submitted_at,
+                        gpu_seconds=gpu_seconds / len(batch),
+                    )
+                )
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+
+    def loop(self):
+        while True:
+            self.run_batch(self.next_batch())
+
+
+class ComfyClient:
+    """
+    Talks to the ComfyUI server over its HTTP and websocket API so a prompt
+    graph can be run without going through the CLI or the filesystem
+    """
+
+    def __init__(
+        self,
+        host: str = COMFY_HOST,
+        timeout: int = 1200,
+        output_dir: str | None = None,
+    ):
+        self.host = host
+        self.timeout = timeout
+        # When the server shares our filesystem, outputs are deleted once
+        # they've been fetched so the output directory doesn't grow forever
+        self.output_dir = output_dir
+
+    def queue_prompt(self, workflow: Dict, client_id: str) -> str:
+        import requests
+
+        response = requests.post(
+            f"http://{self.host}/prompt",
+            json={"prompt": workflow, "client_id": client_id},
+            timeout=30,
+        )
+        response.raise_for_status()
+        return response.json()["prompt_id"]
+
+    def wait_for_prompt(self, ws, prompt_id: str):
+        """Block until the server reports that it has finished our prompt"""
+        while True:
+            message = ws.recv()
+            # Binary messages are previews of the image as it's sampled
+            if not isinstance(message, str):
+                continue
+
+            event = json.loads(message)
+            data = event.get("data", {})
+            if data.get("prompt_id") != prompt_id:
+                continue
+
+            if event["type"] == "execution_error":
+                raise RuntimeError(
+                    f"ComfyUI failed to run prompt {prompt_id}: {data.get('exception_message')}"
+                )
+            if event["type"] == "executing" and data.get("node") is None:
+                return
+
+    def get_outputs(self, prompt_id: str, node_id: str) -> list[Dict]:
+        import requests
+
+        response = requests.get(f"http://{self.host}/history/{prompt_id}", timeout=30)
+        response.raise_for_status()
+        return response.json()[prompt_id]["outputs"][node_id]["images"]
+
+    def get_image(self, output: Dict) -> bytes:
+        import requests
+
+        response = requests.get(
+            f"http://{self.host}/view",
+            params={
+                "filename": output["filename"],
+                "subfolder": output["subfolder"],
+                "type": output["type"],
+            },
+            timeout=30,
+        )
+        response.raise_for_status()
+        return response.content
+
+    def run(self, workflow: Dict, output_node: str) -> list[bytes]:
+        """Run a prompt graph and return the images of its output node"""
+        import websocket
+
+        # Every run gets its own websocket so concurrent runs only ever see
+        # their own progress events
+        client_id = uuid.uuid4().hex
+        ws = websocket.create_connection(
+            f"ws://{self.host}/ws?clientId={client_id}", timeout=self.timeout
+        )
+        try:
+            prompt_id = self.queue_prompt(workflow, client_id)
+            self.wait_for_prompt(ws, prompt_id)
+        finally:
+            ws.close()
+
+        images = []
+        for output in self.get_outputs(prompt_id, output_node):
+            images.append(self.get_image(output))
+            self.remove_output(output)
+        return images
+
+    def remove_output(self, output: Dict):
+        if self.output_dir is None or output["type"] != "output":
+            return
+        Path(self.output_dir, output["subfolder"], output["filename"]).unlink(
+            missing_ok=True
+        )
+
 
 @app.cls(
     gpu="A100",
@@ -30,60 +469,157 @@ vol = modal.Volume.from_name("comfyui-models", create_if_missing=True)
             "workflows/flux.json",
             "/root/flux.json",
         ),
+        modal.Mount.from_local_file(
+            "workflows/nodes/batch_prompts.py",
+            "/root/comfy/ComfyUI/custom_nodes/batch_prompts.py",
+        ),
     ],
     secrets=[modal.Secret.from_name("aws-secret")],
     concurrency_limit=45,
+    # Each container takes several requests at once so they can be batched
+    allow_concurrent_inputs=MAX_BATCH_SIZE,
 )
 class ComfyUI:
     @modal.enter()
     def launch_comfy_background(self):
         cmd = "comfy launch --background"
         subprocess.run(cmd, shell=True, check=True)
+        self.comfy = ComfyClient(output_dir=COMFY_OUTPUT_DIR)
+        self.template = FluxTemplate.load("/root/flux.json")
+        self.batcher = ImageBatcher(self.render_batch)
 
     @modal.method()
-    def infer(self, workflow_path: str = "/root/flux.json"):
-        cmd = f"comfy run --workflow {workflow_path} --wait --timeout 1200"
-        subprocess.run(cmd, shell=True, check=True)
+    def infer(self, workflow: Dict) -> list[bytes]:
+        output_node = next(
+            node_id
+            for node_id, node in workflow.items()
+            if node.get("class_type") in ("SaveImage", "SaveAnimatedWEBP")
+        )
+        return self.comfy.run(workflow, output_node)
 
-        output_dir = "/root/comfy/ComfyUI/output"
-        workflow = json.loads(Path(workflow_path).read_text())
-        file_prefix = [
-            node.get("inputs")
-            for node in workflow.values()
-            if node.get("class_type") == "SaveImage"
-            or node.get("class_type") == "SaveAnimatedWEBP"
-        ][0]["filename_prefix"]
-
-        for f in Path(output_dir).iterdir():
-            if f.name.startswith(file_prefix):
-                return f.read_bytes()
-
-    @modal.web_endpoint(method="POST")
-    def api(self, node: Dict):
-        import boto3
-        import os
+    def render_batch(self, prompts: list[str], seeds: list[int]) -> list[bytes]:
+        return self.infer.local(self.template.build(prompts, seeds, uuid.uuid4().hex))
 
-        print(f"Recieved request: {node}")
-        workflow_data = json.loads(Path("/root/flux.json").read_text())
+    def copy_from_cache(self, s3, cache_key: str, name: str, version: str) -> bool:
+        """
+        Copies a cached image and its variants over to a node. The cached PNG
+        lists the variants stored alongside it and is copied last, since the
+        workflow waits on the PNG key.
+        """
+        from botocore.exceptions import ClientError
 
-        # Update workflow with node prompt
-        workflow_data["6"]["inputs"]["text"] = node["prompt"]
+        bucket = os.getenv("AWS_BUCKET_NAME")
+        try:
+            cached = s3.head_object(Bucket=bucket, Key=f"{cache_key}.png")
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                print(f"Error reading image cache: {e}")
+            return False
 
-        # Set unique filename prefix
-        client_id = uuid.uuid4().hex
-        workflow_data["9"]["inputs"]["filename_prefix"] = client_id
+        variants = cached["Metadata"].get("variants", "").split(",")
+        for suffix in [suffix for suffix in variants if suffix] + ["png"]:
+            # Entries cached with an older Cache-Control would pass it on
+            s3.copy_object(
+                Bucket=bucket,
+                CopySource={"Bucket": bucket, "Key": f"{cache_key}.{suffix}"},
+                Key=get_variant_key(name, version, suffix),
+                MetadataDirective="REPLACE",
+                ContentType=f"image/{suffix.rsplit('.', 1)[-1]}",
+                CacheControl=get_cache_control(suffix),
+            )
 
-        # Save temporary workflow file
-        new_workflow_file = f"{client_id}.json"
-        json.dump(workflow_data, Path(new_workflow_file).open("w"))
+        # Copying the entry onto itself refreshes its last modified time,
+        # which is what eviction orders entries by
+        self.store_in_cache(
+            s3, f"{cache_key}.png", f"{cache_key}.png", "image/png", variants
+        )
+        return True
 
-        # Generate image
-        img_bytes = self.infer.local(new_workflow_file)
+    def store_in_cache(
+        self, s3, key: str, cache_key: str, content_type: str, variants: list[str]
+    ):
+        bucket = os.getenv("AWS_BUCKET_NAME")
+        s3.copy_object(
+            Bucket=bucket,
+            CopySource={"Bucket": bucket, "Key": key},
+            Key=cache_key,
+            MetadataDirective="REPLACE",
+            Metadata={"variants": ",".join(variants)},
+            ContentType=content_type,
+            CacheControl=CACHE_CONTROL,
+        )
 
-        # Upload to S3
+    @modal.method()
+    def generate(self, node: Dict):
+        import boto3
+
+        name = f"{node['story_id']}/{node['node_id']}"
+        key = f"{name}.png"
         s3 = boto3.client("s3")
-        s3.put_object(
-            Bucket=os.getenv("AWS_BUCKET_NAME"),
-            Key=f"{node['story_id']}/{node['node_id']}.png",
-            Body=img_bytes,
+
+        seed = node.get("seed")
+        if seed is None:
+            seed = get_default_seed(node["prompt"])
+        cache_key = get_image_cache_key(
+            node["prompt"], seed, self.template.version, self.template.resolution
         )
+        version = get_image_version(node["prompt"])
+
+        if IMAGE_CACHE and self.copy_from_cache(s3, cache_key, name, version):
+            print(f"Copied {key} from the image cache")
+            notify_callback(node, key)
+            return
+
+        # Generate image, batched with any other prompts that arrive alongside it
+        rendered = self.batcher.submit(node["prompt"], seed)
+        img_bytes = rendered.image
+
+        # Upload to S3
+        variants = encode_variants(img_bytes)
+        for variant in variants:
+            variant_key = get_variant_key(name, version, variant.suffix)
+            s3.put_object(
+                Bucket=os.getenv("AWS_BUCKET_NAME"),
+                Key=variant_key,
+                Body=variant.body,
+                ContentType=variant.content_type,
+                CacheControl=get_cache_control(variant.suffix),
+            )
+            print(
+                f"Uploaded {variant_key}: {len(variant.body)} bytes ({len(variant.body) / len(img_bytes):.0%} of the PNG)"
+            )
+        print(
+            f"Uploaded {key} after {rendered.latency:.2f}s in a batch of {rendered.batch_size} ({rendered.gpu_seconds:.2f} GPU seconds)"
+        )
+
+        notify_callback(node, key)
+
+        if IMAGE_CACHE:
+            # The PNG goes in last, since its presence marks the entry complete
+            suffixes = [variant.suffix for variant in variants[:-1]]
+            try:
+                for variant in variants:
+                    self.store_in_cache(
+                        s3,
+                        get_variant_key(name, version, variant.suffix),
+                        f"{cache_key}.{variant.suffix}",
+                        variant.content_type,
+                        suffixes,
+                    )
+            except Exception as e:
+                print(f"Failed to cache {key}: {e}")
+
+
+@app.function()
+@modal.web_endpoint(method="POST")
+def api(node: Dict):
+    """
+    Hands an image job to a GPU container and answers with a 202 straight
+    away, so the caller isn't held open or queued behind running renders
+    """
+    from fastapi import Response
+
+    # The rest of the node carries the workflow's ingress token
+    print(f"Received request for {node['story_id']}/{node['node_id']}")
+    ComfyUI().generate.spawn(node)
+    return Response(status_code=202)
@@ -1,6 +1,10 @@
 import pytest
-from unittest.mock import MagicMock, patch, mock_open
-import tempfile
+from unittest.mock import MagicMock, patch
+import io
+import sys
+import boto3
+import numpy as np
+from scipy.io import wavfile
 
 
 # Mock the modal library since it's not available in the test environment
@@ -14,21 +18,33 @@ class MockModal:
         def __init__(self, name=None):
             self.name = name
             
-        def function(self, image=None, gpu=None, secrets=None):
+        def function(self, **kwargs):
             def decorator(func):
                 return func
             return decorator
-            
-        def web_endpoint(self, method=None):
-            def decorator(func):
-                return func
+
+        def cls(self, **kwargs):
+            def decorator(cls):
+                return cls
             return decorator
-            
+
     class Secret:
         @staticmethod
         def from_name(name):
             return MockSecret(name)
 
+    @staticmethod
+    def enter():
+        def decorator(func):
+            return func
+        return decorator
+
+    @staticmethod
+    def web_endpoint(method=None, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
 
 class MockImage:
     def apt_install(self, *args):
@@ -52,31 +68,27 @@ with patch.dict('sys.modules', {'modal': MagicMock()}):
     sys.modules['modal'] = MockModal()
     
     # Now we can import our module
-    from audio import generate_audio, AudioRequest
-
-
-@pytest.fixture
-def mock_transformers():
-    with patch('transformers.pipeline') as mock_pipeline:
-        mock_pipe = MagicMock()
-        mock_pipe.return_value = {"audio": [0.1, 0.2, 0.3], "sampling_rate": 44100}
-        mock_pipeline.return_value = mock_pipe
-        yield mock_pipeline
+    from audio import MusicGenerator, AudioRequest, MAX_NEW_TOKENS
 
 
 @pytest.fixture
-def mock_wavfile():
-    with patch('scipy.io.wavfile') as mock_wavfile:
-        yield mock_wavfile
+def mock_transformers(monkeypatch):
+    mock_pipe = MagicMock()
+    mock_pipe.return_value = {
+        "audio": np.zeros((1, 1, 32000), dtype=np.float16),
+        "sampling_rate": 32000,
+    }
+    mock_pipeline = MagicMock(return_value=mock_pipe)
+    monkeypatch.setitem(sys.modules, 'transformers', MagicMock(pipeline=mock_pipeline))
+    monkeypatch.setitem(sys.modules, 'torch', MagicMock())
+    return mock_pipeline
 
 
 @pytest.fixture
-def mock_tempfile():
-    with patch('tempfile.NamedTemporaryFile') as mock_temp:
-        mock_temp_file = MagicMock()
-        mock_temp_file.name = "/tmp/test_audio.wav"
-        mock_temp.return_value.__enter__.return_value = mock_temp_file
-        yield mock_temp
+def generator(mock_transformers):
+    generator = MusicGenerator()
+    generator.load_pipeline()
+    return generator
 
 
 @pytest.fixture
@@ -93,53 +105,70 @@ def mock_requests():
         yield mock_post
 
 
-def test_generate_audio(mock_transformers, mock_wavfile, mock_tempfile, mock_boto3, mock_requests):
+def make_request(**kwargs):
+    return AudioRequest(
+        prompt="Generate epic adventure music",
+        storyId="test_story_id",
+        callback_url="http://test-callback",
+        callback_token="test-token",
+        **kwargs,
+    )
+
+
+def test_load_pipeline(mock_transformers):
+    """Test that the pipeline is built once, in half precision on a GPU"""
+    torch = sys.modules['torch']
+    torch.cuda.is_available.return_value = True
+
+    generator = MusicGenerator()
+    generator.load_pipeline()
+
+    mock_transformers.assert_called_once_with(
+        "text-to-audio",
+        model="facebook/musicgen-medium",
+        device=0,
+        torch_dtype=torch.float16,
+    )
+    assert generator.pipe is mock_transformers.return_value
+
+
+def test_generate_audio(generator, mock_transformers, mock_boto3, mock_requests):
     """Test the audio generation endpoint"""
-    # Mock open
-    with patch('builtins.open', mock_open(read_data=b"test_audio_data")) as mock_file:
-        # Mock os.getenv
-        with patch('os.getenv') as mock_getenv:
-            mock_getenv.return_value = "test-bucket"
-            
-            # Create a request
-            request = AudioRequest(
-                prompt="Generate epic adventure music",
-                storyId="test_story_id",
-                callback_url="http://test-callback",
-                callback_token="test-token"
-            )
-            
-            # Call the function
-            generate_audio(request)
-            
-            # Check that the pipeline was created correctly
-            mock_transformers.assert_called_once_with("text-to-audio", model="facebook/musicgen-medium")
-            
-            # Check that the pipeline was called with the prompt
-            mock_transformers.return_value.assert_called_once_with(
-                "Generate epic adventure music",
-                forward_params={"do_sample": True}
-            )
-            
-            # Check that the audio was written to a file
-            mock_wavfile.write.assert_called_once_with(
-                "/tmp/test_audio.wav", 
-                44100, 
-                [0.1, 0.2, 0.3]
-            )
-            
-            # Check that the file was opened
-            mock_file.assert_called_once_with("/tmp/test_audio.wav", "rb")
-            
-            # Check that the audio was uploaded to S3
-            mock_boto3.put_object.assert_called_once_with(
-                Bucket="test-bucket",
-                Key="test_story_id/theme_song.wav",
-                Body=b"test_audio_data"
-            )
-            
-            # Check that the callback was called
-            mock_requests.assert_called_once_with(
-                "http://test-callback",
-                headers={"Authorization": "Bearer test-token"}
-            )
\ No newline at end of file
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.generate_audio(make_request(duration_seconds=8))
+        generator.generate_audio(make_request(duration_seconds=4))
+
+    # The model is only loaded once for both requests
+    mock_transformers.assert_called_once()
+
+    generator.pipe.assert_any_call(
+        "Generate epic adventure music",
+        forward_params={"do_sample": True, "max_new_tokens": 400},
+    )
+    generator.pipe.assert_any_call(
+        "Generate epic adventure music",
+        forward_params={"do_sample": True, "max_new_tokens": 200},
+    )
+
+    # The wav is encoded in memory and uploaded as a mono clip
+    put = mock_boto3.put_object.call_args.kwargs
+    assert put["Bucket"] == "test-bucket"
+    assert put["Key"] == "test_story_id/theme_song.wav"
+    assert put["ContentType"] == "audio/wav"
+    rate, data = wavfile.read(io.BytesIO(put["Body"]))
+    assert rate == 32000
+    assert data.shape == (32000,)
+
+    mock_requests.assert_called_with(
+        "http://test-callback",
+        headers={"Authorization": "Bearer test-token"}
+    )
+
+
+def test_generate_audio_token_budget(generator, mock_boto3, mock_requests):
+    """Test that long durations are capped by the token budget"""
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.generate_audio(make_request(duration_seconds=600))
+
+    forward_params = generator.pipe.call_args.kwargs["forward_params"]
+    assert forward_params["max_new_tokens"] == MAX_NEW_TOKENS
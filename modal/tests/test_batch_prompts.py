@@ -0,0 +1,61 @@
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+
+# ComfyUI and torch are only available inside the image container
+with patch.dict('sys.modules', {'comfy': MagicMock(), 'comfy.sample': MagicMock(), 'torch': MagicMock()}):
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", "workflows", "nodes"))
+
+    from batch_prompts import BatchCLIPTextEncode, pad_tokens
+
+
+PAD = (0, 1.0)
+END = (1, 1.0)
+# The empty prompt is the end token followed by the tokenizer's padding
+EMPTY = {"l": [[(49406, 1.0)] + [(49407, 1.0)] * 76], "t5xxl": [[END] + [PAD] * 255]}
+
+
+def t5_tokens(count):
+    return [(100 + i, 1.0) for i in range(count)] + [END]
+
+
+def test_pad_tokens():
+    """Test that T5 tokens are padded to a fixed length with the tokenizer's pad entry"""
+    tokens = {"l": EMPTY["l"], "t5xxl": [t5_tokens(3)]}
+
+    padded = pad_tokens(tokens, EMPTY, {"t5xxl": 8})
+
+    assert padded["t5xxl"] == [t5_tokens(3) + [PAD] * 4]
+    # CLIP tokens are left as they are
+    assert padded["l"] == EMPTY["l"]
+    assert tokens["t5xxl"] == [t5_tokens(3)]
+
+
+def test_pad_tokens_truncates():
+    """Test that a prompt over the fixed length is cut short but keeps its end token"""
+    padded = pad_tokens({"t5xxl": [t5_tokens(10)]}, EMPTY, {"t5xxl": 8})
+
+    assert padded["t5xxl"] == [t5_tokens(7)]
+
+
+def test_encode_is_independent_of_batchmates():
+    """Test that a prompt is encoded from the same tokens whatever it is batched with"""
+    clip = MagicMock()
+    clip.tokenize.side_effect = lambda prompt: (
+        EMPTY if not prompt else {"l": EMPTY["l"], "t5xxl": [t5_tokens(len(prompt))]}
+    )
+    clip.encode_from_tokens.return_value = (MagicMock(), MagicMock())
+
+    def encoded_tokens(prompts):
+        clip.encode_from_tokens.reset_mock()
+        BatchCLIPTextEncode().encode(clip, json.dumps(prompts))
+        return [call.args[0] for call in clip.encode_from_tokens.call_args_list]
+
+    alone = encoded_tokens(["short"])
+    batched = encoded_tokens(["short", "a much longer prompt than the first"])
+
+    assert batched[0] == alone[0]
+    assert [len(tokens["t5xxl"][0]) for tokens in batched] == [512, 512]
+
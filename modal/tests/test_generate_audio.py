@@ -0,0 +1,429 @@
+import pytest
+from unittest.mock import MagicMock, patch
+import io
+import numpy as np
+from botocore.exceptions import ClientError
+
+
+# Mock the modal library since it's not available in the test environment
+class MockModal:
+    class Image:
+        @staticmethod
+        def debian_slim(python_version=None):
+            return MockImage()
+
+    class App:
+        def __init__(self, name=None, image=None):
+            self.name = name
+            self.image = image
+
+        def cls(self, **kwargs):
+            def decorator(cls):
+                return cls
+            return decorator
+
+        def function(self, **kwargs):
+            def decorator(func):
+                return func
+            return decorator
+
+        def local_entrypoint(self):
+            def decorator(func):
+                return func
+            return decorator
+
+    class Volume:
+        @staticmethod
+        def from_name(name, create_if_missing=False):
+            return MockVolume()
+
+    class Secret:
+        @staticmethod
+        def from_name(name):
+            return MockSecret(name)
+
+    @staticmethod
+    def enter():
+        def decorator(func):
+            return func
+        return decorator
+
+    @staticmethod
+    def method():
+        def decorator(func):
+            return func
+        return decorator
+
+    @staticmethod
+    def web_endpoint(method=None, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+
+class MockImage:
+    def apt_install(self, *args):
+        return self
+
+    def pip_install(self, *args):
+        return self
+
+
+class MockVolume:
+    pass
+
+
+class MockSecret:
+    def __init__(self, name):
+        self.name = name
+
+
+# Patch modal before importing the module. The upload tests read the clips
+# back as wav, so they run against the uncompressed format.
+with patch.dict('sys.modules', {'modal': MagicMock()}), patch.dict('os.environ', {'AUDIO_FORMAT': 'wav'}):
+    import sys
+    sys.modules['modal'] = MockModal()
+
+    # Now we can import our module
+    import generate_audio
+    from generate_audio import KokoroGenerator, encode_audio, split_sentences, get_cache_key
+
+
+def make_clip(seconds=2, rate=22050):
+    t = np.linspace(0, seconds, rate * seconds, dtype=np.float32)
+    return (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+@pytest.fixture
+def generator():
+    generator = KokoroGenerator()
+    generator.MODEL = MagicMock()
+    generator.VOICE_NAME = "bm_lewis"
+    generator.VOICEPACK = MagicMock()
+    generator.generate_fn = MagicMock(return_value=(make_clip(), "phonemes"))
+    generator.phonemize_fn = MagicMock(side_effect=lambda text, lang: text)
+    # Every character is a token, so the tests can read texts back out of a batch
+    generator.tokenize_fn = MagicMock(side_effect=list)
+    generator.forward_batch = MagicMock(
+        side_effect=lambda token_lists: [make_clip() for _ in token_lists]
+    )
+    return generator
+
+
+def batched_texts(generator):
+    return [
+        ["".join(tokens) for tokens in call.args[0]]
+        for call in generator.forward_batch.call_args_list
+    ]
+
+
+@pytest.fixture
+def mock_boto3():
+    with patch('boto3.client') as mock_client:
+        mock_s3 = MagicMock()
+        cached = set()
+
+        # The TTS cache starts out empty and fills up as clips are copied in
+        def copy_object(Bucket, CopySource, Key):
+            if CopySource["Key"].startswith("tts-cache/") and CopySource["Key"] not in cached:
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "CopyObject")
+            cached.add(Key)
+
+        mock_s3.copy_object.side_effect = copy_object
+        mock_client.return_value = mock_s3
+        yield mock_s3
+
+
+@pytest.fixture
+def mock_requests():
+    with patch('requests.post') as mock_post:
+        yield mock_post
+
+
+@pytest.mark.parametrize("audio_format,extension,content_type", [
+    ("wav", "wav", "audio/wav"),
+    ("opus", "ogg", "audio/ogg"),
+    ("mp3", "mp3", "audio/mpeg"),
+])
+def test_encode_audio(audio_format, extension, content_type):
+    """Test that clips are encoded in memory in each supported format"""
+    import soundfile as sf
+
+    encoded = encode_audio(make_clip(), audio_format=audio_format)
+
+    assert encoded.extension == extension
+    assert encoded.content_type == content_type
+    data, rate = sf.read(io.BytesIO(encoded.body))
+    assert len(data) / rate == pytest.approx(2, abs=0.1)
+
+
+def test_encode_audio_compresses():
+    """Test that compressed formats are much smaller than the wav"""
+    clip = make_clip(seconds=10)
+
+    wav = encode_audio(clip, audio_format="wav")
+    opus = encode_audio(clip, audio_format="opus", compression_level=0.9)
+    mp3 = encode_audio(clip, audio_format="mp3", compression_level=0.9)
+
+    assert len(opus.body) * 10 < len(wav.body)
+    assert len(mp3.body) * 10 < len(wav.body)
+
+
+def test_encode_audio_unsupported_format():
+    """Test that an unknown format is rejected"""
+    with pytest.raises(ValueError):
+        encode_audio(make_clip(), audio_format="flac")
+
+
+def test_generate_audio(generator, mock_boto3, mock_requests):
+    """Test that a node's narration is uploaded and its callback resolved"""
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.narrate({
+            "prompt": "Once upon a time.",
+            "story_id": "test_story_id",
+            "node_id": "test_node_id",
+            "callback_url": "http://test-callback",
+            "callback_token": "test-token",
+        })
+
+    generator.generate_fn.assert_called_once_with(
+        generator.MODEL, "Once upon a time.", generator.VOICEPACK, lang="b", ps=None
+    )
+    put = mock_boto3.put_object.call_args.kwargs
+    assert put["Bucket"] == "test-bucket"
+    assert put["Key"] == "test_story_id/test_node_id.wav"
+    assert put["ContentType"] == "audio/wav"
+    mock_requests.assert_called_once_with(
+        "http://test-callback",
+        headers={"Authorization": "Bearer test-token"},
+        json="test_story_id/test_node_id.wav",
+        timeout=10,
+    )
+
+
+def test_generate_audio_batch(generator, mock_boto3, mock_requests):
+    """Test that every node of a story is narrated, uploaded and signalled"""
+    prompts = ["A much longer opening line.", "Short.", "A medium line."]
+    nodes = [
+        {
+            "prompt": prompt,
+            "story_id": "test_story_id",
+            "node_id": f"node_{i}",
+            "callback_url": "http://test-callback",
+            "callback_token": "test-token",
+        }
+        for i, prompt in enumerate(prompts)
+    ]
+
+    with patch('os.getenv', return_value="test-bucket"), \
+         patch.object(generate_audio, 'SYNTHESIS_BATCH_SIZE', 2):
+        result = generator.narrate_batch(nodes)
+
+    # Clips are synthesized shortest first in batches of similar length
+    assert batched_texts(generator) == [
+        ["Short.", "A medium line."], ["A much longer opening line."]
+    ]
+    generator.generate_fn.assert_not_called()
+
+    assert sorted(result["keys"]) == [
+        f"test_story_id/node_{i}.wav" for i in range(len(prompts))
+    ]
+    assert sorted(
+        call.kwargs["Key"] for call in mock_boto3.put_object.call_args_list
+    ) == sorted(result["keys"])
+    assert sorted(
+        call.kwargs["json"] for call in mock_requests.call_args_list
+    ) == sorted(result["keys"])
+
+
+def test_generate_audio_batch_upload_error(generator, mock_boto3, mock_requests):
+    """Test that a failed upload fails the batch"""
+    mock_boto3.put_object.side_effect = Exception("S3 unavailable")
+    node = {
+        "prompt": "Once upon a time.",
+        "story_id": "test_story_id",
+        "node_id": "test_node_id",
+        "callback_url": "http://test-callback",
+        "callback_token": "test-token",
+    }
+
+    with patch('os.getenv', return_value="test-bucket"):
+        with pytest.raises(Exception, match="S3 unavailable"):
+            generator.narrate_batch([node])
+
+    mock_requests.assert_not_called()
+
+
+def test_generate_audio_batch_truncates_tokens(generator, mock_boto3, mock_requests):
+    """Test that a batch never hands Kokoro more tokens than it reads"""
+    node = {"prompt": "a" * 600, "story_id": "test_story_id", "node_id": "node_0"}
+
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.narrate_batch([node])
+
+    assert [len(tokens) for tokens in generator.forward_batch.call_args.args[0]] == [510]
+
+
+def test_narration_reports_gpu_seconds(generator, mock_boto3, mock_requests):
+    """Test that each call reports the seconds it spent synthesizing"""
+    nodes = [
+        {"prompt": prompt, "story_id": "test_story_id", "node_id": f"node_{i}"}
+        for i, prompt in enumerate(["The end.", "Run away."])
+    ]
+
+    with patch('os.getenv', return_value="test-bucket"), \
+         patch.object(generate_audio.time, 'perf_counter', side_effect=[0.0, 1.5, 2.0, 2.25]):
+        single = generator.narrate(nodes[0])
+        batch = generator.narrate_batch(nodes[1:])
+        # A cache hit doesn't synthesize anything
+        cached = generator.narrate({**nodes[0], "node_id": "node_2"})
+
+    assert single == {"keys": ["test_story_id/node_0.wav"], "gpu_seconds": 1.5}
+    assert batch == {"keys": ["test_story_id/node_1.wav"], "gpu_seconds": 0.25}
+    assert cached == {"keys": ["test_story_id/node_2.wav"], "gpu_seconds": 0.0}
+
+
+@pytest.mark.parametrize("endpoint,method,body,spawned", [
+    ("generate_audio", "narrate", {"node_id": "node_1"}, {"node_id": "node_1"}),
+    ("generate_audio_batch", "narrate_batch", {"nodes": [{"node_id": "node_1"}]}, [{"node_id": "node_1"}]),
+])
+def test_endpoints_accept_jobs(endpoint, method, body, spawned):
+    """Test that the endpoints spawn the narration and answer with a 202 and its call id"""
+    fastapi = MagicMock()
+    with patch.dict('sys.modules', {'fastapi': fastapi}), \
+         patch.object(generate_audio, 'KokoroGenerator') as mock_generator:
+        spawn = getattr(mock_generator.return_value, method).spawn
+        spawn.return_value.object_id = "fc-123"
+        response = getattr(generate_audio, endpoint)(body)
+
+    spawn.assert_called_once_with(spawned)
+    fastapi.Response.assert_called_once_with(
+        content='{"call_id": "fc-123"}',
+        media_type="application/json",
+        status_code=202,
+    )
+    assert response == fastapi.Response.return_value
+
+
+def test_split_sentences():
+    """Test that narration is split on sentence boundaries"""
+    assert split_sentences(" The door opens. Who's there?  Nobody! ") == [
+        "The door opens.", "Who's there?", "Nobody!"
+    ]
+    assert split_sentences("No boundary here") == ["No boundary here"]
+
+
+def test_generate_audio_streaming(generator, mock_boto3, mock_requests):
+    """Test that a streamed node uploads partial audio before the full clip"""
+    from scipy.io import wavfile
+
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.narrate({
+            "prompt": "The door opens. A shadow moves. You run.",
+            "story_id": "test_story_id",
+            "node_id": "test_node_id",
+            "callback_url": "http://test-callback",
+            "callback_token": "test-token",
+            "stream": True,
+        })
+
+    assert [
+        call.args[1] for call in generator.generate_fn.call_args_list
+    ] == ["The door opens.", "A shadow moves.", "You run."]
+
+    puts = [call.kwargs for call in mock_boto3.put_object.call_args_list]
+    assert [put["Key"] for put in puts] == [
+        "test_story_id/partial/test_node_id.wav",
+        "test_story_id/partial/test_node_id.wav",
+        "test_story_id/test_node_id.wav",
+    ]
+    # Each upload holds the audio synthesized so far
+    lengths = [len(wavfile.read(io.BytesIO(put["Body"]))[1]) for put in puts]
+    assert lengths == [len(make_clip()) * n for n in (1, 2, 3)]
+
+    mock_boto3.delete_object.assert_called_once_with(
+        Bucket="test-bucket", Key="test_story_id/partial/test_node_id.wav"
+    )
+    mock_requests.assert_called_once_with(
+        "http://test-callback",
+        headers={"Authorization": "Bearer test-token"},
+        json="test_story_id/test_node_id.wav",
+        timeout=10,
+    )
+
+
+def test_generate_audio_streaming_single_sentence(generator, mock_boto3, mock_requests):
+    """Test that a single sentence is uploaded straight away without a partial"""
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.narrate({
+            "prompt": "Once upon a time.",
+            "story_id": "test_story_id",
+            "node_id": "test_node_id",
+            "stream": True,
+        })
+
+    mock_boto3.put_object.assert_called_once()
+    mock_boto3.delete_object.assert_not_called()
+    mock_requests.assert_not_called()
+
+
+def test_get_cache_key():
+    """Test that the cache key only depends on the normalized text and voice"""
+    key = get_cache_key("Once upon  a time.\n", "bm_lewis")
+
+    assert key.startswith("tts-cache/") and key.endswith(".wav")
+    assert key == get_cache_key(" Once upon a time. ", "bm_lewis")
+    assert key != get_cache_key("Once upon a time.", "af_bella")
+    assert key != get_cache_key("Once upon a time!", "bm_lewis")
+
+
+def test_generate_audio_cache(generator, mock_boto3, mock_requests):
+    """Test that repeated text is copied from the cache instead of synthesized"""
+    node = {
+        "prompt": "Once upon a time.",
+        "story_id": "test_story_id",
+        "callback_url": "http://test-callback",
+    }
+    cache_key = get_cache_key("Once upon a time.", "bm_lewis")
+
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.narrate({**node, "node_id": "first"})
+        generator.narrate({**node, "node_id": "second"})
+
+    generator.generate_fn.assert_called_once()
+    mock_boto3.put_object.assert_called_once()
+    mock_boto3.copy_object.assert_any_call(
+        Bucket="test-bucket",
+        CopySource={"Bucket": "test-bucket", "Key": "test_story_id/first.wav"},
+        Key=cache_key,
+    )
+    mock_boto3.copy_object.assert_called_with(
+        Bucket="test-bucket",
+        CopySource={"Bucket": "test-bucket", "Key": cache_key},
+        Key="test_story_id/second.wav",
+    )
+    assert [call.kwargs["json"] for call in mock_requests.call_args_list] == [
+        "test_story_id/first.wav",
+        "test_story_id/second.wav",
+    ]
+    assert generator.cache_stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_generate_audio_batch_cache(generator, mock_boto3, mock_requests):
+    """Test that the batch endpoint only synthesizes uncached text"""
+    nodes = [
+        {"prompt": prompt, "story_id": "test_story_id", "node_id": f"node_{i}"}
+        for i, prompt in enumerate(["The end.", "Run away.", "The end."])
+    ]
+
+    with patch('os.getenv', return_value="test-bucket"):
+        generator.narrate(nodes[0])
+        result = generator.narrate_batch(nodes)
+
+    assert [
+        call.args[1] for call in generator.generate_fn.call_args_list
+    ] == ["The end."]
+    assert batched_texts(generator) == [["Run away."]]
+    assert sorted(result["keys"]) == [
+        f"test_story_id/node_{i}.wav" for i in range(3)
+    ]
@@ -1,8 +1,11 @@
 import pytest
 from unittest.mock import MagicMock, patch, mock_open
+import io
 import json
 import uuid
+from datetime import datetime, timedelta
 from pathlib import Path
+from botocore.exceptions import ClientError
 
 
 # Mock the modal library since it's not available in the test environment
@@ -21,6 +24,11 @@ class MockModal:
             def decorator(cls):
                 return cls
             return decorator
+
+        def function(self, **kwargs):
+            def decorator(func):
+                return func
+            return decorator
             
         def web_endpoint(self, method=None):
             def decorator(func):
@@ -41,6 +49,10 @@ class MockModal:
         @staticmethod
         def from_name(name):
             return MockSecret(name)
+
+    class Period:
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
             
     @staticmethod
     def enter():
@@ -54,6 +66,12 @@ class MockModal:
             return func
         return decorator
 
+    @staticmethod
+    def web_endpoint(method=None, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
 
 class MockImage:
     def apt_install(self, *args):
@@ -87,7 +105,27 @@ with patch.dict('sys.modules', {'modal': MagicMock()}):
     sys.modules['modal'] = MockModal()
     
     # Now we can import our module
-    from images import ComfyUI
+    import images
+    from images import (
+        ComfyClient,
+        ComfyUI,
+        FluxTemplate,
+        ImageBatcher,
+        encode_variants,
+        get_default_seed,
+        get_image_cache_key,
+        get_image_version,
+        select_evictions,
+    )
+
+
+TEMPLATE = {
+    "5": {"inputs": {"width": 1024, "height": 1024, "batch_size": 1}, "class_type": "EmptyLatentImage"},
+    "6": {"inputs": {"text": "original prompt", "clip": ["11", 0]}, "class_type": "CLIPTextEncode"},
+    "9": {"inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}, "class_type": "SaveImage"},
+    "25": {"inputs": {"noise_seed": 100743429905359}, "class_type": "RandomNoise"},
+    "27": {"inputs": {"images": ["8", 0]}, "class_type": "PreviewImage"},
+}
 
 
 @pytest.fixture
@@ -103,22 +141,10 @@ def mock_subprocess():
 
 @pytest.fixture
 def mock_path():
-    with patch('pathlib.Path') as mock_path:
+    with patch.object(images, 'Path') as mock_path:
         mock_file = MagicMock()
-        mock_file.read_text.return_value = json.dumps({
-            "6": {"inputs": {"text": "original prompt"}},
-            "9": {"inputs": {"filename_prefix": "original_prefix"}}
-        })
-        mock_file.read_bytes.return_value = b"test_image_data"
-        mock_file.name = "test_file.png"
-        
+        mock_file.read_text.return_value = json.dumps(TEMPLATE)
         mock_path.return_value = mock_file
-        
-        # Mock the iterdir method to return a list with one file
-        mock_dir = MagicMock()
-        mock_dir.iterdir.return_value = [mock_file]
-        mock_path.side_effect = lambda p: mock_file if p.endswith(".json") else mock_dir
-        
         yield mock_path
 
 
@@ -126,11 +152,13 @@ def mock_path():
 def mock_boto3():
     with patch('boto3.client') as mock_client:
         mock_s3 = MagicMock()
+        # The image cache starts out empty
+        mock_s3.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
         mock_client.return_value = mock_s3
         yield mock_s3
 
 
-def test_launch_comfy_background(comfy_ui, mock_subprocess):
+def test_launch_comfy_background(comfy_ui, mock_subprocess, mock_path):
     """Test that the ComfyUI background process is launched correctly"""
     comfy_ui.launch_comfy_background()
     
@@ -140,65 +168,382 @@ def test_launch_comfy_background(comfy_ui, mock_subprocess):
         check=True
     )
 
+    # The workflow template is parsed once, up front
+    mock_path.assert_called_once_with("/root/flux.json")
+    assert comfy_ui.template.prompt_node == "6"
+    assert comfy_ui.template.latent_node == "5"
+    assert comfy_ui.template.noise_node == "25"
+    assert comfy_ui.template.save_node == "9"
+    assert "27" not in comfy_ui.template.workflow
 
-def test_infer(comfy_ui, mock_subprocess, mock_path):
-    """Test the inference method"""
-    result = comfy_ui.infer()
-    
-    # Check that the comfy run command was executed
-    mock_subprocess.assert_called_once_with(
-        "comfy run --workflow /root/flux.json --wait --timeout 1200", 
-        shell=True, 
-        check=True
-    )
-    
-    # Check that the file was read
-    mock_path.assert_any_call("/root/flux.json")
-    
-    # Check that the output directory was checked
-    mock_path.assert_any_call("/root/comfy/ComfyUI/output")
-    
-    # Check that the result is the file content
-    assert result == b"test_image_data"
 
+def test_infer(comfy_ui):
+    """Test that inference runs the graph on the server and returns the saved images"""
+    comfy_ui.comfy = MagicMock()
+    comfy_ui.comfy.run.return_value = [b"test_image_data"]
+    workflow = {
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "prompt"}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "prefix"}},
+    }
 
-def test_api(comfy_ui, mock_path, mock_boto3):
+    result = comfy_ui.infer(workflow)
+
+    comfy_ui.comfy.run.assert_called_once_with(workflow, "9")
+    assert result == [b"test_image_data"]
+
+
+@pytest.fixture
+def mock_websocket():
+    ws = MagicMock()
+    websocket = MagicMock()
+    websocket.create_connection.return_value = ws
+    with patch.dict("sys.modules", {"websocket": websocket}):
+        yield ws
+
+
+@pytest.fixture
+def mock_requests():
+    with patch("requests.post") as mock_post, patch("requests.get") as mock_get:
+        mock_post.return_value.json.return_value = {"prompt_id": "test_prompt"}
+        yield mock_post, mock_get
+
+
+def test_comfy_client_run(mock_websocket, mock_requests):
+    """Test that a prompt is queued, followed over the websocket and its image fetched"""
+    mock_post, mock_get = mock_requests
+    mock_websocket.recv.side_effect = [
+        b"preview bytes",
+        json.dumps({"type": "executing", "data": {"node": None, "prompt_id": "other_prompt"}}),
+        json.dumps({"type": "executing", "data": {"node": "9", "prompt_id": "test_prompt"}}),
+        json.dumps({"type": "executing", "data": {"node": None, "prompt_id": "test_prompt"}}),
+    ]
+    history = MagicMock()
+    history.json.return_value = {
+        "test_prompt": {
+            "outputs": {
+                "9": {"images": [{"filename": "out.png", "subfolder": "", "type": "output"}]}
+            }
+        }
+    }
+    image = MagicMock(content=b"test_image_data")
+    mock_get.side_effect = [history, image]
+
+    with patch.object(images, "Path") as mock_path:
+        result = ComfyClient(output_dir="/output").run({"9": {}}, "9")
+
+    assert result == [b"test_image_data"]
+    # The output is deleted once it's been fetched
+    mock_path.assert_called_once_with("/output", "", "out.png")
+    mock_path.return_value.unlink.assert_called_once_with(missing_ok=True)
+    assert mock_post.call_args.kwargs["json"]["prompt"] == {"9": {}}
+    mock_get.assert_any_call("http://127.0.0.1:8188/history/test_prompt", timeout=30)
+    assert mock_get.call_args.kwargs["params"]["filename"] == "out.png"
+    mock_websocket.close.assert_called_once()
+
+
+def test_comfy_client_execution_error(mock_websocket, mock_requests):
+    """Test that an execution error on the server is raised"""
+    mock_websocket.recv.side_effect = [
+        json.dumps({
+            "type": "execution_error",
+            "data": {"prompt_id": "test_prompt", "exception_message": "Out of memory"},
+        }),
+    ]
+
+    with pytest.raises(RuntimeError, match="Out of memory"):
+        ComfyClient().run({"9": {}}, "9")
+
+    mock_websocket.close.assert_called_once()
+
+
+def test_api(comfy_ui, mock_boto3):
     """Test the API endpoint"""
     # Mock uuid.uuid4
     with patch('uuid.uuid4') as mock_uuid:
         mock_uuid.return_value.hex = "test_uuid"
         
-        # Mock open
-        with patch('builtins.open', mock_open()) as mock_file:
-            # Mock os.getenv
-            with patch('os.getenv') as mock_getenv:
-                mock_getenv.return_value = "test-bucket"
-                
-                # Mock the infer method
-                comfy_ui.infer = MagicMock(return_value=b"test_image_data")
-                
-                # Call the API
-                comfy_ui.api({
-                    "prompt": "test prompt",
-                    "story_id": "test_story_id",
-                    "node_id": "test_node_id"
-                })
-                
-                # Check that the workflow was loaded
-                mock_path.assert_any_call("/root/flux.json")
-                
-                # Check that the prompt was updated in the workflow
-                assert mock_path().read_text.called
-                
-                # Check that the new workflow was saved
-                assert mock_file.called
-                
-                # Check that infer was called with the new workflow
-                comfy_ui.infer.assert_called_once_with("test_uuid.json")
-                
-                # Check that the result was uploaded to S3
-                mock_boto3.put_object.assert_called_once_with(
-                    Bucket="test-bucket",
-                    Key="test_story_id/test_node_id.png",
-                    Body=b"test_image_data"
-                )
\ No newline at end of file
+        # Mock os.getenv
+        with patch('os.getenv') as mock_getenv:
+            mock_getenv.return_value = "test-bucket"
+            
+            # Mock the infer method
+            comfy_ui.infer = MagicMock()
+            png = make_png()
+            comfy_ui.infer.local.return_value = [png]
+            comfy_ui.template = FluxTemplate.from_workflow(TEMPLATE)
+            comfy_ui.batcher = ImageBatcher(comfy_ui.render_batch, window_seconds=0)
+            
+            # Call the API
+            comfy_ui.generate({
+                "prompt": "test prompt",
+                "story_id": "test_story_id",
+                "node_id": "test_node_id"
+            })
+            
+            # Check that infer was called with the prompt batched into the workflow
+            workflow = comfy_ui.infer.local.call_args[0][0]
+            assert workflow["6"]["class_type"] == "BatchCLIPTextEncode"
+            assert json.loads(workflow["6"]["inputs"]["prompts"]) == ["test prompt"]
+            assert json.loads(workflow["25"]["inputs"]["seeds"]) == [get_default_seed("test prompt")]
+            assert workflow["5"]["inputs"]["batch_size"] == 1
+            assert workflow["9"]["inputs"]["filename_prefix"] == "test_uuid"
+            
+            # Check that the compressed variants and then the original were uploaded to S3
+            version = get_image_version("test prompt")
+            uploads = mock_boto3.put_object.call_args_list
+            assert [call.kwargs["Key"] for call in uploads] == [
+                f"test_story_id/test_node_id.{version}.webp",
+                f"test_story_id/test_node_id.{version}.thumb.webp",
+                "test_story_id/test_node_id.png",
+            ]
+            # The versioned variants are immutable, the PNG's key is reused
+            assert [call.kwargs["CacheControl"] for call in uploads] == [
+                "public, max-age=31536000, immutable",
+                "public, max-age=31536000, immutable",
+                "public, max-age=3600",
+            ]
+            mock_boto3.put_object.assert_called_with(
+                Bucket="test-bucket",
+                Key="test_story_id/test_node_id.png",
+                Body=png,
+                ContentType="image/png",
+                CacheControl="public, max-age=3600",
+            )
+
+            # Every variant is then copied into the image cache, PNG last
+            cache_key = get_image_cache_key(
+                "test prompt",
+                get_default_seed("test prompt"),
+                comfy_ui.template.version,
+                "1024x1024",
+            )
+            copies = mock_boto3.copy_object.call_args_list
+            assert [call.kwargs["Key"] for call in copies] == [
+                f"{cache_key}.webp",
+                f"{cache_key}.thumb.webp",
+                f"{cache_key}.png",
+            ]
+            assert copies[-1].kwargs["Metadata"] == {"variants": "webp,thumb.webp"}
+
+
+def test_api_accepts_jobs():
+    """Test that the endpoint spawns the render and answers with a 202 straight away"""
+    node = {
+        "prompt": "test prompt",
+        "story_id": "test_story_id",
+        "node_id": "test_node_id",
+        "callback_token": "test-token",
+    }
+    fastapi = MagicMock()
+
+    with patch.dict('sys.modules', {'fastapi': fastapi}), \
+         patch.object(images, 'ComfyUI') as mock_comfy_ui, \
+         patch('builtins.print') as mock_print:
+        response = images.api(node)
+
+    mock_comfy_ui.return_value.generate.spawn.assert_called_once_with(node)
+    fastapi.Response.assert_called_once_with(status_code=202)
+    assert response == fastapi.Response.return_value
+    assert "test-token" not in str(mock_print.call_args_list)
+
+
+def make_png(size=(512, 512)):
+    from PIL import Image
+
+    body = io.BytesIO()
+    Image.new("RGB", size, (200, 80, 40)).save(body, format="PNG")
+    return body.getvalue()
+
+
+def test_encode_variants():
+    """Test that a compressed full size image and thumbnail are encoded"""
+    from PIL import Image
+
+    png = make_png()
+    variants = encode_variants(png, image_format="webp", quality=80, thumbnail_size=128)
+
+    assert [variant.suffix for variant in variants] == ["webp", "thumb.webp", "png"]
+    assert [variant.content_type for variant in variants] == ["image/webp", "image/webp", "image/png"]
+    assert variants[-1].body == png
+
+    full = Image.open(io.BytesIO(variants[0].body))
+    thumbnail = Image.open(io.BytesIO(variants[1].body))
+    assert full.format == "WEBP" and full.size == (512, 512)
+    assert thumbnail.size == (128, 128)
+    assert len(variants[1].body) < len(variants[0].body) < len(png)
+
+
+def test_flux_template_build():
+    """Test that the batch workflow encodes every prompt and sizes the latent to match"""
+    template = FluxTemplate.from_workflow(TEMPLATE)
+
+    workflow = template.build(["first", "second"], [1, 2], "prefix")
+
+    assert workflow["6"]["class_type"] == "BatchCLIPTextEncode"
+    assert json.loads(workflow["6"]["inputs"]["prompts"]) == ["first", "second"]
+    assert workflow["6"]["inputs"]["clip"] == ["11", 0]
+    assert workflow["5"]["inputs"]["batch_size"] == 2
+    assert workflow["25"]["class_type"] == "BatchRandomNoise"
+    assert json.loads(workflow["25"]["inputs"]["seeds"]) == [1, 2]
+    assert workflow["9"]["inputs"]["filename_prefix"] == "prefix"
+    # The template itself is left untouched
+    assert TEMPLATE["5"]["inputs"]["batch_size"] == 1
+    assert TEMPLATE["6"]["class_type"] == "CLIPTextEncode"
+    assert TEMPLATE["9"]["inputs"]["filename_prefix"] == "ComfyUI"
+    assert TEMPLATE["25"]["class_type"] == "RandomNoise"
+
+
+def test_image_batcher_fans_out_batches():
+    """Test that concurrent prompts are rendered together and each caller gets its own image"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    batches = []
+
+    def render(prompts, seeds):
+        batches.append(prompts)
+        return [f"image for {prompt} {seed}".encode() for prompt, seed in zip(prompts, seeds)]
+
+    batcher = ImageBatcher(render, max_batch_size=3, window_seconds=0.5)
+    prompts = [f"prompt {i}" for i in range(5)]
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(batcher.submit, prompts, range(5)))
+
+    assert [result.image for result in results] == [
+        f"image for {p} {seed}".encode() for seed, p in enumerate(prompts)
+    ]
+    assert sorted(len(batch) for batch in batches) == [2, 3]
+    assert all(result.gpu_seconds <= result.latency for result in results)
+
+
+def test_image_batcher_propagates_errors():
+    """Test that a failed batch fails every request in it"""
+    def render(prompts, seeds):
+        raise RuntimeError("Out of memory")
+
+    batcher = ImageBatcher(render, window_seconds=0)
+
+    with pytest.raises(RuntimeError, match="Out of memory"):
+        batcher.submit("prompt", 1)
+
+
+def test_image_batcher_fails_short_batches():
+    """Test that a batch missing images fails its requests instead of leaving them waiting"""
+    def render(prompts, seeds):
+        return [b"image"] * (len(prompts) - 1)
+
+    batcher = ImageBatcher(render, window_seconds=0, timeout=5)
+
+    with pytest.raises(RuntimeError, match="Rendered 0 images for a batch of 1"):
+        batcher.submit("prompt", 1)
+
+
+def test_image_batcher_times_out():
+    """Test that a request gives up once its batch takes longer than the timeout"""
+    from concurrent.futures import TimeoutError
+    import threading
+
+    release = threading.Event()
+
+    def render(prompts, seeds):
+        release.wait(5)
+        return [b"image"] * len(prompts)
+
+    batcher = ImageBatcher(render, window_seconds=0, timeout=0.1)
+
+    with pytest.raises(TimeoutError):
+        batcher.submit("prompt", 1)
+    release.set()
+
+
+def test_api_cache_hit(comfy_ui, mock_boto3):
+    """Test that a cached prompt and seed is copied over instead of rendered"""
+    mock_boto3.head_object.side_effect = None
+    mock_boto3.head_object.return_value = {"Metadata": {"variants": "webp,thumb.webp"}}
+    comfy_ui.template = FluxTemplate.from_workflow(TEMPLATE)
+    comfy_ui.batcher = MagicMock()
+    cache_key = get_image_cache_key("test prompt", 42, comfy_ui.template.version, "1024x1024")
+
+    with patch('os.getenv', return_value="test-bucket"), patch('requests.post') as mock_post:
+        comfy_ui.generate({
+            "prompt": "test prompt",
+            "seed": 42,
+            "story_id": "test_story_id",
+            "node_id": "test_node_id",
+            "callback_url": "http://test-callback",
+        })
+
+    comfy_ui.batcher.submit.assert_not_called()
+    mock_boto3.put_object.assert_not_called()
+    mock_boto3.head_object.assert_called_once_with(Bucket="test-bucket", Key=f"{cache_key}.png")
+    copies = [
+        (call.kwargs["CopySource"]["Key"], call.kwargs["Key"])
+        for call in mock_boto3.copy_object.call_args_list
+    ]
+    version = get_image_version("test prompt")
+    assert copies == [
+        (f"{cache_key}.webp", f"test_story_id/test_node_id.{version}.webp"),
+        (f"{cache_key}.thumb.webp", f"test_story_id/test_node_id.{version}.thumb.webp"),
+        (f"{cache_key}.png", "test_story_id/test_node_id.png"),
+        # The entry is touched so eviction sees it as recently used
+        (f"{cache_key}.png", f"{cache_key}.png"),
+    ]
+    assert mock_post.call_args.kwargs["json"] == "test_story_id/test_node_id.png"
+    node_copies = mock_boto3.copy_object.call_args_list[:3]
+    assert [call.kwargs["ContentType"] for call in node_copies] == [
+        "image/webp", "image/webp", "image/png"
+    ]
+    assert [call.kwargs["CacheControl"] for call in node_copies] == [
+        "public, max-age=31536000, immutable",
+        "public, max-age=31536000, immutable",
+        "public, max-age=3600",
+    ]
+
+
+def test_image_version():
+    """Test the prompt version in variant keys, which the frontend computes the same way"""
+    assert get_image_version("") == "811c9dc5"
+    assert get_image_version("a") == "e40c292c"
+    assert get_image_version("test prompt") == get_image_version("test prompt")
+    assert get_image_version("test prompt") != get_image_version("other prompt")
+    assert len(get_image_version("A café at dusk")) == 8
+
+
+def test_image_cache_key():
+    """Test that the cache key changes with the prompt, seed, workflow and resolution"""
+    key = get_image_cache_key("prompt", 1, "v1", "1024x1024")
+
+    assert key.startswith("image-cache/")
+    assert key == get_image_cache_key("prompt", 1, "v1", "1024x1024")
+    assert len({
+        key,
+        get_image_cache_key("other prompt", 1, "v1", "1024x1024"),
+        get_image_cache_key("prompt", 2, "v1", "1024x1024"),
+        get_image_cache_key("prompt", 1, "v2", "1024x1024"),
+        get_image_cache_key("prompt", 1, "v1", "512x512"),
+    }) == 5
+    assert get_default_seed("prompt") == get_default_seed("prompt")
+
+
+def test_select_evictions():
+    """Test that the least recently used entries are evicted until the cache fits"""
+    now = datetime(2025, 1, 1)
+
+    def entry(name, age, size):
+        return [
+            {"Key": f"image-cache/{name}.webp", "Size": size // 2, "LastModified": now - timedelta(hours=age)},
+            {"Key": f"image-cache/{name}.png", "Size": size // 2, "LastModified": now - timedelta(hours=age)},
+        ]
+
+    objects = entry("old", 3, 100) + entry("recent", 1, 100) + entry("oldest", 5, 100)
+
+    assert select_evictions(objects, max_bytes=300) == []
+    assert sorted(select_evictions(objects, max_bytes=150)) == [
+        "image-cache/old.png",
+        "image-cache/old.webp",
+        "image-cache/oldest.png",
+        "image-cache/oldest.webp",
+    ]
+    assert sorted(select_evictions(objects, max_bytes=250)) == [
+        "image-cache/oldest.png",
+        "image-cache/oldest.webp",
+    ]
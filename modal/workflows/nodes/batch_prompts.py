@@ -0,0 +1,101 @@
+"""
+ComfyUI custom nodes that encode several prompts into a single conditioning
+batch and seed each image of the batch separately. Paired with an
+EmptyLatentImage of the same batch size, every image in the batch is sampled
+from its own prompt and seed in one pass through the model. Every prompt's T5
+tokens are padded to the same fixed length before encoding, so an image
+doesn't depend on what else it happened to be batched with.
+"""
+
+import json
+
+import comfy.sample
+import torch
+
+# Flux reads up to 512 T5 tokens, which the reference pipeline pads every
+# prompt to. CLIP only contributes its pooled output, so its tokens are left
+# as they are.
+PADDED_TOKENS = {"t5xxl": 512}
+
+
+def pad_tokens(tokens: dict, empty: dict, lengths: dict = PADDED_TOKENS) -> dict:
+    """
+    Pad each encoder's tokens to its fixed length with the entry its tokenizer
+    pads with, taken from the end of the empty prompt, keeping the end token
+    of a prompt that has to be cut short
+    """
+    padded = dict(tokens)
+    for name, length in lengths.items():
+        if name not in tokens:
+            continue
+        (sequence,) = tokens[name]
+        if len(sequence) > length:
+            sequence = sequence[: length - 1] + sequence[-1:]
+        pad = empty[name][-1][-1]
+        padded[name] = [sequence + [pad] * (length - len(sequence))]
+    return padded
+
+
+class BatchCLIPTextEncode:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "prompts": ("STRING", {"multiline": True}),
+                "clip": ("CLIP",),
+            }
+        }
+
+    RETURN_TYPES = ("CONDITIONING",)
+    FUNCTION = "encode"
+    CATEGORY = "conditioning"
+
+    def encode(self, clip, prompts: str):
+        empty = clip.tokenize("")
+        conds, pooled = [], []
+        for prompt in json.loads(prompts):
+            cond, pooled_output = clip.encode_from_tokens(
+                pad_tokens(clip.tokenize(prompt), empty), return_pooled=True
+            )
+            conds.append(cond)
+            pooled.append(pooled_output)
+
+        return ([[torch.cat(conds), {"pooled_output": torch.cat(pooled)}]],)
+
+
+class Noise_BatchSeeds:
+    def __init__(self, seeds: list[int]):
+        self.seeds = seeds
+        self.seed = seeds[0]
+
+    def generate_noise(self, input_latent):
+        latent = input_latent["samples"]
+        return torch.cat(
+            [
+                comfy.sample.prepare_noise(latent[i : i + 1], seed)
+                for i, seed in enumerate(self.seeds)
+            ]
+        )
+
+
+class BatchRandomNoise:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"seeds": ("STRING", {"multiline": True})}}
+
+    RETURN_TYPES = ("NOISE",)
+    FUNCTION = "get_noise"
+    CATEGORY = "sampling/custom_sampling/noise"
+
+    def get_noise(self, seeds: str):
+        return (Noise_BatchSeeds(json.loads(seeds)),)
+
+
+NODE_CLASS_MAPPINGS = {
+    "BatchCLIPTextEncode": BatchCLIPTextEncode,
+    "BatchRandomNoise": BatchRandomNoise,
+}
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "BatchCLIPTextEncode": "CLIP Text Encode (Batch)",
+    "BatchRandomNoise": "Random Noise (Batch)",
+}
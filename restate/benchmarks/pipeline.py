@@ -0,0 +1,651 @@
+"""
+Runs whole story workflows offline and reports their throughput.
+
+The real `run` workflow is driven by a local stand-in for the Restate
+context against local fakes of everything it talks to: Gemini with a
+configurable latency and token rate, the image and TTS endpoints served over
+HTTP and writing into an in-memory bucket, and a sqlite file in place of
+libsql. Run it from the restate directory:
+
+    python benchmarks/pipeline.py --stories 10 --save benchmarks/baseline.json
+    python benchmarks/pipeline.py --stories 10 --baseline benchmarks/baseline.json
+
+With a baseline it exits with an error when throughput, a stage's p95
+latency or a request count regresses by more than the threshold.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass, fields
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from aiohttp import web
+from botocore.exceptions import ClientError
+from restate.serde import DefaultSerde
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS stories (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        title TEXT,
+        description TEXT,
+        timestamp INTEGER NOT NULL,
+        public INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'PROCESSING',
+        error_message TEXT,
+        image_prompt TEXT NOT NULL,
+        story_prompt TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS story_choices (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        story_id TEXT NOT NULL,
+        parent_id TEXT,
+        description TEXT NOT NULL,
+        choice_title TEXT NOT NULL,
+        choice_description TEXT NOT NULL,
+        image_prompt TEXT NOT NULL,
+        is_terminal INTEGER NOT NULL DEFAULT 0,
+        explored INTEGER NOT NULL DEFAULT 0
+    )""",
+]
+
+PROMPTS = [
+    "A retired smuggler is pulled back in for one last run through an asteroid field",
+    "A young witch has to pass her final exam before the full moon rises",
+    "A detective in a floating city investigates the disappearance of the sky lanterns",
+    "A knight who is afraid of the dark must guard a cursed mine for one night",
+]
+
+SENTENCE = "The lantern light flickers across the cavern walls as the echoes fade away."
+
+# Below this a p95 increase is treated as timer noise rather than a regression
+MIN_REGRESSION_MS = 5
+
+
+@dataclass
+class BenchmarkOptions:
+    stories: int = 10
+    concurrency: int = 0
+    batch_levels: bool = False
+    max_depth: int = 3
+    branching: int = 2
+    # Levels generated before the story is playable, 0 generates the whole tree
+    lookahead: int = 0
+    llm_latency: float = 0.2
+    llm_tokens_per_second: float = 200
+    llm_capacity: int = 0
+    image_seconds: float = 1.0
+    audio_seconds: float = 0.5
+    # Send each level's narration to the TTS batch endpoint in one request
+    tts_batch: bool = False
+    # GPU time every media request pays on top of its assets, like scheduling
+    # an input on a container
+    media_request_seconds: float = 0.0
+    gpus: int = 4
+    media_error_rate: float = 0.0
+    s3_latency: float = 0.01
+    sleep_scale: float = 0.1
+    seed: int = 0
+
+
+# Gemini rejects cached content shorter than this
+CACHE_MIN_TOKENS = 32768
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def get_fake_response(response_model, context: dict | None) -> dict:
+    """A plausibly sized response for each of the models we ask Gemini for"""
+    context = context or {}
+
+    def node(remaining_turns: int) -> dict:
+        return {
+            "title": "The Lantern Cavern",
+            "story_description": " ".join([SENTENCE] * 4),
+            "banner_image_description": "A glowing cavern, pixel art style, amber and teal hues.",
+            "user_choices": []
+            if remaining_turns == 0
+            else [
+                {
+                    "choice_title": f"Follow tunnel {index + 1}",
+                    "choice_description": " ".join([SENTENCE] * 2),
+                }
+                for index in range(context.get("choices", 2))
+            ],
+        }
+
+    name = response_model.__name__
+    if name == "StoryOutline":
+        return {
+            "title": "The Last Lantern",
+            "description": " ".join([SENTENCE] * 4),
+            "melody": "A slow chiptune melody in a minor key",
+            "banner_image": "A lone explorer at a cavern mouth, pixel art style, amber hues.",
+        }
+    if name == "StoryLevel":
+        return {
+            "branches": [
+                {"path": path, **node(context["remaining_turns"])}
+                for path in context["paths"]
+            ]
+        }
+    return node(context["remaining_turns"])
+
+
+class FakeCache:
+    def __init__(self, model: str, tokens: int):
+        self.name = f"cachedContents/{uuid.uuid4().hex}"
+        self.model = model
+        self.usage_metadata = SimpleNamespace(total_token_count=tokens)
+
+    def delete(self):
+        pass
+
+
+class FakeModel:
+    def __init__(self, model_name: str, cache: FakeCache | None = None):
+        self.model_name = model_name
+        self.cache = cache
+
+    @classmethod
+    def from_cached_content(cls, cache: FakeCache) -> "FakeModel":
+        return cls(cache.model, cache)
+
+
+class QuotaExceeded(Exception):
+    code = 429
+
+
+class FakeGemini:
+    """
+    Stands in for Gemini behind instructor. Every call waits for a time to
+    first token plus its output at a fixed token rate, and responses are
+    validated against the response model like real ones. With a `capacity`,
+    calls beyond that many in flight are answered with a 429.
+    """
+
+    def __init__(self, latency: float, tokens_per_second: float, capacity: int = 0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.capacity = capacity
+        self.requests = 0
+        self.throttled = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.caches: dict[str, FakeCache] = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        # Just enough of google.generativeai for the story helpers
+        self.genai = SimpleNamespace(
+            configure=lambda **kwargs: None,
+            GenerativeModel=FakeModel,
+            caching=SimpleNamespace(
+                CachedContent=SimpleNamespace(
+                    create=self.create_cache, get=self.caches.__getitem__
+                )
+            ),
+        )
+
+    def create_cache(self, model: str, system_instruction: str, ttl=None) -> FakeCache:
+        tokens = count_tokens(system_instruction)
+        if tokens < CACHE_MIN_TOKENS:
+            raise ValueError(
+                f"Cached content is too small. total_token_count={tokens}, "
+                f"min_total_token_count={CACHE_MIN_TOKENS}"
+            )
+        cache = FakeCache(model, tokens)
+        self.caches[cache.name] = cache
+        return cache
+
+    def from_gemini(self, model: FakeModel, use_async: bool = False, **kwargs):
+        hooks = defaultdict(list)
+
+        async def create(response_model, messages, context=None, **kwargs):
+            for hook in hooks["completion:kwargs"]:
+                hook(messages=messages)
+            self.requests += 1
+            if self.capacity and self.in_flight >= self.capacity:
+                self.throttled += 1
+                await asyncio.sleep(self.latency)
+                raise QuotaExceeded("Resource has been exhausted")
+
+            response = get_fake_response(response_model, context)
+            output_tokens = count_tokens(json.dumps(response))
+            self.input_tokens += sum(count_tokens(m["content"]) for m in messages)
+            self.output_tokens += output_tokens
+            if model.cache is not None:
+                self.cached_tokens += model.cache.usage_metadata.total_token_count
+
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self.latency + output_tokens / self.tokens_per_second)
+            finally:
+                self.in_flight -= 1
+            return response_model.model_validate(response, context=context)
+
+        return SimpleNamespace(
+            on=lambda event, handler: hooks[event].append(handler),
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+        )
+
+
+class LocalBucket:
+    """
+    An in-memory stand-in for our S3 bucket, with the client calls the
+    workflow makes. Each call takes `latency` seconds.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.objects: dict[str, bytes] = {}
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    def _request(self, operation: str):
+        with self._lock:
+            self.requests[operation] += 1
+        time.sleep(self.latency)
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes = b"", **kwargs):
+        self._request("put_object")
+        with self._lock:
+            self.objects[Key] = Body
+
+    def head_object(self, Bucket: str, Key: str):
+        self._request("head_object")
+        with self._lock:
+            if Key not in self.objects:
+                raise ClientError(
+                    {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+                )
+            return {"ContentLength": len(self.objects[Key])}
+
+    def copy_object(self, Bucket: str, CopySource: dict, Key: str, **kwargs):
+        self._request("copy_object")
+        with self._lock:
+            self.objects[Key] = self.objects[CopySource["Key"]]
+
+    def get_paginator(self, operation: str):
+        def paginate(Bucket: str, Prefix: str = ""):
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+            for start in range(0, max(len(keys), 1), 1000):
+                self._request("list_objects_v2")
+                yield {"Contents": [{"Key": key} for key in keys[start : start + 1000]]}
+
+        return SimpleNamespace(paginate=paginate)
+
+
+class MediaServer:
+    """
+    Local image and TTS endpoints. Like our Modal services they answer with a
+    202 once a job is accepted and write the asset to the bucket in the
+    background, with `gpus` jobs of each kind rendering at a time.
+    """
+
+    def __init__(self, bucket: LocalBucket, options: BenchmarkOptions):
+        self.bucket = bucket
+        self.seconds = {"images": options.image_seconds, "audio": options.audio_seconds}
+        self.request_seconds = options.media_request_seconds
+        self.error_rate = options.media_error_rate
+        self.gpus = options.gpus
+        self.random = random.Random(options.seed)
+        self.requests = Counter()
+        self.rejected = Counter()
+        self.workers: dict[str, asyncio.Semaphore] = {}
+        self.jobs: set[asyncio.Task] = set()
+        self.runner = None
+        self.endpoint = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        kind = request.match_info["kind"]
+        return await self.accept(kind, kind, [await request.json()])
+
+    async def handle_batch(self, request: web.Request) -> web.Response:
+        """Kokoro's batch endpoint, which narrates a list of nodes back to back"""
+        return await self.accept("audio.batch", "audio", (await request.json())["nodes"])
+
+    async def accept(self, name: str, kind: str, jobs: list[dict]) -> web.Response:
+        self.requests[name] += 1
+        if self.random.random() < self.error_rate:
+            self.rejected[name] += 1
+            return web.Response(status=503, text="busy")
+
+        task = asyncio.create_task(self.render(kind, jobs))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+        return web.Response(status=202, text="accepted")
+
+    async def render(self, kind: str, jobs: list[dict]):
+        from helpers.s3 import BUCKET, get_asset_key
+
+        async with self.workers[kind]:
+            await asyncio.sleep(self.request_seconds)
+            for job in jobs:
+                await asyncio.sleep(self.seconds[kind])
+                await asyncio.to_thread(
+                    self.bucket.put_object,
+                    Bucket=BUCKET,
+                    Key=get_asset_key(job["story_id"], job["node_id"], kind),
+                    Body=b"",
+                )
+
+    async def start(self) -> str:
+        self.workers = {kind: asyncio.Semaphore(self.gpus) for kind in self.seconds}
+        app = web.Application()
+        app.router.add_post("/audio/batch", self.handle_batch)
+        app.router.add_post("/{kind}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoint = f"http://127.0.0.1:{port}"
+        return self.endpoint
+
+    async def stop(self):
+        for task in self.jobs:
+            task.cancel()
+        await asyncio.gather(*self.jobs, return_exceptions=True)
+        await self.runner.cleanup()
+
+
+class LocalContext:
+    """
+    Enough of a Restate WorkflowContext to run the workflow in process. Step
+    results go through their serde like a journal entry would, and durable
+    sleeps are scaled by `sleep_scale` so polling doesn't dominate a run.
+    """
+
+    def __init__(self, key: str, sleep_scale: float):
+        self._key = key
+        self.sleep_scale = sleep_scale
+        self.state = {}
+        self.object_calls = []
+
+    def key(self) -> str:
+        return self._key
+
+    def set(self, name: str, value):
+        self.state[name] = value
+
+    async def run(self, name: str, action, serde=DefaultSerde(), **kwargs):
+        result = action()
+        if asyncio.iscoroutine(result):
+            result = await result
+        return serde.deserialize(serde.serialize(result))
+
+    async def object_call(self, handler, key: str, arg):
+        # Expansions are driven by players, so we only record the tree
+        self.object_calls.append((handler.__name__, key, arg))
+
+    def sleep(self, delta: timedelta, name: str | None = None):
+        return asyncio.sleep(delta.total_seconds() * self.sleep_scale)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(durations: list[float]) -> dict:
+    return {
+        "count": len(durations),
+        "p50_ms": round(percentile(durations, 50), 2),
+        "p95_ms": round(percentile(durations, 95), 2),
+        "p99_ms": round(percentile(durations, 99), 2),
+    }
+
+
+async def run_stories(options: BenchmarkOptions, spans: list) -> dict:
+    from helpers.db import AsyncDatabaseClient
+    from helpers.dispatch import get_dispatcher
+    from helpers.env import get_env
+    from helpers.llm import get_gateway
+    from helpers.story import get_async_client
+    from main import StoryInput, run
+
+    def reset():
+        """Drop the clients cached by a previous run or configuration"""
+        for cached in (get_env, get_dispatcher, get_gateway, get_async_client):
+            cached.cache_clear()
+        AsyncDatabaseClient._instance = None
+        AsyncDatabaseClient._pool = None
+
+    llm = FakeGemini(
+        options.llm_latency, options.llm_tokens_per_second, options.llm_capacity
+    )
+    bucket = LocalBucket(options.s3_latency)
+    media = MediaServer(bucket, options)
+    endpoint = await media.start()
+
+    with tempfile.TemporaryDirectory() as tmp, patch.dict(
+        os.environ,
+        {
+            "GOOGLE_API_KEY": "benchmark",
+            "DB_URL": f"file:{tmp}/benchmark.db",
+            "DB_TOKEN": "",
+            "IMAGE_ENDPOINT": f"{endpoint}/images",
+            "KOKORO_ENDPOINT": f"{endpoint}/audio",
+            "KOKORO_BATCH_ENDPOINT": f"{endpoint}/audio/batch" if options.tts_batch else "",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_REGION": "us-east-1",
+            "MEDIA_COMPLETION_MODE": "poll",
+            "STORY_BATCH_LEVELS": str(options.batch_levels),
+            "STORY_CACHE": "False",
+            "TRACE_EXPORTER": "none",
+        },
+    ), patch("helpers.story.genai", llm.genai), patch(
+        "helpers.prompts.genai", llm.genai
+    ), patch("helpers.story.instructor.from_gemini", llm.from_gemini), patch(
+        "helpers.s3.get_s3_client", return_value=bucket
+    ), patch("helpers.tracing.export", side_effect=spans.extend):
+        reset()
+
+        db = AsyncDatabaseClient()
+        for statement in SCHEMA:
+            await db.execute(lambda conn: conn.execute(statement))
+
+        limit = asyncio.Semaphore(options.concurrency or options.stories)
+        latencies, failures = [], []
+
+        async def story(index: int):
+            ctx = LocalContext(str(uuid.uuid4()), options.sleep_scale)
+            req = StoryInput(
+                prompt=PROMPTS[index % len(PROMPTS)],
+                user_email=f"benchmark-{index}@example.com",
+                max_depth=options.max_depth,
+                branching=options.branching,
+                lookahead=options.lookahead or None,
+            )
+            async with limit:
+                start = time.perf_counter()
+                try:
+                    await run(ctx, req)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                except Exception as e:
+                    failures.append(repr(e))
+
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*[story(i) for i in range(options.stories)])
+        finally:
+            elapsed = time.perf_counter() - start
+            for kind in ("images", "audio"):
+                session = get_dispatcher(kind)._session
+                if session is not None:
+                    await session.close()
+            await db._pool.close()
+            await media.stop()
+            reset()
+
+    requests = {
+        "llm": llm.requests,
+        "llm.throttled": llm.throttled,
+        "llm.input_tokens": llm.input_tokens,
+        "llm.cached_tokens": llm.cached_tokens,
+        "llm.output_tokens": llm.output_tokens,
+        "llm.peak_in_flight": llm.peak_in_flight,
+        **{f"media.{kind}": count for kind, count in media.requests.items()},
+        **{f"media.{kind}.rejected": count for kind, count in media.rejected.items()},
+        **{f"s3.{operation}": count for operation, count in bucket.requests.items()},
+        "db": sum(1 for s in spans if s.name.startswith("db.")),
+    }
+
+    return {
+        "options": asdict(options),
+        "stories": options.stories,
+        "completed": len(latencies),
+        "failed": len(failures),
+        "failures": failures[:5],
+        "elapsed_seconds": round(elapsed, 3),
+        "stories_per_minute": round(len(latencies) / elapsed * 60, 2),
+        "story_latency": summarize(latencies) if latencies else {},
+        "requests": requests,
+    }
+
+
+def get_stage_latencies(spans: list) -> dict[str, dict]:
+    durations = defaultdict(list)
+    for s in spans:
+        if s.name != "cyoa":
+            durations[s.name].append(s.duration_ms)
+    return {name: summarize(values) for name, values in sorted(durations.items())}
+
+
+def run_benchmark(options: BenchmarkOptions, verbose: bool = False) -> dict:
+    spans = []
+    # The workflow prints as it goes, which would bury the report
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        results = asyncio.run(run_stories(options, spans))
+    results["stages"] = get_stage_latencies(spans)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Every metric that got worse than the baseline by more than `threshold`"""
+    regressions = []
+
+    if results["failed"] > baseline["failed"]:
+        regressions.append(
+            f"{results['failed']} stories failed, baseline had {baseline['failed']}"
+        )
+
+    floor = baseline["stories_per_minute"] * (1 - threshold)
+    if results["stories_per_minute"] < floor:
+        regressions.append(
+            f"throughput {results['stories_per_minute']} stories/min, "
+            f"baseline {baseline['stories_per_minute']}"
+        )
+
+    for name, stage in baseline["stages"].items():
+        current = results["stages"].get(name)
+        if current is None:
+            continue
+        if (
+            current["p95_ms"] > stage["p95_ms"] * (1 + threshold)
+            and current["p95_ms"] - stage["p95_ms"] > MIN_REGRESSION_MS
+        ):
+            regressions.append(
+                f"{name} p95 {current['p95_ms']}ms, baseline {stage['p95_ms']}ms"
+            )
+
+    for name, count in baseline["requests"].items():
+        current = results["requests"].get(name, 0)
+        if name != "llm.peak_in_flight" and current > count * (1 + threshold):
+            regressions.append(f"{name} made {current} requests, baseline {count}")
+
+    return regressions
+
+
+def print_report(results: dict):
+    print(
+        f"{results['completed']}/{results['stories']} stories in {results['elapsed_seconds']:.2f}s: "
+        f"{results['stories_per_minute']:.2f} stories/min"
+    )
+    for failure in results["failures"]:
+        print(f"  failed: {failure}")
+    if results["story_latency"]:
+        latency = results["story_latency"]
+        print(
+            f"story latency: p50 {latency['p50_ms']:.0f}ms, "
+            f"p95 {latency['p95_ms']:.0f}ms, p99 {latency['p99_ms']:.0f}ms"
+        )
+
+    print(f"\n{'stage':<32}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for name, stage in results["stages"].items():
+        print(
+            f"{name:<32}{stage['count']:>8}{stage['p50_ms']:>12.1f}"
+            f"{stage['p95_ms']:>12.1f}{stage['p99_ms']:>12.1f}"
+        )
+
+    print(f"\n{'requests':<32}{'count':>8}")
+    for name, count in results["requests"].items():
+        print(f"{name:<32}{count:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    for option in fields(BenchmarkOptions):
+        flag = "--" + option.name.replace("_", "-")
+        if option.type is bool or option.type == "bool":
+            parser.add_argument(flag, action="store_true")
+        else:
+            parser.add_argument(flag, type=type(option.default), default=option.default)
+    parser.add_argument("--save", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Fail on regressions against these results")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # instructor imports the deprecated Gemini SDK, which warns about it
+    warnings.filterwarnings("ignore", category=FutureWarning)
+
+    options = BenchmarkOptions(
+        **{option.name: getattr(args, option.name) for option in fields(BenchmarkOptions)}
+    )
+    results = run_benchmark(options, args.verbose)
+    print_report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\nRegressed by more than {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measures cold start time of the worker and of the test suite.
+
+Every run happens in a fresh interpreter so nothing is served from an
+already warm module cache. Run it from the restate directory:
+
+    python benchmarks/startup.py --runs 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+TARGETS = {
+    "worker": [sys.executable, "-c", "import main"],
+    "tests": [sys.executable, "-m", "pytest", "--collect-only", "-q", "tests"],
+}
+
+
+def time_command(command: list[str], runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def slowest_imports(module: str, limit: int) -> list[tuple[int, str]]:
+    """Top level cumulative import times, in microseconds, from -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", choices=TARGETS, action="append")
+    parser.add_argument("--imports", type=int, default=10)
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    for target in args.target or TARGETS:
+        timings = time_command(TARGETS[target], args.runs)
+        print(
+            f"{target}: median {statistics.median(timings):.3f}s, "
+            f"min {min(timings):.3f}s, max {max(timings):.3f}s over {args.runs} runs"
+        )
+
+    if args.imports:
+        print("\nSlowest imports of main:")
+        for cumulative, name in slowest_imports("main", args.imports):
+            print(f"{cumulative / 1000:>10.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import hashlib
+import re
+import time
+import uuid
+from pydantic import BaseModel
+from restate import VirtualObject, ObjectContext
+from helpers.s3 import get_asset_key, get_image_variant_keys
+from helpers.story import (
+    BRANCHING,
+    MAX_DEPTH,
+    MODEL_NAME,
+    FinalStoryNode,
+    get_story_node_ids,
+)
+
+# Bump this whenever the generation pipeline changes in a way that should
+# invalidate previously cached stories
+CACHE_VERSION = 1
+
+# Keyed by the prompt hash. Holds the cached story for that prompt and acts
+# as a single-flight guard so concurrent identical prompts share one run.
+story_cache = VirtualObject("story_cache")
+
+
+class CacheLookup(BaseModel):
+    # The workflow that generates the story if the lookup misses
+    claimant: str
+    awakeable_id: str
+    # A claim older than this is taken over by the next lookup
+    claim_ttl_seconds: int
+
+
+class CacheRelease(BaseModel):
+    claimant: str
+    reason: str
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", prompt).strip().lower()
+
+
+def get_prompt_key(
+    prompt: str, max_depth: int = MAX_DEPTH, branching: int = BRANCHING
+) -> str:
+    """
+    Content address of a story prompt. The model and tree shape are part of
+    the key so a change to either never serves a stale story.
+    """
+    shape = f"{max_depth}" if branching == BRANCHING else f"{max_depth}x{branching}"
+    payload = f"{CACHE_VERSION}:{MODEL_NAME}:{shape}:{normalize_prompt(prompt)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_asset_keys(
+    story_id: str, nodes: list[FinalStoryNode], banner_prompt: str
+) -> list[str]:
+    """Every image, with its compressed variants, and every narration of a story"""
+    images = [(node.id, node.image_description) for node in nodes]
+    images.append(("banner", banner_prompt))
+
+    keys = []
+    for name, prompt in images:
+        keys.extend(get_image_variant_keys(story_id, name, prompt))
+        keys.append(get_asset_key(story_id, name, "images"))
+    return keys + [
+        get_asset_key(story_id, name, "audio")
+        for name in [node.id for node in nodes] + ["theme"]
+    ]
+
+
+def clone_story_nodes(
+    nodes: list[FinalStoryNode],
+    source_story_id: str,
+    story_id: str,
+    max_depth: int = MAX_DEPTH,
+    branching: int = BRANCHING,
+) -> tuple[list[FinalStoryNode], dict[str, str]]:
+    """
+    Copy a story tree over to a new story. Node ids are derived from their
+    position in the tree so the clone gets the ids it would have had if it
+    was generated from scratch.
+    """
+    id_map = dict(
+        zip(
+            get_story_node_ids(source_story_id, max_depth, branching),
+            get_story_node_ids(story_id, max_depth, branching),
+        )
+    )
+    for node in nodes:
+        if node.id not in id_map:
+            id_map[node.id] = str(uuid.uuid5(uuid.UUID(story_id), node.id))
+
+    cloned = [
+        node.model_copy(
+            update={
+                "id": id_map[node.id],
+                "parent_id": None
+                if node.parent_id is None
+                else id_map.get(node.parent_id, node.parent_id),
+            }
+        )
+        for node in nodes
+    ]
+
+    return cloned, id_map
+
+
+@story_cache.handler()
+async def lookup(ctx: ObjectContext, req: CacheLookup) -> dict:
+    """
+    Returns the cached story for this prompt if we have one. If another
+    workflow is already generating it, the caller's awakeable is resolved
+    once that workflow stores or releases the prompt. A claim that's older
+    than its TTL belongs to a workflow that's gone, so the caller takes it
+    over and anyone already waiting now waits on the caller.
+    """
+    entry = await ctx.get("entry")
+    if entry is not None:
+        return {"status": "hit", "entry": entry}
+
+    now = await ctx.run("Claim Time", time.time)
+    claim = await ctx.get("pending")
+    if (
+        claim is not None
+        and claim["claimant"] != req.claimant
+        and now - claim["claimed_at"] < req.claim_ttl_seconds
+    ):
+        waiters = await ctx.get("waiters") or []
+        ctx.set("waiters", waiters + [req.awakeable_id])
+        return {"status": "pending"}
+
+    if claim is not None and claim["claimant"] != req.claimant:
+        print(f"Taking over the stale claim of {claim['claimant']} on {ctx.key()}")
+    ctx.set("pending", {"claimant": req.claimant, "claimed_at": now})
+    return {"status": "miss"}
+
+
+@story_cache.handler()
+async def store(ctx: ObjectContext, entry: dict) -> None:
+    ctx.set("entry", entry)
+    for waiter in await ctx.get("waiters") or []:
+        ctx.resolve_awakeable(waiter, entry)
+    ctx.clear("waiters")
+    ctx.clear("pending")
+
+
+@story_cache.handler()
+async def release(ctx: ObjectContext, req: CacheRelease) -> None:
+    """Gives up on a pending generation so waiting workflows run their own"""
+    claim = await ctx.get("pending")
+    if claim is None or claim["claimant"] != req.claimant:
+        # The claim was taken over, and its waiters now belong to someone else
+        return
+
+    print(f"Releasing story cache for {ctx.key()}: {req.reason}")
+    for waiter in await ctx.get("waiters") or []:
+        ctx.resolve_awakeable(waiter, None)
+    ctx.clear("waiters")
+    ctx.clear("pending")
+
+
+@story_cache.handler()
+async def invalidate(ctx: ObjectContext, reason: str) -> None:
+    print(f"Invalidating story cache for {ctx.key()}: {reason}")
+    ctx.clear("entry")
@@ -1,114 +1,347 @@
+import asyncio
 import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
-from libsql_client import create_client_sync
-from helpers.env import Env
+from typing import Awaitable, Callable, TypeVar
+import aiohttp
+from libsql_client import Client, LibsqlError, ResultSet, Statement, create_client
+from pydantic import BaseModel
+from helpers.env import get_env
+from helpers import tracing
 from helpers.story import StoryOutline, FinalStoryNode
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# Both upserts are idempotent so a retried workflow step never fails on, or
+# duplicates, rows written by a previous attempt
+STORY_UPSERT = """INSERT INTO stories 
+    (id, user_id, title, description, status, timestamp, story_prompt, image_prompt) 
+    VALUES 
+    (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO NOTHING"""
+
+STORY_NODE_UPSERT = """INSERT INTO story_choices 
+    (id, user_id, parent_id, story_id, description, choice_title, choice_description, is_terminal, explored, image_prompt) 
+    VALUES 
+    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        parent_id = excluded.parent_id,
+        story_id = excluded.story_id,
+        description = excluded.description,
+        choice_title = excluded.choice_title,
+        choice_description = excluded.choice_description,
+        is_terminal = excluded.is_terminal,
+        image_prompt = excluded.image_prompt"""
+
+STORY_COMPLETED = "UPDATE stories SET status = 'GENERATED' WHERE id = ?"
+
+NODE_EXPLORED = "UPDATE story_choices SET explored = 1 WHERE id = ?"
+
+# libsql errors that mean the connection is broken rather than the statement
+CONNECTION_ERROR_CODES = {
+    "CLIENT_CLOSED",
+    "HRANA_PROTO_ERROR",
+    "HRANA_WEBSOCKET_ERROR",
+    "STREAM_CLOSED",
+}
+
+
+class InsertResult(BaseModel):
+    rows_written: int
+    elapsed_seconds: float
+
+
+def get_story_statement(
+    story: StoryOutline, story_id: str, user_id: str, story_prompt: str
+) -> Statement:
+    return Statement(
+        STORY_UPSERT,
+        (
+            story_id,
+            user_id,
+            story.title,
+            story.description,
+            "PROCESSING",
+            int(datetime.now().timestamp()),
+            story_prompt,
+            story.banner_image,
+        ),
+    )
+
+
+def get_story_node_statements(
+    nodes: list[FinalStoryNode],
+    story_id: str,
+    user_id: str,
+    story: StoryOutline | None = None,
+    story_prompt: str | None = None,
+) -> list[Statement]:
+    statements = []
+    if story is not None:
+        statements.append(get_story_statement(story, story_id, user_id, story_prompt))
+
+    for node in nodes:
+        statements.append(
+            Statement(
+                STORY_NODE_UPSERT,
+                (
+                    node.id,
+                    user_id,
+                    "NULL" if node.parent_id is None else node.parent_id,
+                    story_id,
+                    node.description,
+                    node.choice_title,
+                    node.choice_description,
+                    1 if node.is_terminal else 0,
+                    1 if node.parent_id is None else 0,
+                    node.image_description,
+                ),
+            )
+        )
+
+    return statements
+
+
+def get_insert_result(
+    results: list[ResultSet], story_id: str, start_time: float
+) -> InsertResult:
+    result = InsertResult(
+        rows_written=sum(result.rows_affected for result in results),
+        elapsed_seconds=time.perf_counter() - start_time,
+    )
+    logger.info(
+        f"Wrote {result.rows_written} rows for story {story_id} in {result.elapsed_seconds:.2f}s"
+    )
+    return result
+
+
+def is_connection_error(error: Exception) -> bool:
+    if isinstance(error, LibsqlError):
+        return error.code in CONNECTION_ERROR_CODES
+    return isinstance(error, (OSError, aiohttp.ClientError))
+
+
+@dataclass
+class PooledConnection:
+    client: Client
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class ConnectionPool:
+    """
+    A bounded pool of async libsql clients. Connections that sat idle for
+    longer than `idle_timeout` are closed, and ones idle for longer than
+    `probe_after` are checked with a cheap `SELECT 1` before being handed
+    out. Recently used connections are assumed to be alive.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Client],
+        max_size: int = 4,
+        idle_timeout: float = 300,
+        probe_after: float = 30,
+    ):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.probe_after = probe_after
+        self._idle: list[PooledConnection] = []
+        self._size = 0
+        self._available = asyncio.Condition()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @asynccontextmanager
+    async def connection(self):
+        pooled = await self._acquire()
+        try:
+            yield pooled.client
+        except Exception as e:
+            # Only a broken connection is dropped, a statement error leaves
+            # the connection usable for the next checkout
+            if is_connection_error(e):
+                await self._discard(pooled)
+                raise
+            await self._release(pooled)
+            raise
+        await self._release(pooled)
+
+    async def _acquire(self) -> PooledConnection:
+        async with self._available:
+            while True:
+                expired = self._evict_idle()
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    pooled = None
+                    break
+                await self._available.wait()
+
+        for client in expired:
+            await self._close(client)
+
+        if pooled is not None and not await self._is_alive(pooled):
+            logger.info("Pooled connection expired, recreating connection")
+            await self._close(pooled.client)
+            pooled = None
+
+        if pooled is None:
+            try:
+                pooled = PooledConnection(self.factory())
+            except Exception:
+                async with self._available:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+
+        return pooled
+
+    async def _is_alive(self, pooled: PooledConnection) -> bool:
+        if pooled.client.closed:
+            return False
+        if time.monotonic() - pooled.last_used < self.probe_after:
+            return True
+        try:
+            await pooled.client.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self) -> list[Client]:
+        now = time.monotonic()
+        expired = [p for p in self._idle if now - p.last_used > self.idle_timeout]
+        for pooled in expired:
+            self._idle.remove(pooled)
+            self._size -= 1
+        return [pooled.client for pooled in expired]
+
+    async def _release(self, pooled: PooledConnection):
+        pooled.last_used = time.monotonic()
+        async with self._available:
+            self._idle.append(pooled)
+            self._available.notify()
+
+    async def _discard(self, pooled: PooledConnection):
+        await self._close(pooled.client)
+        async with self._available:
+            self._size -= 1
+            self._available.notify()
+
+    async def _close(self, client: Client):
+        try:
+            await client.close()
+        except Exception as e:
+            logger.debug(f"Failed to close database connection: {e}")
+
+    async def close(self):
+        async with self._available:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for pooled in idle:
+            await self._close(pooled.client)
+
+
+class AsyncDatabaseClient:
+    """
+    Database client on top of the async libsql client so database steps
+    don't block the event loop the workflows share. Statements check a
+    connection out of a bounded pool, so concurrent workflows on the worker
+    don't queue behind each other on a single connection.
+    """
 
-class DatabaseClient:
     _instance = None
-    _connection = None
+    _pool: ConnectionPool | None = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            cls._settings = Env()
+            cls._settings = get_env()
+            cls._pool = ConnectionPool(
+                lambda: create_client(
+                    cls._settings.DB_URL, auth_token=cls._settings.DB_TOKEN
+                ),
+                max_size=cls._settings.DB_POOL_SIZE,
+                idle_timeout=cls._settings.DB_POOL_IDLE_TIMEOUT_SECONDS,
+                probe_after=cls._settings.DB_POOL_PROBE_AFTER_SECONDS,
+            )
         return cls._instance
 
     def get_connection(self):
-        from contextlib import contextmanager
-
-        @contextmanager
-        def connection():
-            for _ in range(3):
-                if not self._connection:
-                    self._connection = create_client_sync(
-                        self._settings.DB_URL,
-                        auth_token=self._settings.DB_TOKEN,
-                    )
-
-                try:
-                    # Test connection
-                    self._connection.execute("SELECT * FROM stories LIMIT 1;")
-                    break
-                except Exception:
-                    print("Connection expired, recreating connection")
-                    self._connection = None
-            else:
-                raise Exception(
-                    "Failed to establish database connection after 3 attempts"
-                )
-
-            try:
-                yield self._connection
-            finally:
-                logger.info("Database connection closed")
+        return self._pool.connection()
 
-        return connection()
+    async def execute(self, fn: Callable[[Client], Awaitable[T]]) -> T:
+        """
+        Runs `fn` with a pooled connection, retrying once on another
+        if the connection failed. Every statement passed in here needs to be
+        safe to run twice. Errors from the statement itself are raised.
+        """
+        try:
+            async with self.get_connection() as conn:
+                return await fn(conn)
+        except Exception as e:
+            if not is_connection_error(e):
+                raise
+            logger.warning(f"Database statement failed, reconnecting: {str(e)}")
+            tracing.add_event("db.reconnect", error=str(e))
 
-    def insert_story(self, story: StoryOutline, user_email: str, story_prompt: str):
-        import uuid
+        async with self.get_connection() as conn:
+            return await fn(conn)
 
+    @tracing.traced("db.insert_story")
+    async def insert_story(
+        self, story: StoryOutline, user_email: str, story_prompt: str
+    ) -> str:
         story_id = str(uuid.uuid4())
 
-        with self.get_connection() as conn:
-            query = """INSERT INTO stories 
-            (id, user_id, title, description, status, timestamp, story_prompt, image_prompt) 
-            VALUES 
-            (?, ?, ?, ?, ?, ?, ?, ?)"""
-            params = (
-                story_id,
-                user_email,
-                story.title,
-                story.description,
-                "PROCESSING",
-                int(datetime.now().timestamp()),
-                story_prompt,
-                story.banner_image,
-            )
-            print(f"Executing query: {query} with params: {params}")
-            conn.execute(query, params)
+        statement = get_story_statement(story, story_id, user_email, story_prompt)
+        logger.debug(f"Executing query: {statement.sql} with params: {statement.args}")
+        await self.execute(lambda conn: conn.execute(statement.sql, statement.args))
 
         return story_id
 
-    def mark_story_as_completed(self, story_id: str):
+    @tracing.traced("db.mark_story_as_completed")
+    async def mark_story_as_completed(self, story_id: str):
         try:
             print(f"Marking story {story_id} as completed")
-            with self.get_connection() as conn:
-                query = "UPDATE stories SET status = 'GENERATED' WHERE id = ?"
-                conn.execute(query, (story_id,))
+            await self.execute(lambda conn: conn.execute(STORY_COMPLETED, (story_id,)))
 
         except Exception as e:
             logger.error(f"Failed to mark story {story_id} as completed: {str(e)}")
             raise
 
-    def insert_story_nodes(
-        self, nodes: list[FinalStoryNode], story_id: str, user_id: str
-    ):
-        with self.get_connection() as conn:
-            query = """INSERT INTO story_choices 
-                (id, user_id, parent_id, story_id, description, choice_title, choice_description, is_terminal, explored, image_prompt) 
-                VALUES 
-                (?, ?, ?, ?, ?, ?, ?, ?, ?,?)"""
+    @tracing.traced("db.mark_node_as_explored")
+    async def mark_node_as_explored(self, node_id: str):
+        await self.execute(lambda conn: conn.execute(NODE_EXPLORED, (node_id,)))
 
-            try:
-                for node in nodes:
-                    params = (
-                        node.id,
-                        user_id,
-                        "NULL" if node.parent_id is None else node.parent_id,
-                        story_id,
-                        node.description,
-                        node.choice_title,
-                        node.choice_description,
-                        1 if node.is_terminal else 0,
-                        1 if node.parent_id is None else 0,
-                        node.image_description,
-                    )
-                    conn.execute(query, params)
-
-            except Exception as e:
-                logger.error(f"Failed to insert story nodes: {str(e)}")
-                raise
+    @tracing.traced("db.insert_story_nodes")
+    async def insert_story_nodes(
+        self,
+        nodes: list[FinalStoryNode],
+        story_id: str,
+        user_id: str,
+        story: StoryOutline | None = None,
+        story_prompt: str | None = None,
+    ) -> InsertResult:
+        start_time = time.perf_counter()
+        statements = get_story_node_statements(
+            nodes, story_id, user_id, story, story_prompt
+        )
+        tracing.set_attribute("statements", len(statements))
+
+        try:
+            results = await self.execute(lambda conn: conn.batch(statements))
+        except Exception as e:
+            logger.error(f"Failed to insert story nodes: {str(e)}")
+            raise
+
+        return get_insert_result(results, story_id, start_time)
@@ -0,0 +1,228 @@
+import asyncio
+import random
+from functools import lru_cache
+from typing import Literal
+
+from pydantic import BaseModel
+from helpers.env import get_env
+from helpers import tracing
+from helpers.lazy import lazy_import
+
+aiohttp = lazy_import("aiohttp")
+
+# 4xx statuses that mean the endpoint couldn't take the job right now. Any
+# other 4xx means the job itself was rejected and retrying won't help.
+RETRYABLE_STATUSES = {408, 425, 429}
+
+
+class DeadLetter(BaseModel):
+    kind: Literal["images", "audio"]
+    node_id: str
+    attempts: int
+    error: str
+
+
+class DispatchReport(BaseModel):
+    acknowledged: list[str] = []
+    dead_letters: list[DeadLetter] = []
+
+    def merge(self, other: "DispatchReport") -> "DispatchReport":
+        return DispatchReport(
+            acknowledged=self.acknowledged + other.acknowledged,
+            dead_letters=self.dead_letters + other.dead_letters,
+        )
+
+
+class RetryableDispatchError(Exception):
+    pass
+
+
+class RejectedDispatchError(Exception):
+    pass
+
+
+class MediaDispatcher:
+    """
+    Posts media jobs to one of our GPU endpoints over a shared keep-alive
+    session, with a bound on the number of deliveries in flight.
+
+    The media services answer with a 202 as soon as they've spawned a job,
+    and only a 2xx counts as an acknowledgement. Timeouts, connection
+    failures and any other status are retried with jittered exponential
+    backoff, except for a 4xx that rejects the job itself. Jobs that never
+    get through are returned as dead letters instead of being dropped.
+
+    With a `batch_endpoint`, `dispatch_batch` sends a list of jobs in a
+    single request and they're acknowledged or dead lettered together.
+    `headers` are sent with every request, which is how endpoints behind
+    Modal's proxy auth get their token.
+    """
+
+    def __init__(
+        self,
+        kind: Literal["images", "audio"],
+        endpoint: str,
+        max_concurrency: int = 16,
+        ack_timeout: float = 60.0,
+        max_attempts: int = 5,
+        initial_backoff: float = 0.5,
+        max_backoff: float = 10.0,
+        batch_endpoint: str | None = None,
+        headers: dict[str, str] | None = None,
+    ):
+        self.kind = kind
+        self.endpoint = endpoint
+        self.batch_endpoint = batch_endpoint
+        self.headers = headers or {}
+        self.max_concurrency = max_concurrency
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+
+    def _bind(self):
+        """Sessions and semaphores belong to an event loop, so they're made on first use"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._session is None or self._session.closed:
+            self._loop = loop
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.ack_timeout, sock_read=self.ack_timeout
+                ),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session, self._semaphore
+
+    def get_backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+        )
+
+    async def post(self, job: dict, endpoint: str | None = None):
+        """A single delivery attempt, which returns once the job is acknowledged"""
+        session, semaphore = self._bind()
+        async with tracing.acquire(semaphore, "dispatch.wait"):
+            async with session.post(
+                endpoint or self.endpoint, json=job, allow_redirects=False
+            ) as response:
+                if 200 <= response.status < 300:
+                    return
+                if 400 <= response.status < 500 and response.status not in RETRYABLE_STATUSES:
+                    raise RejectedDispatchError(
+                        f"HTTP {response.status}: {await response.text()}"
+                    )
+                raise RetryableDispatchError(f"HTTP {response.status}")
+
+    async def send(self, job: dict) -> DeadLetter | None:
+        with tracing.span(f"dispatch.{self.kind}", node_id=job["node_id"]) as span:
+            dead_letter = await self.deliver(job)
+            span.set_attribute("delivered", dead_letter is None)
+            return dead_letter
+
+    async def deliver(
+        self, job: dict, endpoint: str | None = None, node_id: str | None = None
+    ) -> DeadLetter | None:
+        node_id = node_id or job["node_id"]
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            tracing.set_attribute("attempts", attempt)
+            try:
+                await self.post(job, endpoint)
+                return None
+            except RejectedDispatchError as e:
+                return DeadLetter(
+                    kind=self.kind, node_id=node_id, attempts=attempt, error=str(e)
+                )
+            except (RetryableDispatchError, aiohttp.ClientError, TimeoutError) as e:
+                error = e
+                tracing.add_event("dispatch.retry", attempt=attempt, error=repr(e))
+                print(
+                    f"Failed to dispatch {self.kind} for {node_id} (attempt {attempt}): {e!r}"
+                )
+
+            if attempt < self.max_attempts:
+                await asyncio.sleep(self.get_backoff(attempt))
+
+        return DeadLetter(
+            kind=self.kind,
+            node_id=node_id,
+            attempts=self.max_attempts,
+            error=repr(error),
+        )
+
+    async def dispatch(self, jobs: list[dict]) -> DispatchReport:
+        results = await asyncio.gather(*[self.send(job) for job in jobs])
+
+        report = DispatchReport()
+        for job, dead_letter in zip(jobs, results):
+            if dead_letter is None:
+                report.acknowledged.append(job["node_id"])
+            else:
+                print(f"Dead letter: {dead_letter}")
+                report.dead_letters.append(dead_letter)
+        return report
+
+    async def dispatch_batch(self, jobs: list[dict]) -> DispatchReport:
+        """Sends every job to the batch endpoint in a single request"""
+        if not jobs:
+            return DispatchReport()
+
+        node_ids = [job["node_id"] for job in jobs]
+        with tracing.span(f"dispatch.{self.kind}.batch", jobs=len(jobs)) as span:
+            dead_letter = await self.deliver(
+                {"nodes": jobs},
+                self.batch_endpoint,
+                node_id=f"{jobs[0]['story_id']} batch of {len(jobs)}",
+            )
+            span.set_attribute("delivered", dead_letter is None)
+
+        if dead_letter is None:
+            return DispatchReport(acknowledged=node_ids)
+
+        print(f"Dead letter: {dead_letter}")
+        return DispatchReport(
+            dead_letters=[
+                dead_letter.model_copy(update={"node_id": node_id})
+                for node_id in node_ids
+            ]
+        )
+
+
+def get_proxy_headers(token_id: str | None, token_secret: str | None) -> dict[str, str]:
+    """Headers for a Modal endpoint deployed with `requires_proxy_auth`"""
+    if not token_id or not token_secret:
+        return {}
+    return {"Modal-Key": token_id, "Modal-Secret": token_secret}
+
+
+@lru_cache
+def get_dispatcher(kind: Literal["images", "audio"]) -> MediaDispatcher:
+    """One dispatcher, and so one session, per endpoint for the whole worker"""
+    settings = get_env()
+    if kind == "images":
+        endpoint = settings.IMAGE_ENDPOINT
+        headers = get_proxy_headers(
+            settings.IMAGE_PROXY_TOKEN_ID, settings.IMAGE_PROXY_TOKEN_SECRET
+        )
+    else:
+        endpoint = settings.KOKORO_ENDPOINT
+        headers = get_proxy_headers(
+            settings.KOKORO_PROXY_TOKEN_ID, settings.KOKORO_PROXY_TOKEN_SECRET
+        )
+
+    return MediaDispatcher(
+        kind,
+        endpoint,
+        max_concurrency=settings.DISPATCH_CONCURRENCY,
+        ack_timeout=settings.DISPATCH_ACK_TIMEOUT_SECONDS,
+        max_attempts=settings.DISPATCH_MAX_ATTEMPTS,
+        initial_backoff=settings.DISPATCH_INITIAL_BACKOFF_SECONDS,
+        max_backoff=settings.DISPATCH_MAX_BACKOFF_SECONDS,
+        batch_endpoint=settings.KOKORO_BATCH_ENDPOINT if kind == "audio" else None,
+        headers=headers,
+    )
@@ -1,3 +1,6 @@
+from functools import lru_cache
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 
@@ -7,9 +10,91 @@ class Env(BaseSettings):
     DB_TOKEN: str
     IMAGE_ENDPOINT: str
     KOKORO_ENDPOINT: str
+    # When set, each story level's narration is sent to Kokoro's batch
+    # endpoint in one request instead of one request per node
+    KOKORO_BATCH_ENDPOINT: str | None = None
+    # Modal proxy auth token sent as Modal-Key/Modal-Secret to endpoints
+    # deployed with requires_proxy_auth, which the Kokoro endpoints are
+    KOKORO_PROXY_TOKEN_ID: str | None = None
+    KOKORO_PROXY_TOKEN_SECRET: str | None = None
+    IMAGE_PROXY_TOKEN_ID: str | None = None
+    IMAGE_PROXY_TOKEN_SECRET: str | None = None
     AWS_SECRET_ACCESS_KEY: str
     AWS_ACCESS_KEY_ID: str
     AWS_REGION: str
 
+    # libsql connections kept per worker. Connections idle for longer than the
+    # probe window are checked before use and closed after the idle timeout.
+    DB_POOL_SIZE: int = 4
+    DB_POOL_IDLE_TIMEOUT_SECONDS: int = 300
+    DB_POOL_PROBE_AFTER_SECONDS: int = 30
+
+    # Public Restate ingress that the media services call back into once an
+    # asset has been uploaded. Without it we fall back to polling S3.
+    RESTATE_INGRESS_URL: str | None = None
+    RESTATE_INGRESS_TOKEN: str | None = None
+    MEDIA_COMPLETION_MODE: Literal["signal", "poll"] = "signal"
+    MEDIA_TIMEOUT_SECONDS: int = 600
+    # Format of the compressed image variants the image service uploads
+    IMAGE_FORMAT: Literal["webp", "avif"] = "webp"
+    # Extension of the narration the Kokoro service uploads for its AUDIO_FORMAT
+    AUDIO_EXTENSION: Literal["wav", "ogg", "mp3"] = "mp3"
+    POLL_INITIAL_INTERVAL_SECONDS: int = 5
+    POLL_MAX_INTERVAL_SECONDS: int = 60
+
+    # Media jobs are posted over one keep-alive session per endpoint with a
+    # bound on deliveries in flight. Failed deliveries are retried with
+    # jittered backoff and reported as dead letters after the last attempt.
+    # The endpoints answer as soon as a job is spawned, so the ack timeout
+    # only has to cover a cold start of the endpoint's container.
+    DISPATCH_CONCURRENCY: int = 16
+    DISPATCH_ACK_TIMEOUT_SECONDS: float = 60.0
+    DISPATCH_MAX_ATTEMPTS: int = 5
+    DISPATCH_INITIAL_BACKOFF_SECONDS: float = 0.5
+    DISPATCH_MAX_BACKOFF_SECONDS: float = 10.0
+
+    # Every Gemini call on the worker goes through one gateway that keeps the
+    # request and token rates under these quotas. Its concurrency limit is
+    # halved when Gemini returns a 429 or a 5xx and grows back on success.
+    LLM_REQUESTS_PER_MINUTE: int = 1000
+    LLM_TOKENS_PER_MINUTE: int = 4_000_000
+    LLM_INITIAL_CONCURRENCY: int = 16
+    LLM_MIN_CONCURRENCY: int = 4
+    LLM_MAX_CONCURRENCY: int = 64
+    LLM_MAX_ATTEMPTS: int = 5
+    LLM_EXPECTED_OUTPUT_TOKENS: int = 512
+
+    # Generate each level of the story tree in a single call per batch of
+    # sibling branches instead of one call per node
+    STORY_BATCH_LEVELS: bool = False
+
+    # Upload the story-invariant part of the continuation prompt as a Gemini
+    # context cache, once per story, when the model supports it. The TTL has
+    # to cover every level of a story. Gemini only caches content of at least
+    # PROMPT_CACHE_MIN_TOKENS, which today's prefix is well short of
+    PROMPT_CACHE: bool = False
+    PROMPT_CACHE_TTL_SECONDS: int = 900
+    PROMPT_CACHE_MIN_TOKENS: int = 32768
+
+    # Serve repeated prompts from previously generated stories, and let
+    # concurrent identical prompts share a single generation
+    STORY_CACHE: bool = False
+    STORY_CACHE_WAIT_SECONDS: int = 900
+    # A workflow's claim on generating a prompt is taken over after this long,
+    # so one that died without releasing it doesn't block the prompt forever
+    STORY_CACHE_CLAIM_TTL_SECONDS: int = 1800
+
+    # One trace per story workflow, with spans for every step, model call,
+    # database statement, S3 call and media dispatch
+    TRACE_EXPORTER: Literal["none", "file", "otlp"] = "none"
+    TRACE_FILE: str = "traces.jsonl"
+    TRACE_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"
+
     class Config:
         env_file = ".env"
+
+
+@lru_cache
+def get_env() -> Env:
+    """Settings are read and validated once and shared by the whole worker"""
+    return Env()
@@ -0,0 +1,21 @@
+import importlib
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Stands in for a module until one of its attributes is used. It's never
+    registered in sys.modules, so other importers always see the real module.
+    """
+
+    def __getattr__(self, attr: str):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Returns a module that's only imported the first time one of its
+    attributes is used. The worker imports these SDKs on every cold start
+    while most of them aren't needed until the first request comes in.
+    """
+    return LazyModule(name)
@@ -0,0 +1,315 @@
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Literal
+
+from pydantic import BaseModel
+from restate import Context, Service
+from helpers.env import get_env
+from helpers import tracing
+
+Priority = Literal["interactive", "bulk"]
+
+# Lower ranks are admitted first
+PRIORITY_RANKS: dict[str, int] = {"interactive": 0, "bulk": 1}
+
+# Responses that mean Gemini is over quota or overloaded rather than that the
+# request itself was bad
+OVERLOADED_STATUSES = {429, 500, 502, 503, 504}
+
+# How many of the most recent calls the latency percentiles are taken over
+LATENCY_WINDOW = 1000
+
+llm_gateway = Service("llm_gateway")
+
+
+class GatewayStats(BaseModel):
+    concurrency_limit: float
+    in_flight: int
+    queued: dict[str, int]
+    requests: int
+    throttled: int
+    cached_tokens_saved: int
+    queue_wait_p50_ms: float
+    queue_wait_p95_ms: float
+    latency_p50_ms: float
+    latency_p95_ms: float
+
+
+class TokenBucket:
+    """A bucket of `per_minute` tokens that refills continuously"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available"""
+        self.refill()
+        # A single request bigger than the whole bucket only waits for a full one
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+def is_overloaded(error: BaseException) -> bool:
+    """Whether an error, or one it was raised from, is a 429 or a 5xx"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        status = getattr(error, "code", None) or getattr(error, "status_code", None)
+        if isinstance(status, int) and status in OVERLOADED_STATUSES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def estimate_tokens(messages: list[dict], output_tokens: int) -> int:
+    """Roughly four characters per token for the prompt, plus the expected output"""
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4 + output_tokens
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class LLMGateway:
+    """
+    Every Gemini call on the worker goes through here. Calls are admitted in
+    priority order while the request and token buckets have room and fewer
+    than `concurrency_limit` calls are in flight.
+
+    The limit is adjusted with AIMD. It grows by one every time a full limit
+    of calls succeeds, and it's halved when Gemini returns a 429 or a 5xx.
+    Calls that were already in flight when it was halved don't halve it
+    again. Throttled calls are retried here with jittered backoff so a burst
+    of 429s doesn't fail the whole workflow step.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = 1000,
+        tokens_per_minute: int = 4_000_000,
+        initial_concurrency: int = 16,
+        min_concurrency: int = 4,
+        max_concurrency: int = 64,
+        max_attempts: int = 5,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 30.0,
+        expected_output_tokens: int = 512,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.concurrency_limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.expected_output_tokens = expected_output_tokens
+
+        self.requests = 0
+        self.throttled = 0
+        self.cached_tokens_saved = 0
+        self.queue_waits: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+        self._loop = None
+        self._waiters: list = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._timer = None
+        self._last_decrease = 0.0
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+
+    def _bind(self):
+        """Waiters belong to an event loop, so the queue is reset if the loop changes"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._waiters = []
+            self._in_flight = 0
+            self._timer = None
+        return loop
+
+    def client(self, client, priority: Priority = "interactive") -> "GatewayClient":
+        return GatewayClient(self, client, priority)
+
+    def get_backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+        )
+
+    async def create(self, client, priority: Priority = "interactive", **kwargs):
+        """`client.chat.completions.create(**kwargs)` once the gateway admits it"""
+        tokens = estimate_tokens(kwargs.get("messages", []), self.expected_output_tokens)
+
+        for attempt in range(1, self.max_attempts + 1):
+            queued_at = time.monotonic()
+            with tracing.span("llm.wait", priority=priority, tokens=tokens):
+                await self._admit(priority, tokens)
+            started_at = time.monotonic()
+            self.queue_waits.append((started_at - queued_at) * 1000)
+
+            try:
+                result = await client.chat.completions.create(**kwargs)
+            except Exception as e:
+                overloaded = is_overloaded(e)
+                self._release(started_at, overloaded)
+                if not overloaded or attempt == self.max_attempts:
+                    raise
+                self.throttled += 1
+                tracing.add_event("llm.throttled", attempt=attempt, error=repr(e))
+                print(
+                    f"Gemini is overloaded (attempt {attempt}), "
+                    f"concurrency limit is now {self.concurrency_limit:.1f}: {e!r}"
+                )
+                await asyncio.sleep(self.get_backoff(attempt))
+                continue
+            except BaseException:
+                self._release(started_at, False)
+                raise
+
+            self.latencies.append((time.monotonic() - started_at) * 1000)
+            self._release(started_at, False)
+            return result
+
+    async def _admit(self, priority: Priority, tokens: int):
+        loop = self._bind()
+        future = loop.create_future()
+        heapq.heappush(
+            self._waiters,
+            (PRIORITY_RANKS[priority], next(self._sequence), tokens, priority, future),
+        )
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were admitted just as we got cancelled, so give the slot back
+                self._in_flight -= 1
+                self._wake()
+            raise
+
+    def _wake(self):
+        """Admit waiters in priority order for as long as there's room"""
+        while self._waiters and self._in_flight < int(self.concurrency_limit):
+            _, _, tokens, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            delay = max(
+                self._request_bucket.delay(1), self._token_bucket.delay(tokens)
+            )
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = self._loop.call_later(delay, self._on_timer)
+                return
+
+            heapq.heappop(self._waiters)
+            self._request_bucket.take(1)
+            self._token_bucket.take(tokens)
+            self._in_flight += 1
+            self.requests += 1
+            future.set_result(None)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake()
+
+    def _release(self, started_at: float, overloaded: bool):
+        self._in_flight -= 1
+        if overloaded:
+            if started_at >= self._last_decrease:
+                self.concurrency_limit = max(
+                    self.min_concurrency, self.concurrency_limit / 2
+                )
+                self._last_decrease = time.monotonic()
+        else:
+            self.concurrency_limit = min(
+                self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit
+            )
+        self._wake()
+
+    def record_cached_tokens(self, tokens: int):
+        """Prompt tokens a story served from a context cache instead of resending"""
+        self.cached_tokens_saved += tokens
+
+    def stats(self) -> GatewayStats:
+        queued = {priority: 0 for priority in PRIORITY_RANKS}
+        for _, _, _, priority, future in self._waiters:
+            if not future.done():
+                queued[priority] += 1
+
+        return GatewayStats(
+            concurrency_limit=round(self.concurrency_limit, 2),
+            in_flight=self._in_flight,
+            queued=queued,
+            requests=self.requests,
+            throttled=self.throttled,
+            cached_tokens_saved=self.cached_tokens_saved,
+            queue_wait_p50_ms=round(percentile(self.queue_waits, 50), 2),
+            queue_wait_p95_ms=round(percentile(self.queue_waits, 95), 2),
+            latency_p50_ms=round(percentile(self.latencies, 50), 2),
+            latency_p95_ms=round(percentile(self.latencies, 95), 2),
+        )
+
+
+class GatewayClient:
+    """An instructor client whose completions all go through the gateway"""
+
+    def __init__(self, gateway: LLMGateway, client, priority: Priority):
+        self.gateway = gateway
+        self.client = client
+        self.priority = priority
+
+    async def create(self, **kwargs):
+        return await self.gateway.create(self.client, self.priority, **kwargs)
+
+    @property
+    def chat(self):
+        return self
+
+    @property
+    def completions(self):
+        return self
+
+
+@lru_cache
+def get_gateway() -> LLMGateway:
+    """One gateway, and so one set of quotas, for the whole worker"""
+    settings = get_env()
+    return LLMGateway(
+        requests_per_minute=settings.LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE,
+        initial_concurrency=settings.LLM_INITIAL_CONCURRENCY,
+        min_concurrency=settings.LLM_MIN_CONCURRENCY,
+        max_concurrency=settings.LLM_MAX_CONCURRENCY,
+        max_attempts=settings.LLM_MAX_ATTEMPTS,
+        expected_output_tokens=settings.LLM_EXPECTED_OUTPUT_TOKENS,
+    )
+
+
+@llm_gateway.handler()
+async def stats(ctx: Context) -> dict:
+    """Queue depth, concurrency and latency of the gateway on this worker"""
+    return get_gateway().stats().model_dump()
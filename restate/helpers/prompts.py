@@ -0,0 +1,231 @@
+import logging
+from datetime import timedelta
+
+from jinja2 import Environment
+from helpers.lazy import lazy_import
+from helpers import tracing
+from helpers.llm import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+genai = lazy_import("google.generativeai")
+
+# Templates are compiled once at import time instead of on every call
+templates = Environment()
+
+CONTINUATION_PREFIX = templates.from_string(
+    """
+Continue the story where we last left off. You'll be given the outline of the story, previous choices made by the user and the remaining turns.
+
+<story>
+<title>
+{{ story_title }}
+</title>
+<description>
+{{ story_description }}
+</description>
+
+</story>
+
+<bad image description>
+Pixel art of Kai walking through a dense forest, looking weary, with a village in the distance.
+</bad image description>
+
+<good image description>
+A lone martial artist stands silhouetted against a fiery sunset, pixel art style, orange and red hues dominate the sky.
+
+A brave knight faces a towering dragon, 8-bit pixel art, vibrant blues and greens with dark castle silhouette in background.
+
+A mysterious wizard casting spells in a moonlit forest clearing, pixel art style with purple and blue color palette, glowing magical particles.
+
+A space explorer on an alien planet with two suns, retro pixel art, teal and pink landscape with strange crystalline formations.
+
+A pirate ship sailing through a storm, 8-bit pixel art, deep blues and whites with lightning flashes illuminating the choppy waves.
+</good image description>
+
+A good description will be specific, include details about how the image should look like in terms of just pure visual elements. Examples of these are the style, the colors, individual components of the image and the background.
+
+Make sure to provide specific details about the image, the colours, the style and the individual components of the image. We want something that has a strong 8 bit pixel art style.
+"""
+)
+
+PREVIOUS_CHOICES = """
+<previous choices>
+{% for choice in previous_choices %}
+<choice {{loop.index}}>
+Choice Context: {{ choice.context }}
+Options: {% for option in choice.options %}
+    <option {{loop.index}}>
+    Title: {{ option.title }}
+    Description: {{ option.description }}
+    </option>
+{% endfor %}
+User Chose: {{ choice.choice.choice_title }}
+</choice>
+{% endfor %}
+</previous choices>
+"""
+
+INSTRUCTIONS = """
+{% if remaining_turns == 0 %}
+Based on the outline above, generate the following{{ target }}:
+
+- A conclusion of the story that's between 3-5 sentences. Make sure to tie up all loose ends where possible and provide a satisfying conclusion to the story. This should not be too far off in the future from the previous choices made by the user.
+- There should be no choices for the user to make at this point in the story.
+- A image description of about 15 words that's suitable for the story as cover art. This should be in a pixel art and retro 8-bit style. Mention specific details of the image in the description.
+
+{% else %}
+Based on the outline above, generate the following{{ target }}:
+- A 3-4 sentence description of what happens next in the story based off previous user choices. If there are no previous user choices, make sure that you set the scene for the first choice explicitly and introduce the main character.
+- {{ choice_count }} distinct choices for the user to make that will meaningfully impact how the story continues. Each choice title must be distinct from each other.
+- The choice title should be a single sentence that describes the user's choice. The description of the choice here should be around 2 sentences.
+- A description for an image that's suitable for this story at this point. Make sure to mention specific details of the image in the description.
+{% endif %}
+"""
+
+CONTINUATION_SUFFIX = templates.from_string(
+    """
+These are the previous choices made by the user:
+"""
+    + PREVIOUS_CHOICES
+    + INSTRUCTIONS
+)
+
+LEVEL_SUFFIX = templates.from_string(
+    """
+Continue each of the branches below. Each branch is its own independent version of the story.
+
+{% for branch in branches %}
+<branch path="{{ branch.path }}">
+These are the previous choices made by the user in this branch:
+{% with previous_choices = branch.user_choices %}"""
+    + PREVIOUS_CHOICES
+    + """{% endwith %}
+</branch>
+{% endfor %}
+"""
+    + INSTRUCTIONS
+    + """
+Return exactly one entry per branch and set its path to the path of the branch it continues.
+"""
+)
+
+
+CHOICE_COUNTS = {2: "Two", 3: "Three", 4: "Four"}
+
+
+def get_choice_count(choices: int) -> str:
+    return CHOICE_COUNTS.get(choices, str(choices))
+
+
+def as_literal(text: str) -> str:
+    """
+    Instructor renders every message as a jinja template when we pass a
+    validation context, so rendered prompts are wrapped to pass through as is.
+    """
+    return "{% raw %}" + text.replace("{% endraw %}", "") + "{% endraw %}"
+
+
+class StoryPrompt:
+    """
+    The story-invariant prefix of the continuation prompt. It's rendered once
+    per story and, where the model supports it, uploaded once as cached
+    content that every level of the story reuses, so each node only sends
+    its previous choices.
+    """
+
+    def __init__(self, title: str, description: str):
+        self.prefix = CONTINUATION_PREFIX.render(
+            story_title=title, story_description=description
+        )
+        self.cache = None
+        self.prefix_tokens = 0
+        self.calls = 0
+
+    @tracing.traced("gemini.create_cache")
+    def create_cache(
+        self, model_name: str, ttl: timedelta, min_tokens: int = 0
+    ) -> str | None:
+        """
+        Uploads the prefix as cached content and returns its name, or None
+        when caching isn't available for the model. Gemini rejects cached
+        content below `min_tokens`, so a shorter prefix isn't uploaded.
+        """
+        if estimate_tokens([{"content": self.prefix}], 0) < min_tokens:
+            logger.info(f"Prompt prefix is below the {min_tokens} token cache minimum")
+            return None
+
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=f"models/{model_name}",
+                system_instruction=self.prefix,
+                ttl=ttl,
+            )
+            return cache.name
+        except Exception as e:
+            logger.info(f"Context caching unavailable for {model_name}: {e}")
+            return None
+
+    @tracing.traced("gemini.get_model")
+    def get_model(self, model_name: str, cache_name: str | None = None):
+        """
+        Returns a model backed by the story's cached prefix, falling back to
+        a plain model without a cache or once it has expired
+        """
+        if cache_name is not None:
+            try:
+                self.cache = genai.caching.CachedContent.get(cache_name)
+                self.prefix_tokens = self.cache.usage_metadata.total_token_count
+                return genai.GenerativeModel.from_cached_content(self.cache)
+            except Exception as e:
+                logger.info(f"Prompt cache {cache_name} unavailable: {e}")
+                self.cache = None
+
+        return genai.GenerativeModel(model_name)
+
+    def messages(self, suffix: str) -> list[dict]:
+        self.calls += 1
+
+        if self.cache is not None:
+            return [{"role": "user", "content": as_literal(suffix)}]
+
+        return [
+            {"role": "system", "content": as_literal(self.prefix)},
+            {"role": "user", "content": as_literal(suffix)},
+        ]
+
+    def continuation(
+        self, previous_choices: list[dict], remaining_turns: int, choices: int = 2
+    ):
+        return self.messages(
+            CONTINUATION_SUFFIX.render(
+                previous_choices=previous_choices,
+                remaining_turns=remaining_turns,
+                choice_count=get_choice_count(choices),
+                target="",
+            )
+        )
+
+    def level(self, branches: list[dict], remaining_turns: int, choices: int = 2):
+        return self.messages(
+            LEVEL_SUFFIX.render(
+                branches=branches,
+                remaining_turns=remaining_turns,
+                choice_count=get_choice_count(choices),
+                target=" for every branch",
+            )
+        )
+
+    @property
+    def tokens_saved(self) -> int:
+        """Prefix tokens served from the context cache instead of being resent"""
+        if self.cache is None:
+            return 0
+        return self.prefix_tokens * self.calls
+
+
+def delete_cache(cache_name: str):
+    try:
+        genai.caching.CachedContent.get(cache_name).delete()
+    except Exception as e:
+        logger.warning(f"Failed to delete prompt cache {cache_name}: {e}")
@@ -1,47 +1,189 @@
-import boto3
-from botocore.exceptions import ClientError
-from helpers.env import Env
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pydantic import BaseModel
+from helpers.env import get_env
+from helpers import tracing
+from helpers.lazy import lazy_import
 
+boto3 = lazy_import("boto3")
+botocore_config = lazy_import("botocore.config")
+botocore_exceptions = lazy_import("botocore.exceptions")
 
-def get_story_items(story_id: str) -> list[str]:
+BUCKET = "restate-story"
+ASSET_EXTENSIONS = {"png": "images", "wav": "audio", "ogg": "audio", "mp3": "audio"}
+
+# Upper bound on concurrent requests against the bucket. It's also the most
+# keys we'll HEAD individually before a listing becomes the cheaper check.
+MAX_CONCURRENT_REQUESTS = 16
+
+
+class StoryAssets(BaseModel):
+    images: set[str] = set()
+    audio: set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.images) + len(self.audio)
+
+
+@lru_cache
+def get_s3_client():
+    """
+    boto3 clients are thread safe, so the whole worker shares one client and
+    its connection pool instead of creating a new one on every call
+    """
+    settings = get_env()
+    return boto3.client(
+        "s3",
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_REGION,
+        config=botocore_config.Config(max_pool_connections=MAX_CONCURRENT_REQUESTS),
+    )
+
+
+def get_asset_key(story_id: str, name: str, kind: str) -> str:
+    extension = "png" if kind == "images" else get_env().AUDIO_EXTENSION
+    return f"{story_id}/{name}.{extension}"
+
+
+def get_image_version(prompt: str) -> str:
     """
-    Get list of image filenames for a given story ID from S3 bucket
+    32-bit FNV-1a hash of an image prompt. The image service puts it in the
+    keys of its compressed variants, so they can be cached as immutable.
+    """
+    version = 0x811C9DC5
+    for byte in prompt.encode("utf-8"):
+        version = ((version ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return f"{version:08x}"
+
+
+def get_image_variant_keys(story_id: str, name: str, prompt: str) -> list[str]:
+    """Keys of the full size and thumbnail variants uploaded next to an image"""
+    version = get_image_version(prompt)
+    image_format = get_env().IMAGE_FORMAT
+    return [
+        f"{story_id}/{name}.{version}.{image_format}",
+        f"{story_id}/{name}.{version}.thumb.{image_format}",
+    ]
+
+
+def parse_asset_key(story_id: str, key: str) -> tuple[str, str] | None:
+    """Returns the asset type and node id of an asset key, if it is one"""
+    prefix = f"{story_id}/"
+    if not key.startswith(prefix) or "." not in key:
+        return None
+
+    name, extension = key[len(prefix) :].rsplit(".", 1)
+    if extension not in ASSET_EXTENSIONS or "/" in name:
+        return None
+    return ASSET_EXTENSIONS[extension], name
+
+
+@tracing.traced("s3.list_objects")
+def get_story_items(story_id: str) -> StoryAssets:
+    """
+    Get the images and audio that have been uploaded for a given story ID
 
     Args:
         story_id: UUID of the story
 
     Returns:
-        List of image filenames (without .png extension)
+        The node ids of every image and audio file, without their extension
     """
+    assets = StoryAssets()
     try:
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=Env().AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=Env().AWS_SECRET_ACCESS_KEY,
-            region_name=Env().AWS_REGION,
-        )
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=f"{story_id}/"):
+            tracing.add_event("page", keys=len(page.get("Contents", [])))
+            for obj in page.get("Contents", []):
+                parsed = parse_asset_key(story_id, obj["Key"])
+                if parsed is not None:
+                    kind, name = parsed
+                    getattr(assets, kind).add(name)
 
-        response = s3.list_objects_v2(Bucket="restate-story", Prefix=f"{story_id}/")
-
-        if "Contents" not in response:
-            return {
-                "images": [],
-                "audio": [],
-            }
-
-        return {
-            "images": [
-                obj["Key"].replace(f"{story_id}/", "").replace(".png", "")
-                for obj in response["Contents"]
-                if obj["Key"].endswith(".png")
-            ],
-            "audio": [
-                obj["Key"].replace(f"{story_id}/", "").replace(".wav", "")
-                for obj in response["Contents"]
-                if obj["Key"].endswith(".wav")
-            ],
-        }
-
-    except ClientError as e:
+    except botocore_exceptions.ClientError as e:
         print(f"Error accessing S3: {e}")
-        return []
+        return StoryAssets()
+
+    return assets
+
+
+@tracing.traced("s3.head_object")
+def asset_exists(key: str) -> bool:
+    try:
+        get_s3_client().head_object(Bucket=BUCKET, Key=key)
+        return True
+    except botocore_exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+            print(f"Error accessing S3: {e}")
+        return False
+
+
+def get_missing_assets(
+    story_id: str, images: set[str], audio: set[str]
+) -> StoryAssets:
+    """
+    Check which of the expected images and audio haven't been uploaded yet.
+
+    Once only a few assets are outstanding we HEAD just those keys
+    concurrently, otherwise a single listing of the story is cheaper.
+    """
+    expected = StoryAssets(images=images, audio=audio)
+    if len(expected) == 0:
+        return expected
+
+    if len(expected) > MAX_CONCURRENT_REQUESTS:
+        uploaded = get_story_items(story_id)
+        return StoryAssets(
+            images=expected.images - uploaded.images,
+            audio=expected.audio - uploaded.audio,
+        )
+
+    checks = [("images", name) for name in expected.images] + [
+        ("audio", name) for name in expected.audio
+    ]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        exists = executor.map(
+            tracing.bind(
+                lambda check: asset_exists(get_asset_key(story_id, check[1], check[0]))
+            ),
+            checks,
+        )
+        missing = [check for check, found in zip(checks, exists) if not found]
+
+    return StoryAssets(
+        images={name for kind, name in missing if kind == "images"},
+        audio={name for kind, name in missing if kind == "audio"},
+    )
+
+
+def copy_story_assets(
+    asset_keys: list[str], story_id: str, id_map: dict[str, str]
+) -> list[str]:
+    """
+    Server side copy of a cached story's images and audio over to a new story
+
+    Args:
+        asset_keys: S3 keys of the cached story's assets
+        story_id: UUID of the story we're copying into
+        id_map: Mapping of the cached story's node ids to the new node ids
+
+    Returns:
+        List of the keys that were written
+    """
+    s3 = get_s3_client()
+
+    @tracing.traced("s3.copy_object")
+    def copy(key: str) -> str:
+        # Image variants carry a version and suffix after the node id
+        name, suffix = key.split("/", 1)[1].split(".", 1)
+        new_key = f"{story_id}/{id_map.get(name, name)}.{suffix}"
+        s3.copy_object(
+            Bucket=BUCKET,
+            CopySource={"Bucket": BUCKET, "Key": key},
+            Key=new_key,
+        )
+        return new_key
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(tracing.bind(copy), asset_keys))
@@ -1,12 +1,54 @@
 import instructor
-import google.generativeai as genai
 from pydantic import BaseModel, field_validator, ValidationInfo
-from helpers.env import Env
-from asyncio import Semaphore, gather
-import requests
+from helpers.dispatch import DispatchReport, get_dispatcher
+from helpers.env import get_env
+from helpers.lazy import lazy_import
+from helpers.llm import GatewayClient, Priority, get_gateway
+from helpers.prompts import StoryPrompt, delete_cache
+from helpers import tracing
+from asyncio import Semaphore, gather, to_thread
+from datetime import timedelta
+from functools import lru_cache
 import uuid
 
-genai.configure(api_key=Env().GOOGLE_API_KEY)
+genai = lazy_import("google.generativeai")
+
+MODEL_NAME = "gemini-2.0-flash-exp"
+MAX_DEPTH = 3
+BRANCHING = 2
+# Every node id generated in one go is known, and in signal mode awaited,
+# before generation starts. Bounds a whole story, or an incremental story's
+# lookahead levels.
+MAX_STORY_NODES = 127
+LEVEL_BATCH_SIZE = 8
+
+
+@lru_cache
+def configure_genai():
+    """Configures the Gemini SDK the first time a model is needed"""
+    genai.configure(api_key=get_env().GOOGLE_API_KEY)
+
+
+def trace_client(client):
+    """Record each attempt and validation retry on the span of the model call"""
+    client.on("completion:kwargs", lambda *args, **kwargs: tracing.add_event("attempt"))
+    client.on(
+        "parse:error",
+        lambda error: tracing.add_event("validation_error", error=str(error)),
+    )
+    return client
+
+
+@lru_cache
+def get_async_client():
+    """
+    The plain model's client is shared by every story on the worker, so they
+    all reuse its connection to Gemini
+    """
+    configure_genai()
+    return trace_client(
+        instructor.from_gemini(genai.GenerativeModel(MODEL_NAME), use_async=True)
+    )
 
 
 class StoryOutline(BaseModel):
@@ -30,12 +72,35 @@ class StoryNode(BaseModel):
     @field_validator("user_choices")
     def validate_user_choices(cls, v, info: ValidationInfo):
         context = info.context
-        if len(v) != 2 and context["remaining_turns"] > 0:
-            raise ValueError("Only provide two choices to the user")
+        # Without a context we don't know how far into the story the node is
+        if context is None:
+            return v
+
+        choices = context.get("choices", BRANCHING)
+        if len(v) != choices and context["remaining_turns"] > 0:
+            raise ValueError(f"Only provide {choices} choices to the user")
 
         if len(v) == 0 and context["remaining_turns"] != 0:
             raise ValueError(
-                "You must provide two choices for the user to advance the story"
+                f"You must provide {choices} choices for the user to advance the story"
+            )
+
+        return v
+
+
+class StoryBranch(StoryNode):
+    path: str
+
+
+class StoryLevel(BaseModel):
+    branches: list[StoryBranch]
+
+    @field_validator("branches")
+    def validate_branches(cls, v, info: ValidationInfo):
+        expected = sorted(info.context["paths"])
+        if sorted(branch.path for branch in v) != expected:
+            raise ValueError(
+                f"Provide exactly one continuation for each of these paths: {', '.join(expected)}"
             )
 
         return v
@@ -59,13 +124,95 @@ class FinalStoryNode(BaseModel):
     is_terminal: bool
 
 
+class Branch(BaseModel):
+    """A node that hasn't been generated yet and the choices that lead to it"""
+
+    path: str
+    node_id: str
+    parent_id: str
+    user_choices: list[dict]
+
+    @property
+    def depth(self) -> int:
+        return len(self.user_choices)
+
+    @field_validator("user_choices")
+    def validate_user_choices(cls, v):
+        # Choices come back as plain dicts once they've been through the journal
+        return [{**c, "choice": UserChoice.model_validate(c["choice"])} for c in v]
+
+
 class StoryNodes(BaseModel):
     nodes: list[FinalStoryNode]
+    # Branches below the generated levels, which are expanded on demand
+    frontier: list[Branch] = []
+    # Prompt tokens the story's context cache saved us from resending
+    cached_tokens_saved: int = 0
+
 
+def get_root_node_id(story_id: str) -> str:
+    return str(uuid.uuid5(uuid.UUID(story_id), "root"))
 
-def generate_story(prompt: str) -> str:
-    client = instructor.from_gemini(genai.GenerativeModel("gemini-2.0-flash-exp"))
-    return client.chat.completions.create(
+
+def get_child_node_id(parent_id: str, index: int) -> str:
+    return str(uuid.uuid5(uuid.UUID(parent_id), str(index)))
+
+
+def get_node_count(max_depth: int, branching: int = BRANCHING) -> int:
+    """The number of nodes in a full tree of this shape"""
+    return (branching ** (max_depth + 1) - 1) // (branching - 1)
+
+
+def get_story_node_ids(
+    story_id: str, max_depth: int = MAX_DEPTH, branching: int = BRANCHING
+) -> list[str]:
+    """
+    Node ids are derived from the story id and each node's position in the
+    tree, so we know every id before the tree has been generated and a
+    retried generation writes to the same ids.
+    """
+    level = [get_root_node_id(story_id)]
+    node_ids = list(level)
+    for _ in range(max_depth):
+        level = [
+            get_child_node_id(parent, i) for parent in level for i in range(branching)
+        ]
+        node_ids.extend(level)
+    return node_ids
+
+
+def get_path_node_ids(story_id: str, path: str) -> list[str]:
+    """The ids of every node from the root down to the node at `path`, e.g. 1.2.1"""
+    node_ids = [get_root_node_id(story_id)]
+    for index in path.split(".")[1:]:
+        node_ids.append(get_child_node_id(node_ids[-1], int(index) - 1))
+    return node_ids
+
+
+def get_expansion(
+    story_id: str, frontier: list[Branch], node_id: str, lookahead: int
+) -> tuple[list[Branch], int | None]:
+    """
+    The branches to generate once a player reaches `node_id` so that the
+    tree below them is `lookahead` levels deep, and the depth to stop at.
+    """
+    targets, depth = [], None
+    for branch in frontier:
+        path_ids = get_path_node_ids(story_id, branch.path)
+        if node_id not in path_ids:
+            continue
+        depth = path_ids.index(node_id)
+        if branch.depth <= depth + lookahead:
+            targets.append(branch)
+
+    return targets, None if depth is None else depth + lookahead
+
+
+@tracing.traced("gemini.generate_story", model=MODEL_NAME)
+async def generate_story(prompt: str, priority: Priority = "interactive") -> StoryOutline:
+    # The first call imports the SDK, which shouldn't block the event loop
+    client = get_gateway().client(await to_thread(get_async_client), priority)
+    return await client.chat.completions.create(
         response_model=StoryOutline,
         messages=[
             {
@@ -109,255 +256,431 @@ def generate_story(prompt: str) -> str:
     )
 
 
+def to_final_node(
+    choices: StoryNode,
+    node_id: str,
+    parent_id: str | None,
+    user_choices: list[dict],
+    is_terminal: bool,
+) -> FinalStoryNode:
+    return FinalStoryNode(
+        id=node_id,
+        parent_id=parent_id,
+        title=choices.title,
+        description=choices.story_description,
+        image_description=choices.banner_image_description,
+        is_terminal=is_terminal,
+        choice_title="Start"
+        if len(user_choices) == 0
+        else user_choices[-1]["choice"].choice_title,
+        choice_description="Start the story"
+        if len(user_choices) == 0
+        else user_choices[-1]["choice"].choice_description,
+    )
+
+
+def extend_user_choices(
+    user_choices: list[dict], choices: StoryNode, choice: UserChoice
+) -> list[dict]:
+    return user_choices + [
+        {
+            "choice": choice,
+            "options": [
+                {
+                    "title": option.choice_title,
+                    "description": option.choice_description,
+                }
+                for option in choices.user_choices
+            ],
+            "context": choices.story_description,
+        }
+    ]
+
+
+def get_child_branches(
+    node: FinalStoryNode, choices: StoryNode, user_choices: list[dict], path: str
+) -> list[dict]:
+    return [
+        {
+            "path": f"{path}.{index + 1}",
+            "node_id": get_child_node_id(node.id, index),
+            "parent_id": node.id,
+            "user_choices": extend_user_choices(user_choices, choices, choice),
+        }
+        for index, choice in enumerate(choices.user_choices)
+    ]
+
+
 async def generate_choices(
-    client: instructor.AsyncInstructor,
-    title: str,
-    description: str,
+    client: GatewayClient,
+    prompt: StoryPrompt,
     user_choices: list[dict],
     max_depth: int,
     semaphore: Semaphore,
     parent_id: str | None,
+    node_id: str | None = None,
+    branching: int = BRANCHING,
+    stop_depth: int | None = None,
+    frontier: list[dict] | None = None,
+    path: str = "1",
 ) -> list[FinalStoryNode]:
-    async with semaphore:
-        is_terminal = max_depth - len(user_choices) == 0
+    """
+    Generate a node and the subtree below it, depth first. Nodes deeper than
+    `stop_depth` are left as branches in `frontier` instead of generated.
+    """
+    depth = len(user_choices)
+    is_terminal = max_depth - depth == 0
+
+    # Only the call holds a slot. A parent that held one while waiting on
+    # its children would starve them once the inner nodes filled the pool.
+    async with tracing.acquire(semaphore):
+        with tracing.span("gemini.generate_choices", model=MODEL_NAME, depth=depth):
+            choices: StoryNode = await client.chat.completions.create(
+                response_model=StoryNode,
+                messages=prompt.continuation(user_choices, max_depth - depth, branching),
+                context={
+                    "remaining_turns": max_depth - depth,
+                    "choices": branching,
+                },
+            )
 
-        choices: StoryNode = await client.chat.completions.create(
-            response_model=StoryNode,
-            messages=[
-                {
-                    "role": "system",
-                    "content": """
-Continue the story where we last left off. You'll be given the outline of the story, previous choices made by the user and the remaining turns.
-
-<story>
-<title>
-{{ story_title }}
-</title>
-<description>
-{{ story_description }}
-</description>
-
-</story>
-
-These are the previous choices made by the user:
-<previous choices>
-{% for choice in previous_choices %}
-<choice {{loop.index}}>
-Choice Context: {{ choice.story_context }}
-Options: {% for option in choice.choices %}
-    <option {{loop.index}}>
-    Title: {{ option.title }}
-    Description: {{ option.description }}
-    </option>
-{% endfor %}
-User Chose: {{ choice.choice.choice_title }}
-</choice>
-{% endfor %}
-</previous choices>
-
-{% if remaining_turns == 0 %}
-Based on the outline above, generate the following:
-
-- A conclusion of the story that's between 3-5 sentences. Make sure to tie up all loose ends where possible and provide a satisfying conclusion to the story. This should not be too far off in the future from the previous choices made by the user. 
-- There should be no choices for the user to make at this point in the story.
-- A image description of about 15 words that's suitable for the story as cover art. This should be in a pixel art and retro 8-bit style. Mention specific details of the image in the description.
-
-{% else %}
-Based on the outline above, generate the following:
-- A 3-4 sentence description of what happens next in the story based off previous user choices. If there are no previous user choices, make sure that you set the scene for the first choice explicitly and introduce the main character.
-- Two distinct choices for the user to make that will meaningfully impact how the story continues. Each choice title must be distinct from each other.
-- The choice title should be a single sentence that describes the user's choice. The description of the choice here should be around 2 sentences.
-- A description for an image that's suitable for this story at this point. Make sure to mention specific details of the image in the description.
-{% endif %}
-
-<bad image description>
-Pixel art of Kai walking through a dense forest, looking weary, with a village in the distance.
-</bad image description>
-
-<good image description>
-A lone martial artist stands silhouetted against a fiery sunset, pixel art style, orange and red hues dominate the sky.
-
-A brave knight faces a towering dragon, 8-bit pixel art, vibrant blues and greens with dark castle silhouette in background.
-
-A mysterious wizard casting spells in a moonlit forest clearing, pixel art style with purple and blue color palette, glowing magical particles.
-
-A space explorer on an alien planet with two suns, retro pixel art, teal and pink landscape with strange crystalline formations.
-
-A pirate ship sailing through a storm, 8-bit pixel art, deep blues and whites with lightning flashes illuminating the choppy waves.
-</good image description>
-
-A good description will be specific, include details about how the image should look like in terms of just pure visual elements. Examples of these are the style, the colors, individual components of the image and the background.
-
-Make sure to provide specific details about the image, the colours, the style and the individual components of the image. We want something that has a strong 8 bit pixel art style.
-                    """,
+    res = [
+        to_final_node(
+            choices, node_id or str(uuid.uuid4()), parent_id, user_choices, is_terminal
+        )
+    ]
+
+    if is_terminal:
+        return res
+
+    children = get_child_branches(res[0], choices, user_choices, path)
+    if stop_depth is not None and depth >= stop_depth:
+        frontier.extend(children)
+        return res
+
+    coros = [
+        generate_choices(
+            client,
+            prompt,
+            child["user_choices"],
+            max_depth,
+            semaphore,
+            parent_id=child["parent_id"],
+            node_id=child["node_id"],
+            branching=branching,
+            stop_depth=stop_depth,
+            frontier=frontier,
+            path=child["path"],
+        )
+        for child in children
+    ]
+
+    for subtree in await gather(*coros):
+        res.extend(subtree)
+    return res
+
+
+async def generate_level(
+    client: GatewayClient,
+    prompt: StoryPrompt,
+    branches: list[dict],
+    remaining_turns: int,
+    semaphore: Semaphore,
+    branching: int = BRANCHING,
+) -> dict[str, StoryNode]:
+    """
+    Continue every branch of a single tree level in one structured call.
+    Each branch is validated exactly like a node from `generate_choices`.
+    """
+    async with tracing.acquire(semaphore):
+        with tracing.span(
+            "gemini.generate_level", model=MODEL_NAME, branches=len(branches)
+        ):
+            level: StoryLevel = await client.chat.completions.create(
+                response_model=StoryLevel,
+                messages=prompt.level(branches, remaining_turns, branching),
+                context={
+                    "paths": [branch["path"] for branch in branches],
+                    "remaining_turns": remaining_turns,
+                    "choices": branching,
                 },
-            ],
-            context={
-                "story_title": title,
-                "story_description": description,
-                "previous_choices": user_choices,
-                "remaining_turns": max_depth - len(user_choices),
-            },
+            )
+
+        return {branch.path: branch for branch in level.branches}
+
+
+async def generate_choices_by_level(
+    client: GatewayClient,
+    prompt: StoryPrompt,
+    max_depth: int,
+    semaphore: Semaphore,
+    node_id: str | None = None,
+    batch_size: int = LEVEL_BATCH_SIZE,
+    branching: int = BRANCHING,
+    stop_depth: int | None = None,
+    frontier: list[dict] | None = None,
+    branches: list[dict] | None = None,
+) -> list[FinalStoryNode]:
+    """
+    Generate the story tree breadth first, continuing up to `batch_size`
+    sibling branches per call instead of making one call per node. Starts
+    from the root unless we're given `branches` to continue.
+    """
+
+    async def expand(batch: list[dict], remaining_turns: int):
+        continuations = await generate_level(
+            client, prompt, batch, remaining_turns, semaphore, branching
         )
 
-        res = [
-            FinalStoryNode(
-                id=str(uuid.uuid4()),
-                parent_id=parent_id,
-                title=choices.title,
-                description=choices.story_description,
-                image_description=choices.banner_image_description,
-                is_terminal=is_terminal,
-                choice_title="Start"
-                if len(user_choices) == 0
-                else user_choices[-1]["choice"].choice_title,
-                choice_description="Start the story"
-                if len(user_choices) == 0
-                else user_choices[-1]["choice"].choice_description,
+        nodes, children = [], []
+        for branch in batch:
+            choices = continuations[branch["path"]]
+            node = to_final_node(
+                choices,
+                branch["node_id"],
+                branch["parent_id"],
+                branch["user_choices"],
+                remaining_turns == 0,
+            )
+            nodes.append(node)
+
+            if remaining_turns == 0:
+                continue
+
+            below = get_child_branches(
+                node, choices, branch["user_choices"], branch["path"]
             )
+            if stop_depth is not None and max_depth - remaining_turns >= stop_depth:
+                frontier.extend(below)
+            else:
+                children.extend(below)
+
+        return nodes, children
+
+    pending = branches or [
+        {
+            "path": "1",
+            "node_id": node_id or str(uuid.uuid4()),
+            "parent_id": None,
+            "user_choices": [],
+        }
+    ]
+    res = []
+    while pending:
+        # Branches we're asked to continue aren't necessarily all on one level
+        levels: dict[int, list[dict]] = {}
+        for branch in pending:
+            levels.setdefault(len(branch["user_choices"]), []).append(branch)
+
+        batches = [
+            (group[i : i + batch_size], max_depth - depth)
+            for depth, group in sorted(levels.items())
+            for i in range(0, len(group), batch_size)
         ]
+        expanded = await gather(
+            *[expand(batch, remaining_turns) for batch, remaining_turns in batches]
+        )
 
-        if is_terminal:
-            return res
+        pending = []
+        for nodes, children in expanded:
+            res.extend(nodes)
+            pending.extend(children)
+
+    return res
+
+
+async def generate_story_choices(
+    story: StoryOutline,
+    story_id: str | None = None,
+    batch_levels: bool = False,
+    priority: Priority = "interactive",
+    max_depth: int = MAX_DEPTH,
+    branching: int = BRANCHING,
+    stop_depth: int | None = None,
+    branches: list[Branch] | None = None,
+    prompt_cache: str | None = None,
+) -> StoryNodes:
+    """
+    Generate the story tree, or just the subtrees below `branches` when
+    we're expanding part of an existing tree. Levels below `stop_depth` are
+    returned as the frontier instead of generated. `prompt_cache` is the
+    name of the story's cached prompt prefix, from `create_prompt_cache`.
+    """
+    # Bounds the fan out of a single tree, the gateway bounds the worker
+    sem = Semaphore(50)
+    prompt = StoryPrompt(story.title, story.description)
+    # The first call imports the SDK, which shouldn't block the event loop
+    await to_thread(configure_genai)
+    model = await to_thread(prompt.get_model, MODEL_NAME, prompt_cache)
+    # A story's cached prompt is its own model, anything else shares a client
+    if prompt.cache is not None:
+        client = trace_client(instructor.from_gemini(model, use_async=True))
+    else:
+        client = await to_thread(get_async_client)
+    client = get_gateway().client(client, priority)
+    root_id = get_root_node_id(story_id) if story_id else None
+    # Plain dicts keep each choice as a UserChoice for the prompt templates
+    starts = [dict(branch) for branch in branches] if branches else None
+    frontier = []
 
-        coros = [
-            generate_choices(
+    try:
+        if batch_levels:
+            final_nodes = await generate_choices_by_level(
                 client,
-                title,
-                description,
-                user_choices
-                + [
-                    {
-                        "choice": choice,
-                        "options": [
-                            {
-                                "title": choice.choice_title,
-                                "description": choice.choice_description,
-                            }
-                            for choice in choices.user_choices
-                        ],
-                        "context": choices.story_description,
-                    }
-                ],
+                prompt,
                 max_depth,
-                semaphore,
-                parent_id=res[0].id,
+                sem,
+                node_id=root_id,
+                branching=branching,
+                stop_depth=stop_depth,
+                frontier=frontier,
+                branches=starts,
             )
-            for choice in choices.user_choices
-        ]
-
-        children = await gather(*coros)
-        for child in children:
-            res.extend(child)
-        return res
+        elif starts:
+            final_nodes = []
+            subtrees = await gather(
+                *[
+                    generate_choices(
+                        client,
+                        prompt,
+                        start["user_choices"],
+                        max_depth,
+                        sem,
+                        start["parent_id"],
+                        node_id=start["node_id"],
+                        branching=branching,
+                        stop_depth=stop_depth,
+                        frontier=frontier,
+                        path=start["path"],
+                    )
+                    for start in starts
+                ]
+            )
+            for subtree in subtrees:
+                final_nodes.extend(subtree)
+        else:
+            final_nodes = await generate_choices(
+                client,
+                prompt,
+                [],
+                max_depth,
+                sem,
+                None,
+                node_id=root_id,
+                branching=branching,
+                stop_depth=stop_depth,
+                frontier=frontier,
+            )
+    finally:
+        get_gateway().record_cached_tokens(prompt.tokens_saved)
 
+    print(f"Final Nodes: {len(final_nodes)}, frontier: {len(frontier)}")
 
-async def generate_story_choices(story: StoryOutline):
-    sem = Semaphore(50)
-    client = instructor.from_gemini(
-        genai.GenerativeModel("gemini-2.0-flash-exp"), use_async=True
+    return StoryNodes(
+        nodes=final_nodes,
+        frontier=[Branch.model_validate(branch) for branch in frontier],
+        cached_tokens_saved=prompt.tokens_saved,
     )
-    final_nodes = await generate_choices(
-        client, story.title, story.description, [], 3, sem, None
+
+
+async def create_prompt_cache(story: StoryOutline) -> str | None:
+    """
+    Uploads the story's prompt prefix once, for every level of the story to
+    reuse. Returns the name of the cached content, if it could be created.
+    """
+    settings = get_env()
+    prompt = StoryPrompt(story.title, story.description)
+    await to_thread(configure_genai)
+    return await to_thread(
+        prompt.create_cache,
+        MODEL_NAME,
+        timedelta(seconds=settings.PROMPT_CACHE_TTL_SECONDS),
+        settings.PROMPT_CACHE_MIN_TOKENS,
     )
 
-    print(f"Final Nodes: {len(final_nodes)}")
 
-    return StoryNodes(nodes=final_nodes)
+async def delete_prompt_cache(cache_name: str):
+    await to_thread(configure_genai)
+    await to_thread(delete_cache, cache_name)
+
+
+def get_callback_payload(awakeable_id: str | None) -> dict:
+    """
+    Build the callback fields a media service uses to resolve the workflow's
+    awakeable for an asset once it has been uploaded to S3.
+    """
+    if awakeable_id is None:
+        return {}
+
+    env = get_env()
+    return {
+        "callback_url": f"{env.RESTATE_INGRESS_URL}/restate/awakeables/{awakeable_id}/resolve",
+        "callback_token": env.RESTATE_INGRESS_TOKEN,
+    }
 
 
 async def generate_images(
     choices: list[FinalStoryNode],
     story_id: str,
-    banner_image_description: str,
-):
-    try:
-        import asyncio
-        import aiohttp
-
-        async def send_request(session, request_data):
-            try:
-                async with session.post(
-                    Env().IMAGE_ENDPOINT, json=request_data, timeout=1.0
-                ) as response:
-                    return await response.text()
-            except asyncio.TimeoutError:
-                return None
-            except Exception as e:
-                print(f"Failed to send request: {e}")
-                return None
-
-        # Prepare requests for each node and banner
-        requests_data = [
-            {
-                "prompt": node.image_description,
-                "node_id": node.id,
-                "story_id": story_id,
-            }
-            for node in choices
-        ]
+    banner_image_description: str | None,
+    callbacks: dict[str, str] | None = None,
+) -> DispatchReport:
+    # Prepare requests for each node and banner
+    callbacks = callbacks or {}
+    requests_data = [
+        {
+            "prompt": node.image_description,
+            "node_id": node.id,
+            "story_id": story_id,
+            **get_callback_payload(callbacks.get(node.id)),
+        }
+        for node in choices
+    ]
 
-        # Add banner request
+    # Add banner request
+    if banner_image_description is not None:
         requests_data.append(
             {
                 "story_id": story_id,
                 "node_id": "banner",
                 "prompt": banner_image_description,
+                **get_callback_payload(callbacks.get("banner")),
             }
         )
 
-        # Send all requests concurrently
-        async with aiohttp.ClientSession() as session:
-            tasks = [send_request(session, data) for data in requests_data]
-            await asyncio.gather(*tasks)
-
-        return "Success"
-
-    except Exception as e:
-        print(e)
-        raise e
+    return await get_dispatcher("images").dispatch(requests_data)
 
 
 async def generate_tts(
-    nodes: list[FinalStoryNode], story_id: str, story_description: str
-):
-    import asyncio
-    import aiohttp
-
-    async def send_request(session, request_data):
-        try:
-            async with session.post(
-                Env().KOKORO_ENDPOINT, json=request_data, timeout=1.0
-            ) as response:
-                return await response.text()
-        except asyncio.TimeoutError:
-            return None
-        except Exception as e:
-            print(f"Failed to send request: {e}")
-            return None
-
+    nodes: list[FinalStoryNode],
+    story_id: str,
+    story_description: str | None,
+    callbacks: dict[str, str] | None = None,
+) -> DispatchReport:
     # Prepare requests for each node and banner
+    callbacks = callbacks or {}
     requests_data = [
         {
             "prompt": node.description,
             "node_id": node.id,
             "story_id": story_id,
+            **get_callback_payload(callbacks.get(node.id)),
         }
         for node in nodes
     ]
 
-    # Add banner request
-    requests_data.append(
-        {
-            "story_id": story_id,
-            "node_id": "theme",
-            "prompt": story_description,
-        }
-    )
-
-    # Send all requests concurrently
-    async with aiohttp.ClientSession() as session:
-        tasks = [send_request(session, data) for data in requests_data]
-        await asyncio.gather(*tasks)
+    # Add theme request
+    if story_description is not None:
+        requests_data.append(
+            {
+                "story_id": story_id,
+                "node_id": "theme",
+                "prompt": story_description,
+                **get_callback_payload(callbacks.get("theme")),
+            }
+        )
 
-    return "Success"
+    dispatcher = get_dispatcher("audio")
+    if dispatcher.batch_endpoint:
+        return await dispatcher.dispatch_batch(requests_data)
+    return await dispatcher.dispatch(requests_data)
@@ -0,0 +1,275 @@
+import functools
+import inspect
+import json
+import secrets
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
+from typing import Callable, TypeVar
+from urllib import request
+
+from helpers.env import get_env
+
+T = TypeVar("T")
+
+# Trace ids are derived from the workflow id, so a workflow that is replayed
+# after suspending keeps adding its spans to the same trace
+TRACE_NAMESPACE = uuid.UUID("5b1f9f7e-8d0c-4c55-9a43-1f6a0f1f7b6e")
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int | None = None
+    attributes: dict = field(default_factory=dict)
+    events: list[dict] = field(default_factory=list)
+    error: str | None = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes):
+        self.events.append(
+            {"name": name, "time_ns": time.time_ns(), "attributes": attributes}
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "events": self.events,
+            "error": self.error,
+        }
+
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def record(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_current_span: ContextVar[Span | None] = ContextVar("span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a block as a child of the current span. Outside of a trace the span
+    is still handed out but never recorded.
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    current = Span(
+        trace_id=trace.trace_id if trace else "",
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent else None,
+        name=name,
+        attributes=attributes,
+    )
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if trace is not None:
+            trace.record(current)
+
+
+def traced(name: str, **attributes):
+    """Decorator that runs every call of a function in its own span"""
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attributes):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@asynccontextmanager
+async def acquire(semaphore, name: str = "semaphore.wait"):
+    """Hold a semaphore, recording how long we queued for it"""
+    with span(name):
+        await semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def add_event(name: str, **attributes):
+    current = _current_span.get()
+    if current is not None:
+        current.add_event(name, **attributes)
+
+
+def set_attribute(key: str, value):
+    current = _current_span.get()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def bind(fn: Callable[..., T]) -> Callable[..., T]:
+    """
+    Carry the caller's trace over to `fn` when it runs on another thread.
+    Executor threads don't inherit context variables the way tasks do.
+    """
+    context = copy_context()
+
+    def bound(*args, **kwargs) -> T:
+        return context.copy().run(fn, *args, **kwargs)
+
+    return bound
+
+
+@contextmanager
+def trace(name: str, key: str | None = None, **attributes):
+    """Start a new trace with a root span, exporting its spans at the end"""
+    trace_id = uuid.uuid5(TRACE_NAMESPACE, key).hex if key else secrets.token_hex(16)
+    current = Trace(trace_id)
+    trace_token = _current_trace.set(current)
+    span_token = _current_span.set(None)
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        export(current.spans)
+
+
+def export(spans: list[Span]):
+    settings = get_env()
+    if settings.TRACE_EXPORTER == "none" or not spans:
+        return
+
+    exporter = export_file if settings.TRACE_EXPORTER == "file" else export_otlp
+    # Exporting shouldn't hold up the workflow that produced the spans
+    threading.Thread(target=exporter, args=(spans,), daemon=True).start()
+
+
+_file_lock = threading.Lock()
+
+
+def export_file(spans: list[Span]):
+    """Append every span to the trace file as a line of JSON"""
+    try:
+        with _file_lock, open(get_env().TRACE_FILE, "a") as f:
+            for s in spans:
+                f.write(json.dumps(s.to_dict(), default=str) + "\n")
+    except Exception as e:
+        print(f"Failed to export {len(spans)} spans: {e}")
+
+
+def to_otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp_attributes(attributes: dict) -> list[dict]:
+    return [
+        {"key": key, "value": to_otlp_value(value)} for key, value in attributes.items()
+    ]
+
+
+def to_otlp(spans: list[Span]) -> dict:
+    """Spans in the OTLP/HTTP JSON encoding"""
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": to_otlp_attributes({"service.name": "cyoa-restate"})
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "cyoa"},
+                        "spans": [
+                            {
+                                "traceId": s.trace_id,
+                                "spanId": s.span_id,
+                                "parentSpanId": s.parent_id or "",
+                                "name": s.name,
+                                "kind": 1,
+                                "startTimeUnixNano": str(s.start_ns),
+                                "endTimeUnixNano": str(s.end_ns),
+                                "attributes": to_otlp_attributes(s.attributes),
+                                "events": [
+                                    {
+                                        "name": event["name"],
+                                        "timeUnixNano": str(event["time_ns"]),
+                                        "attributes": to_otlp_attributes(
+                                            event["attributes"]
+                                        ),
+                                    }
+                                    for event in s.events
+                                ],
+                                "status": {"code": 2, "message": s.error}
+                                if s.error
+                                else {"code": 1},
+                            }
+                            for s in spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def export_otlp(spans: list[Span]):
+    """Send every span to an OTLP/HTTP collector"""
+    try:
+        req = request.Request(
+            get_env().TRACE_OTLP_ENDPOINT,
+            data=json.dumps(to_otlp(spans)).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with request.urlopen(req, timeout=10) as response:
+            response.read()
+    except Exception as e:
+        print(f"Failed to export {len(spans)} spans: {e}")
@@ -1,28 +1,96 @@
-from helpers.db import DatabaseClient
-from helpers.s3 import get_story_items
+from helpers import cache
+from helpers.cache import get_prompt_key
+from helpers.db import AsyncDatabaseClient, InsertResult
+from helpers.dispatch import DeadLetter, DispatchReport
+from helpers.env import get_env
+from helpers.llm import Priority, llm_gateway
+from helpers import tracing
+from helpers.s3 import StoryAssets, copy_story_assets, get_missing_assets
 from helpers.story import (
+    BRANCHING,
+    MAX_DEPTH,
+    MAX_STORY_NODES,
+    MODEL_NAME,
+    Branch,
+    FinalStoryNode,
     generate_images,
     generate_story,
+    generate_story_choices,
+    create_prompt_cache,
+    delete_prompt_cache,
     StoryOutline,
     StoryNodes,
-    generate_story_choices,
+    get_expansion,
+    get_node_count,
+    get_story_node_ids,
     generate_tts,
 )
 from datetime import timedelta
+import asyncio
+import inspect
+import uuid
 from rich import print
 import restate
-from restate import Workflow, WorkflowContext
+from restate import (
+    ObjectContext,
+    RestateDurableFuture,
+    VirtualObject,
+    Workflow,
+    WorkflowContext,
+)
 from restate.exceptions import TerminalError
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
 from restate.serde import PydanticJsonSerde
 import time
 
 story_workflow = Workflow("cyoa")
 
+# Keyed by story id. Holds the branches of an incrementally generated story
+# that are still to be generated, and expands them as the player advances.
+story_tree = VirtualObject("story_tree")
+
 
 class StoryInput(BaseModel):
     prompt: str
     user_email: str
+    # Interactive stories are admitted to the LLM gateway ahead of bulk jobs
+    priority: Priority = "interactive"
+    max_depth: int = Field(default=MAX_DEPTH, ge=1)
+    branching: int = Field(default=BRANCHING, ge=2)
+    # Levels generated ahead of the player. Without it, or when it covers the
+    # whole tree, every level is generated up front.
+    lookahead: int | None = Field(default=None, ge=1)
+
+    @model_validator(mode="after")
+    def validate_tree_size(self):
+        # Depth and branching compound, so they're bounded together. An
+        # incremental story only generates `lookahead` levels up front, and
+        # each expansion at most `lookahead` levels below the player, so
+        # that's the shape which is bounded rather than the whole tree.
+        depth = self.lookahead if self.incremental else self.max_depth
+        nodes = get_node_count(depth, self.branching)
+        if nodes > MAX_STORY_NODES:
+            raise ValueError(
+                f"Generating {depth} levels with {self.branching} choices per node "
+                f"takes {nodes} nodes at once, the most we generate is {MAX_STORY_NODES}"
+            )
+        return self
+
+    @property
+    def incremental(self) -> bool:
+        return self.lookahead is not None and self.lookahead < self.max_depth
+
+
+class ExpandInput(BaseModel):
+    node_id: str
+    # Only the owner's visits count towards their progress, but anyone
+    # playing a public story needs the branches ahead of them generated
+    mark_explored: bool = True
+
+
+class StoryChoices(StoryNodes):
+    # Media jobs that never reached their endpoint, so their assets won't arrive
+    dead_letters: list[DeadLetter] = []
 
 
 def wrap_async_call(coro_fn, *args, **kwargs):
@@ -37,16 +105,244 @@ def wrap_async_call(coro_fn, *args, **kwargs):
     return wrapped
 
 
-@story_workflow.main()
-async def run(ctx: WorkflowContext, req: StoryInput) -> str:
-    print(f"Recieved request: {req}")
-    db = DatabaseClient()
+async def run_step(ctx: WorkflowContext, name: str, action, **kwargs):
+    """ctx.run with the action traced as a span named after the step"""
+
+    async def traced():
+        with tracing.span(name, step=True):
+            result = action()
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+
+    return await ctx.run(name, traced, **kwargs)
+
+
+async def dispatch_media(
+    nodes: list[FinalStoryNode],
+    story_id: str,
+    image_callbacks: dict[str, str],
+    audio_callbacks: dict[str, str],
+    story: StoryOutline | None = None,
+) -> DispatchReport:
+    """
+    Dispatch the image and audio jobs of these nodes, along with the
+    story's banner and theme when we're given the story.
+    """
+    reports = await asyncio.gather(
+        generate_images(
+            nodes, story_id, story.banner_image if story else None, image_callbacks
+        ),
+        generate_tts(
+            nodes, story_id, story.description if story else None, audio_callbacks
+        ),
+    )
+    return reports[0].merge(reports[1])
+
+
+async def generate_choices_and_media(
+    ctx: WorkflowContext | ObjectContext,
+    story: StoryOutline,
+    story_id: str,
+    image_callbacks: dict[str, str],
+    audio_callbacks: dict[str, str],
+    batch_levels: bool = False,
+    priority: Priority = "interactive",
+    max_depth: int = MAX_DEPTH,
+    branching: int = BRANCHING,
+    stop_depth: int | None = None,
+    branches: list[Branch] | None = None,
+) -> StoryChoices:
+    """
+    Generate the story tree a level at a time and dispatch the image and
+    audio jobs of each level as soon as it has been journaled, so the GPUs
+    are busy while the rest of the tree is still being written. A failure
+    only retries the level it happened on, and a replay never regenerates or
+    re-dispatches a level that has already been journaled. Jobs that
+    couldn't be delivered are returned alongside the tree.
+
+    With `branches` only the subtrees below them are generated, and the
+    story's banner and theme are left alone.
+    """
+    # The story's prompt prefix is cached once and reused by every level.
+    # A failed generation leaves it to expire with its TTL.
+    prompt_cache = None
+    if get_env().PROMPT_CACHE:
+        prompt_cache = await run_step(
+            ctx, "Create Prompt Cache", wrap_async_call(create_prompt_cache, story)
+        )
+
+    report = DispatchReport()
+    if branches is None:
+        report = await run_step(
+            ctx,
+            "Dispatch Story Media",
+            wrap_async_call(
+                dispatch_media, [], story_id, image_callbacks, audio_callbacks, story
+            ),
+            serde=PydanticJsonSerde(DispatchReport),
+        )
+
+    async def journal_level(depth: int, level: list[Branch] | None) -> StoryNodes:
+        generated: StoryNodes = await run_step(
+            ctx,
+            f"Generate Story Level {depth}",
+            wrap_async_call(
+                generate_story_choices,
+                story,
+                story_id,
+                batch_levels=batch_levels,
+                priority=priority,
+                max_depth=max_depth,
+                branching=branching,
+                stop_depth=depth,
+                branches=level,
+                prompt_cache=prompt_cache,
+            ),
+            serde=PydanticJsonSerde(StoryNodes),
+        )
+        dispatched: DispatchReport = await run_step(
+            ctx,
+            f"Dispatch Story Level {depth}",
+            wrap_async_call(
+                dispatch_media,
+                generated.nodes,
+                story_id,
+                image_callbacks,
+                audio_callbacks,
+            ),
+            serde=PydanticJsonSerde(DispatchReport),
+        )
+        nonlocal report, cached_tokens_saved
+        report = report.merge(dispatched)
+        cached_tokens_saved += generated.cached_tokens_saved
+        return generated
 
+    nodes, frontier = [], []
+    cached_tokens_saved = 0
+    pending = list(branches or [])
+    if branches is None:
+        root = await journal_level(0, None)
+        nodes.extend(root.nodes)
+        pending = root.frontier
+
+    while pending:
+        # Branches we're asked to continue aren't necessarily all on one level
+        depth = min(branch.depth for branch in pending)
+        if stop_depth is not None and depth > stop_depth:
+            frontier.extend(pending)
+            break
+
+        level = [branch for branch in pending if branch.depth == depth]
+        generated = await journal_level(depth, level)
+        nodes.extend(generated.nodes)
+        pending = [branch for branch in pending if branch.depth != depth]
+        pending.extend(generated.frontier)
+
+    if prompt_cache is not None:
+        await run_step(
+            ctx,
+            "Delete Prompt Cache",
+            wrap_async_call(delete_prompt_cache, prompt_cache),
+        )
+    tracing.set_attribute("prompt_cache.tokens_saved", cached_tokens_saved)
+    print(f"Prompt cache saved {cached_tokens_saved} tokens for story {story_id}")
+
+    return StoryChoices(
+        nodes=nodes,
+        frontier=frontier,
+        dead_letters=report.dead_letters,
+        cached_tokens_saved=cached_tokens_saved,
+    )
+
+
+async def wait_for_asset_signals(
+    ctx: WorkflowContext,
+    image_signals: dict[str, RestateDurableFuture],
+    audio_signals: dict[str, RestateDurableFuture],
+    timeout: timedelta,
+) -> tuple[set[str], set[str]]:
+    """
+    Wait for the media services to resolve the awakeable of every asset.
+
+    Returns the images and audio that have not reported in once the
+    deadline has passed.
+    """
+    deadline = ctx.sleep(timeout)
+    pending = {("images", k): v for k, v in image_signals.items()} | {
+        ("audio", k): v for k, v in audio_signals.items()
+    }
+
+    while pending:
+        done, _ = await restate.wait_completed(deadline, *pending.values())
+        if deadline in done:
+            break
+        pending = {k: v for k, v in pending.items() if v not in done}
+        print(f"{len(pending)} assets remaining")
+
+    return (
+        {node_id for kind, node_id in pending if kind == "images"},
+        {node_id for kind, node_id in pending if kind == "audio"},
+    )
+
+
+async def poll_for_assets(
+    ctx: WorkflowContext,
+    story_id: str,
+    expected_images: set[str],
+    expected_audio: set[str],
+    timeout: timedelta,
+) -> tuple[set[str], set[str]]:
+    """
+    Poll our S3 bucket with exponential backoff until every asset exists or
+    the timeout has elapsed. The bucket is always checked at least once, and
+    each check only looks for the assets that were still missing.
+    """
+    settings = get_env()
+    interval = timedelta(seconds=settings.POLL_INITIAL_INTERVAL_SECONDS)
+    max_interval = timedelta(seconds=settings.POLL_MAX_INTERVAL_SECONDS)
+    waited = timedelta()
+    iterations = 0
+    remaining_images, remaining_audio = expected_images, expected_audio
+
+    while True:
+        missing: StoryAssets = await run_step(
+            ctx,
+            "Get Story Images",
+            lambda: get_missing_assets(story_id, remaining_images, remaining_audio),
+            serde=PydanticJsonSerde(StoryAssets),
+        )
+
+        remaining_images, remaining_audio = missing.images, missing.audio
+
+        if (len(remaining_images) == 0 and len(remaining_audio) == 0) or (
+            waited >= timeout
+        ):
+            return remaining_images, remaining_audio
+
+        iterations += 1
+        print(
+            f"Iteration {iterations} : {len(remaining_images)} images and {len(remaining_audio)} audio remaining"
+        )
+
+        await ctx.sleep(delta=interval)
+        waited += interval
+        interval = min(interval * 2, max_interval)
+
+
+async def create_story(
+    ctx: WorkflowContext, req: StoryInput, db: AsyncDatabaseClient
+) -> tuple[str, StoryOutline, StoryNodes, bool]:
+    """
+    Generate the story, its choices and their media. Returns whether every
+    asset made it to S3 before we stopped waiting.
+    """
     # This will take in a story prompt and then generate a story
     try:
-        story: StoryOutline = await ctx.run(
+        story: StoryOutline = await run_step(
+            ctx,
             "Generate Story",
-            lambda: generate_story(req.prompt),
+            lambda: generate_story(req.prompt, req.priority),
             serde=PydanticJsonSerde(StoryOutline),
         )
     except TerminalError as e:
@@ -54,95 +350,374 @@ async def run(ctx: WorkflowContext, req: StoryInput) -> str:
         raise TerminalError("Failed to generate story")
 
     try:
-        story_id = await ctx.run(
+        story_id = await run_step(
+            ctx,
             "Insert Story",
-            lambda: db.insert_story(story, req.user_email, req.prompt),
+            wrap_async_call(db.insert_story, story, req.user_email, req.prompt),
         )
     except Exception as e:
         print(e)
         raise TerminalError("Failed to insert story")
 
+    settings = get_env()
+    timeout = timedelta(seconds=settings.MEDIA_TIMEOUT_SECONDS)
+    use_signals = (
+        settings.MEDIA_COMPLETION_MODE == "signal"
+        and settings.RESTATE_INGRESS_URL is not None
+    )
+
+    # Node ids are derived from the story id, so we know every asset we're
+    # waiting on before the tree has been generated
+    stop_depth = req.lookahead if req.incremental else None
+    node_ids = get_story_node_ids(
+        story_id, stop_depth or req.max_depth, req.branching
+    )
+    expected_images = set(node_ids + ["banner"])
+    expected_audio = set(node_ids + ["theme"])
+
+    # Each asset gets its own awakeable which the media service resolves once
+    # the upload has finished, so we can complete as soon as the last one lands
+    image_signals: dict[str, RestateDurableFuture] = {}
+    audio_signals: dict[str, RestateDurableFuture] = {}
+    image_callbacks: dict[str, str] = {}
+    audio_callbacks: dict[str, str] = {}
+    if use_signals:
+        for node_id in sorted(expected_images):
+            image_callbacks[node_id], image_signals[node_id] = ctx.awakeable()
+        for node_id in sorted(expected_audio):
+            audio_callbacks[node_id], audio_signals[node_id] = ctx.awakeable()
+
     try:
-        choices: StoryNodes = await ctx.run(
-            "Generate Story Choices",
-            wrap_async_call(generate_story_choices, story),
-            serde=PydanticJsonSerde(StoryNodes),
+        choices = await generate_choices_and_media(
+            ctx,
+            story,
+            story_id,
+            image_callbacks,
+            audio_callbacks,
+            settings.STORY_BATCH_LEVELS,
+            req.priority,
+            req.max_depth,
+            req.branching,
+            stop_depth,
         )
     except TerminalError as e:
         print(e)
         raise TerminalError("Failed to generate story choices")
 
+    # Dead lettered assets are never going to report in, so we don't wait on them
+    dead_images = {d.node_id for d in choices.dead_letters if d.kind == "images"}
+    dead_audio = {d.node_id for d in choices.dead_letters if d.kind == "audio"}
+    if choices.dead_letters:
+        print(f"{len(choices.dead_letters)} media jobs could not be dispatched")
+        ctx.set("dead_letters", [d.model_dump() for d in choices.dead_letters])
+
     try:
-        await ctx.run(
+        await run_step(
+            ctx,
             "Insert Story Choices",
-            lambda: db.insert_story_nodes(choices.nodes, story_id, req.user_email),
+            wrap_async_call(
+                db.insert_story_nodes, choices.nodes, story_id, req.user_email
+            ),
+            serde=PydanticJsonSerde(InsertResult),
         )
     except Exception as e:
         print(e)
         raise TerminalError("Failed to insert story choices")
 
+    if req.incremental:
+        await ctx.object_call(
+            track_story,
+            key=story_id,
+            arg={
+                "story": story.model_dump(),
+                "user_email": req.user_email,
+                "priority": req.priority,
+                "max_depth": req.max_depth,
+                "branching": req.branching,
+                "lookahead": req.lookahead,
+                "batch_levels": settings.STORY_BATCH_LEVELS,
+                "frontier": [b.model_dump(mode="json") for b in choices.frontier],
+            },
+        )
+
+    if use_signals:
+        remaining_images, remaining_audio = await wait_for_asset_signals(
+            ctx,
+            {k: v for k, v in image_signals.items() if k not in dead_images},
+            {k: v for k, v in audio_signals.items() if k not in dead_audio},
+            timeout,
+        )
+        remaining_images |= dead_images
+        remaining_audio |= dead_audio
+        if remaining_images or remaining_audio:
+            # A callback may have been lost, so check the bucket once before giving up
+            remaining_images, remaining_audio = await poll_for_assets(
+                ctx, story_id, remaining_images, remaining_audio, timedelta()
+            )
+    else:
+        remaining_images, remaining_audio = await poll_for_assets(
+            ctx,
+            story_id,
+            expected_images - dead_images,
+            expected_audio - dead_audio,
+            timeout,
+        )
+        remaining_images |= dead_images
+        remaining_audio |= dead_audio
+
+    if remaining_images or remaining_audio:
+        print(
+            f"Gave up waiting on {len(remaining_images)} images and {len(remaining_audio)} audio"
+        )
+
+    return story_id, story, choices, not (remaining_images or remaining_audio)
+
+
+async def get_cached_story(
+    ctx: WorkflowContext, key: str, timeout: timedelta, claim_ttl: timedelta
+) -> tuple[dict | None, bool]:
+    """
+    Look up a cached story for this prompt. Returns the cached entry, if any,
+    and whether this workflow is now responsible for generating the story.
+    """
+    awakeable_id, entry_future = ctx.awakeable()
+    result = await ctx.object_call(
+        cache.lookup,
+        key=key,
+        arg=cache.CacheLookup(
+            claimant=ctx.key(),
+            awakeable_id=awakeable_id,
+            claim_ttl_seconds=int(claim_ttl.total_seconds()),
+        ),
+    )
+
+    if result["status"] == "hit":
+        return result["entry"], False
+
+    if result["status"] == "miss":
+        return None, True
+
+    # Another workflow is generating this exact prompt, so wait for its result
+    print(f"Waiting on in-flight generation for prompt {key}")
+    name, value = await restate.select(entry=entry_future, timeout=ctx.sleep(timeout))
+    if name == "entry":
+        return value, False
+
+    return None, False
+
+
+async def clone_cached_story(
+    ctx: WorkflowContext, req: StoryInput, db: AsyncDatabaseClient, entry: dict
+) -> str:
+    story = StoryOutline.model_validate(entry["story"])
+    story_id = await run_step(ctx, "Generate Story Id", lambda: str(uuid.uuid4()))
+
+    nodes, id_map = cache.clone_story_nodes(
+        [FinalStoryNode.model_validate(node) for node in entry["nodes"]],
+        entry["story_id"],
+        story_id,
+        entry.get("max_depth", MAX_DEPTH),
+        entry.get("branching", BRANCHING),
+    )
+
     try:
-        await ctx.run(
-            "trigger task",
-            wrap_async_call(
-                generate_images, choices.nodes, story_id, story.banner_image
-            ),
+        await run_step(
+            ctx,
+            "Copy Cached Story Assets",
+            lambda: copy_story_assets(entry["assets"], story_id, id_map),
         )
     except Exception as e:
         print(e)
-        raise TerminalError("Failed to generate images")
+        raise TerminalError("Failed to copy cached story assets")
 
+    # The story and all of its choices are written in a single transaction
     try:
-        await ctx.run(
-            "trigger task",
-            wrap_async_call(generate_tts, choices.nodes, story_id, story.description),
+        await run_step(
+            ctx,
+            "Insert Story",
+            wrap_async_call(
+                db.insert_story_nodes,
+                nodes,
+                story_id,
+                req.user_email,
+                story,
+                req.prompt,
+            ),
+            serde=PydanticJsonSerde(InsertResult),
         )
     except Exception as e:
         print(e)
-        raise TerminalError("Failed to generate images")
+        raise TerminalError("Failed to insert story")
 
-    iterations = 0
+    return story_id
 
-    expected_images = set([node.id for node in choices.nodes] + ["banner"])
-    expected_audio = set([node.id for node in choices.nodes] + ["theme"])
 
-    while True:
-        # We poll our S3 bucket and wait to see if all the images are there.
-        images_and_audio = await ctx.run(
-            "Get Story Images", lambda: get_story_items(story_id)
-        )
+@story_workflow.main()
+async def run(ctx: WorkflowContext, req: StoryInput) -> str:
+    with tracing.trace("cyoa", key=ctx.key(), workflow_id=ctx.key()):
+        return await run_story(ctx, req)
 
-        remaining_images = expected_images - set(images_and_audio["images"])
-        remaining_audio = expected_audio - set(images_and_audio["audio"])
 
-        if len(remaining_images) == 0 and len(remaining_audio) == 0:
-            break
+async def run_story(ctx: WorkflowContext, req: StoryInput) -> str:
+    print(f"Recieved request: {req}")
+    db = AsyncDatabaseClient()
+    settings = get_env()
 
-        iterations += 1
-        print(
-            f"Iteration {iterations} : {len(remaining_images)} images and {len(remaining_audio)} audio remaining"
+    # Incremental stories are only partly generated, so they aren't cached
+    cache_key = (
+        get_prompt_key(req.prompt, req.max_depth, req.branching)
+        if settings.STORY_CACHE and not req.incremental
+        else None
+    )
+    claimed = False
+    if cache_key is not None:
+        entry, claimed = await get_cached_story(
+            ctx,
+            cache_key,
+            timedelta(seconds=settings.STORY_CACHE_WAIT_SECONDS),
+            timedelta(seconds=settings.STORY_CACHE_CLAIM_TTL_SECONDS),
         )
+        if entry is not None:
+            print(f"Serving cached story {entry['story_id']} for prompt {cache_key}")
+            story_id = await clone_cached_story(ctx, req, db, entry)
+            await mark_story_as_completed(ctx, db, story_id)
+            return "success"
 
-        # We wait for at most 10 minutes. If the story is not ready, then we just give up.
-        if iterations > 10:
-            break
+    try:
+        story_id, story, choices, complete = await create_story(ctx, req, db)
+        await mark_story_as_completed(ctx, db, story_id)
+    except TerminalError:
+        if claimed:
+            ctx.object_send(
+                cache.release,
+                key=cache_key,
+                arg=cache.CacheRelease(claimant=ctx.key(), reason="Generation failed"),
+            )
+        raise
+
+    if claimed and complete:
+        ctx.object_send(
+            cache.store,
+            key=cache_key,
+            arg={
+                "story_id": story_id,
+                "model": MODEL_NAME,
+                "max_depth": req.max_depth,
+                "branching": req.branching,
+                "story": story.model_dump(),
+                "nodes": [node.model_dump() for node in choices.nodes],
+                "assets": cache.get_asset_keys(
+                    story_id, choices.nodes, story.banner_image
+                ),
+            },
+        )
+    elif claimed:
+        ctx.object_send(
+            cache.release,
+            key=cache_key,
+            arg=cache.CacheRelease(claimant=ctx.key(), reason="Story assets incomplete"),
+        )
+
+    return "success"
 
-        await ctx.sleep(delta=timedelta(seconds=60))
 
+async def mark_story_as_completed(
+    ctx: WorkflowContext, db: AsyncDatabaseClient, story_id: str
+):
     try:
-        await ctx.run(
+        await run_step(
+            ctx,
             "Mark Story as Completed",
-            lambda: db.mark_story_as_completed(story_id),
+            wrap_async_call(db.mark_story_as_completed, story_id),
         )
     except Exception as e:
         print(e)
         raise TerminalError("Failed to mark story as completed")
 
-    return "success"
+
+@story_tree.handler()
+async def track_story(ctx: ObjectContext, tree: dict) -> None:
+    ctx.set("tree", tree)
+
+
+@story_tree.handler()
+async def expand(ctx: ObjectContext, req: ExpandInput) -> dict:
+    """
+    Called by the frontend whenever a player reaches a node. Marks it as
+    explored and generates the branches below it, with their images and
+    audio, until the tree is `lookahead` levels deep below the player again.
+    Stories that were generated up front have nothing to expand.
+    """
+    tree = await ctx.get("tree")
+    if tree is None:
+        return {"expanded": 0, "dead_letters": []}
+
+    story_id = ctx.key()
+    node_id = req.node_id
+    db = AsyncDatabaseClient()
+    if req.mark_explored:
+        try:
+            await run_step(
+                ctx,
+                "Mark Node as Explored",
+                wrap_async_call(db.mark_node_as_explored, node_id),
+            )
+        except Exception as e:
+            print(e)
+            raise TerminalError("Failed to mark node as explored")
+
+    frontier = [Branch.model_validate(branch) for branch in tree["frontier"]]
+    targets, stop_depth = get_expansion(story_id, frontier, node_id, tree["lookahead"])
+    if not targets:
+        return {"expanded": 0, "dead_letters": []}
+
+    try:
+        expansion = await generate_choices_and_media(
+            ctx,
+            StoryOutline.model_validate(tree["story"]),
+            story_id,
+            {},
+            {},
+            tree["batch_levels"],
+            tree["priority"],
+            tree["max_depth"],
+            tree["branching"],
+            stop_depth,
+            targets,
+        )
+    except TerminalError as e:
+        print(e)
+        raise TerminalError("Failed to expand story choices")
+
+    try:
+        await run_step(
+            ctx,
+            "Insert Story Choices",
+            wrap_async_call(
+                db.insert_story_nodes, expansion.nodes, story_id, tree["user_email"]
+            ),
+            serde=PydanticJsonSerde(InsertResult),
+        )
+    except Exception as e:
+        print(e)
+        raise TerminalError("Failed to insert story choices")
+
+    expanded = {branch.node_id for branch in targets}
+    tree["frontier"] = [
+        branch.model_dump(mode="json")
+        for branch in frontier + expansion.frontier
+        if branch.node_id not in expanded
+    ]
+    ctx.set("tree", tree)
+
+    return {
+        "expanded": len(expansion.nodes),
+        "dead_letters": [d.model_dump() for d in expansion.dead_letters],
+    }
 
 
 app = restate.app(
-    [story_workflow],
+    [story_workflow, cache.story_cache, story_tree, llm_gateway],
     "bidi",
     identity_keys=[
         "publickeyv1_GTKUcX5ZHNBG3MX9wk7JGwA6VALTGr5UNYika3kyf63e",
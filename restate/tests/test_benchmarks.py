@@ -0,0 +1,115 @@
+import pytest
+from benchmarks.pipeline import BenchmarkOptions, compare, percentile, run_benchmark
+
+
+@pytest.fixture
+def fast_options():
+    """A run small and fast enough for the test suite"""
+    return BenchmarkOptions(
+        stories=2,
+        llm_latency=0,
+        llm_tokens_per_second=100_000,
+        image_seconds=0.01,
+        audio_seconds=0.01,
+        s3_latency=0,
+        sleep_scale=0.01,
+    )
+
+
+def test_run_benchmark(fast_options):
+    """Test that whole stories run offline and every stage is reported"""
+    results = run_benchmark(fast_options)
+
+    assert results["completed"] == 2, results["failures"]
+    assert results["stories_per_minute"] > 0
+    # A depth 3 tree has 15 nodes and each story makes one outline call
+    assert results["requests"]["llm"] == 2 * 16
+    assert results["requests"]["media.images"] == 2 * 16
+    assert results["requests"]["media.audio"] == 2 * 16
+    for stage in (
+        "Generate Story",
+        "Generate Story Level 0",
+        "Dispatch Story Level 3",
+        "Insert Story Choices",
+        "gemini.generate_choices",
+        "dispatch.images",
+        "db.insert_story_nodes",
+    ):
+        assert results["stages"][stage]["count"] > 0
+
+
+def test_run_benchmark_batch_levels(fast_options):
+    """Test that level batching needs one call per tree level"""
+    fast_options.batch_levels = True
+
+    results = run_benchmark(fast_options)
+
+    assert results["completed"] == 2, results["failures"]
+    assert results["requests"]["llm"] == 2 * 5
+
+
+def test_run_benchmark_tts_batch(fast_options):
+    """Test that narration goes to the batch endpoint once per dispatch"""
+    fast_options.tts_batch = True
+
+    results = run_benchmark(fast_options)
+
+    assert results["completed"] == 2, results["failures"]
+    assert "media.audio" not in results["requests"]
+    # The banner and theme plus one dispatch for each of the four levels
+    assert results["requests"]["media.audio.batch"] == 2 * 5
+    assert results["requests"]["media.images"] == 2 * 16
+
+
+def test_run_benchmark_lookahead(fast_options):
+    """Test that a deep story is playable once its lookahead levels are generated"""
+    fast_options.max_depth = 5
+    fast_options.lookahead = 2
+
+    results = run_benchmark(fast_options)
+
+    assert results["completed"] == 2, results["failures"]
+    # Two of five levels is 7 nodes instead of 63
+    assert results["requests"]["llm"] == 2 * 8
+    assert results["requests"]["media.images"] == 2 * 8
+
+
+def test_compare():
+    """Test that only regressions beyond the threshold are reported"""
+    baseline = {
+        "failed": 0,
+        "stories_per_minute": 10,
+        "stages": {
+            "Generate Story": {"p95_ms": 1000},
+            "s3.head_object": {"p95_ms": 1},
+        },
+        "requests": {"llm": 32, "llm.peak_in_flight": 16},
+    }
+    results = {
+        "failed": 0,
+        "stories_per_minute": 9,
+        "stages": {
+            "Generate Story": {"p95_ms": 1100},
+            "s3.head_object": {"p95_ms": 3},
+        },
+        "requests": {"llm": 32, "llm.peak_in_flight": 32},
+    }
+
+    assert compare(results, baseline, 0.2) == []
+
+    results["stories_per_minute"] = 7
+    results["stages"]["Generate Story"]["p95_ms"] = 1500
+    results["requests"]["llm"] = 64
+    regressions = compare(results, baseline, 0.2)
+
+    assert len(regressions) == 3
+    assert "Generate Story" in regressions[1]
+
+
+def test_percentile():
+    """Test nearest rank percentiles"""
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile([3.0], 99) == 3.0
@@ -0,0 +1,148 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from helpers.cache import (
+    CacheLookup,
+    CacheRelease,
+    get_prompt_key,
+    get_asset_keys,
+    clone_story_nodes,
+    lookup,
+    store,
+    release,
+)
+from helpers.s3 import get_image_version
+from helpers.story import FinalStoryNode, get_story_node_ids
+
+
+def test_get_prompt_key_normalizes_prompt():
+    """Test that prompts differing only in case and whitespace share a key"""
+    assert get_prompt_key("A knight  fights a\nDragon ") == get_prompt_key(
+        "a knight fights a dragon"
+    )
+    assert get_prompt_key("a knight fights a dragon") != get_prompt_key(
+        "a knight fights a wizard"
+    )
+
+
+def test_get_asset_keys():
+    """Test that every image, with its variants, and audio file of a story is listed"""
+    node = FinalStoryNode(
+        id="node1",
+        parent_id=None,
+        title="Node 1",
+        description="This is node 1",
+        image_description="Image for node 1",
+        choice_title="Choice 1",
+        choice_description="Description for choice 1",
+        is_terminal=True,
+    )
+    keys = get_asset_keys("story", [node], "Banner image")
+
+    node_version = get_image_version("Image for node 1")
+    banner_version = get_image_version("Banner image")
+    assert keys == [
+        f"story/node1.{node_version}.webp",
+        f"story/node1.{node_version}.thumb.webp",
+        "story/node1.png",
+        f"story/banner.{banner_version}.webp",
+        f"story/banner.{banner_version}.thumb.webp",
+        "story/banner.png",
+        "story/node1.mp3",
+        "story/theme.mp3",
+    ]
+
+
+def test_clone_story_nodes():
+    """Test that a cloned tree keeps its shape under the new story's ids"""
+    source_story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+    story_id = "6f1c7e0e-8d7a-4d8b-a1a4-1c9a3c3f0b7e"
+    source_ids = get_story_node_ids(source_story_id, max_depth=1)
+    nodes = [
+        FinalStoryNode(
+            id=node_id,
+            parent_id=None if index == 0 else source_ids[0],
+            title=f"Node {index}",
+            description="Description",
+            image_description="Image",
+            choice_title="Choice",
+            choice_description="Choice description",
+            is_terminal=index > 0,
+        )
+        for index, node_id in enumerate(source_ids)
+    ]
+
+    cloned, id_map = clone_story_nodes(nodes, source_story_id, story_id)
+
+    assert [node.id for node in cloned] == get_story_node_ids(story_id, max_depth=1)
+    assert cloned[0].parent_id is None
+    assert cloned[1].parent_id == cloned[0].id
+    assert [node.title for node in cloned] == [node.title for node in nodes]
+    assert id_map[source_ids[1]] == cloned[1].id
+
+
+@pytest.fixture
+def object_ctx():
+    state = {}
+    ctx = MagicMock()
+    ctx.get = AsyncMock(side_effect=lambda key: state.get(key))
+    ctx.set = MagicMock(side_effect=lambda key, value: state.__setitem__(key, value))
+    ctx.clear = MagicMock(side_effect=lambda key: state.pop(key, None))
+    ctx.run = AsyncMock(side_effect=lambda name, action: action())
+    ctx.key = MagicMock(return_value="prompt_key")
+    ctx.state = state
+    return ctx
+
+
+def make_lookup(claimant, awakeable_id):
+    return CacheLookup(
+        claimant=claimant, awakeable_id=awakeable_id, claim_ttl_seconds=1800
+    )
+
+
+@pytest.mark.asyncio
+async def test_single_flight(object_ctx):
+    """Test that only the first lookup generates and later ones wait for it"""
+    assert await lookup(object_ctx, make_lookup("workflow_1", "awakeable_1")) == {"status": "miss"}
+    assert await lookup(object_ctx, make_lookup("workflow_2", "awakeable_2")) == {"status": "pending"}
+    assert await lookup(object_ctx, make_lookup("workflow_3", "awakeable_3")) == {"status": "pending"}
+
+    await store(object_ctx, {"story_id": "story"})
+
+    assert object_ctx.resolve_awakeable.call_count == 2
+    object_ctx.resolve_awakeable.assert_any_call("awakeable_2", {"story_id": "story"})
+    assert await lookup(object_ctx, make_lookup("workflow_4", "awakeable_4")) == {
+        "status": "hit",
+        "entry": {"story_id": "story"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_release_wakes_waiters(object_ctx):
+    """Test that a failed generation frees the prompt for the next workflow"""
+    await lookup(object_ctx, make_lookup("workflow_1", "awakeable_1"))
+    await lookup(object_ctx, make_lookup("workflow_2", "awakeable_2"))
+
+    await release(object_ctx, CacheRelease(claimant="workflow_1", reason="Generation failed"))
+
+    object_ctx.resolve_awakeable.assert_called_once_with("awakeable_2", None)
+    assert await lookup(object_ctx, make_lookup("workflow_3", "awakeable_3")) == {"status": "miss"}
+
+
+@pytest.mark.asyncio
+async def test_stale_claim_is_taken_over(object_ctx):
+    """Test that a claim past its TTL goes to the next workflow, which the waiters then wait on"""
+    with patch("helpers.cache.time.time", return_value=1000):
+        await lookup(object_ctx, make_lookup("workflow_1", "awakeable_1"))
+        await lookup(object_ctx, make_lookup("workflow_2", "awakeable_2"))
+
+    with patch("helpers.cache.time.time", return_value=1000 + 1800):
+        assert await lookup(object_ctx, make_lookup("workflow_3", "awakeable_3")) == {"status": "miss"}
+    assert object_ctx.state["pending"] == {"claimant": "workflow_3", "claimed_at": 2800}
+
+    # The workflow that lost its claim can't release the new one
+    await release(object_ctx, CacheRelease(claimant="workflow_1", reason="Generation failed"))
+    object_ctx.resolve_awakeable.assert_not_called()
+    assert object_ctx.state["pending"]["claimant"] == "workflow_3"
+
+    await store(object_ctx, {"story_id": "story"})
+    object_ctx.resolve_awakeable.assert_called_once_with("awakeable_2", {"story_id": "story"})
@@ -1,97 +1,68 @@
+import asyncio
 import pytest
-from unittest.mock import MagicMock, patch
-from helpers.db import DatabaseClient
+from unittest.mock import AsyncMock, MagicMock, patch
+from libsql_client import LibsqlError
+from helpers.db import AsyncDatabaseClient, ConnectionPool
 from helpers.story import StoryOutline, FinalStoryNode
 
 
 @pytest.fixture
 def mock_env():
-    with patch("helpers.db.Env") as mock_env:
+    with patch("helpers.db.get_env") as mock_env:
         mock_env_instance = MagicMock()
         mock_env_instance.DB_URL = "test_url"
         mock_env_instance.DB_TOKEN = "test_token"
+        mock_env_instance.DB_POOL_SIZE = 2
+        mock_env_instance.DB_POOL_IDLE_TIMEOUT_SECONDS = 300
+        mock_env_instance.DB_POOL_PROBE_AFTER_SECONDS = 30
         mock_env.return_value = mock_env_instance
         yield mock_env
 
 
 @pytest.fixture
-def mock_connection():
-    with patch("helpers.db.create_client_sync") as mock_create_client:
-        mock_conn = MagicMock()
+def mock_async_connection():
+    with patch("helpers.db.create_client") as mock_create_client:
+        mock_conn = AsyncMock()
+        mock_conn.closed = False
         mock_create_client.return_value = mock_conn
         yield mock_conn
 
 
 @pytest.fixture
-def db_client(mock_env, mock_connection):
-    # Reset the singleton instance
-    DatabaseClient._instance = None
-    DatabaseClient._connection = None
-    return DatabaseClient()
+def async_db_client(mock_env, mock_async_connection):
+    AsyncDatabaseClient._instance = None
+    AsyncDatabaseClient._pool = None
+    return AsyncDatabaseClient()
 
 
-def test_singleton_pattern():
-    """Test that DatabaseClient follows the singleton pattern"""
+def test_singleton_pattern(mock_env):
+    """Test that AsyncDatabaseClient follows the singleton pattern"""
     # Reset the singleton instance
-    DatabaseClient._instance = None
+    AsyncDatabaseClient._instance = None
     
-    client1 = DatabaseClient()
-    client2 = DatabaseClient()
+    client1 = AsyncDatabaseClient()
+    client2 = AsyncDatabaseClient()
     
     assert client1 is client2
 
 
-def test_insert_story(db_client, mock_connection):
-    """Test inserting a story into the database"""
-    # Create a mock story
-    story = StoryOutline(
-        title="Test Story",
-        description="This is a test story",
-        melody="Test melody",
-        banner_image="Test banner image"
-    )
-    
-    # Mock uuid.uuid4() to return a predictable value
-    with patch("uuid.uuid4") as mock_uuid:
-        mock_uuid.return_value.hex = "test_id"
-        mock_uuid.return_value.__str__.return_value = "test_id"
-        
-        # Call the method
-        story_id = db_client.insert_story(story, "test@example.com", "Test prompt")
-        
-        # Verify the result
-        assert story_id == "test_id"
-        
-        # Verify the database call
-        mock_connection.execute.assert_called_once()
-        args, kwargs = mock_connection.execute.call_args
-        
-        # Check that the query contains the expected values
-        assert "INSERT INTO stories" in args[0]
-        assert args[1][0] == "test_id"
-        assert args[1][1] == "test@example.com"
-        assert args[1][2] == "Test Story"
-        assert args[1][3] == "This is a test story"
-        assert args[1][4] == "PROCESSING"
-        assert args[1][6] == "Test prompt"
-        assert args[1][7] == "Test banner image"
-
-
-def test_mark_story_as_completed(db_client, mock_connection):
+@pytest.mark.asyncio
+async def test_mark_story_as_completed(async_db_client, mock_async_connection):
     """Test marking a story as completed"""
     # Call the method
-    db_client.mark_story_as_completed("test_id")
+    await async_db_client.mark_story_as_completed("test_id")
     
     # Verify the database call
-    mock_connection.execute.assert_called_once()
-    args, kwargs = mock_connection.execute.call_args
+    mock_async_connection.execute.assert_awaited_once()
+    args, kwargs = mock_async_connection.execute.call_args
     
     # Check that the query contains the expected values
     assert "UPDATE stories SET status = 'GENERATED'" in args[0]
     assert args[1][0] == "test_id"
 
 
-def test_insert_story_nodes(db_client, mock_connection):
+@pytest.mark.asyncio
+async def test_insert_story_nodes(async_db_client, mock_async_connection):
     """Test inserting story nodes into the database"""
     # Create mock nodes
     nodes = [
@@ -117,51 +88,250 @@ def test_insert_story_nodes(db_client, mock_connection):
         )
     ]
     
+    mock_async_connection.batch.return_value = [MagicMock(rows_affected=1), MagicMock(rows_affected=1)]
+
     # Call the method
-    db_client.insert_story_nodes(nodes, "test_story_id", "test@example.com")
+    result = await async_db_client.insert_story_nodes(nodes, "test_story_id", "test@example.com")
     
-    # Verify the database calls
-    assert mock_connection.execute.call_count == 2
+    # All nodes are written in a single batch
+    mock_async_connection.batch.assert_awaited_once()
+    statements = mock_async_connection.batch.call_args[0][0]
+    assert len(statements) == 2
+    assert result.rows_written == 2
     
     # Check first node
-    args1, kwargs1 = mock_connection.execute.call_args_list[0]
-    assert "INSERT INTO story_choices" in args1[0]
-    assert args1[1][0] == "node1"
-    assert args1[1][1] == "test@example.com"
-    assert args1[1][2] == "NULL"  # parent_id is None
-    assert args1[1][3] == "test_story_id"
-    assert args1[1][4] == "This is node 1"
-    assert args1[1][5] == "Choice 1"
-    assert args1[1][6] == "Description for choice 1"
-    assert args1[1][7] == 0  # is_terminal is False
-    assert args1[1][8] == 1  # explored is 1 for root node
+    args1 = statements[0].args
+    assert "INSERT INTO story_choices" in statements[0].sql
+    assert "ON CONFLICT(id) DO UPDATE" in statements[0].sql
+    assert args1[0] == "node1"
+    assert args1[1] == "test@example.com"
+    assert args1[2] == "NULL"  # parent_id is None
+    assert args1[3] == "test_story_id"
+    assert args1[4] == "This is node 1"
+    assert args1[5] == "Choice 1"
+    assert args1[6] == "Description for choice 1"
+    assert args1[7] == 0  # is_terminal is False
+    assert args1[8] == 1  # explored is 1 for root node
     
     # Check second node
-    args2, kwargs2 = mock_connection.execute.call_args_list[1]
-    assert args2[1][0] == "node2"
-    assert args2[1][1] == "test@example.com"
-    assert args2[1][2] == "node1"  # parent_id
-    assert args2[1][3] == "test_story_id"
-    assert args2[1][4] == "This is node 2"
-    assert args2[1][5] == "Choice 2"
-    assert args2[1][6] == "Description for choice 2"
-    assert args2[1][7] == 1  # is_terminal is True
-    assert args2[1][8] == 0  # explored is 0 for non-root node
-
-
-def test_get_connection_retry(db_client, mock_connection):
-    """Test that get_connection retries on failure"""
-    # Make the connection fail on first attempt
-    mock_connection.execute.side_effect = [Exception("Connection failed"), None]
-    
-    # Reset the connection
-    db_client._connection = None
-    
-    # Use the context manager
-    with db_client.get_connection():
-        pass
-    
-    # Verify that create_client_sync was called twice
-    with patch("helpers.db.create_client_sync") as mock_create_client:
-        mock_create_client.return_value = mock_connection
-        assert mock_create_client.call_count <= 2  # Called at most twice
\ No newline at end of file
+    args2 = statements[1].args
+    assert args2[0] == "node2"
+    assert args2[1] == "test@example.com"
+    assert args2[2] == "node1"  # parent_id
+    assert args2[3] == "test_story_id"
+    assert args2[4] == "This is node 2"
+    assert args2[5] == "Choice 2"
+    assert args2[6] == "Description for choice 2"
+    assert args2[7] == 1  # is_terminal is True
+    assert args2[8] == 0  # explored is 0 for non-root node
+
+
+@pytest.mark.asyncio
+async def test_insert_story_nodes_with_story(async_db_client, mock_async_connection):
+    """Test that the story row can be written in the same batch as its nodes"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    node = FinalStoryNode(
+        id="node1",
+        parent_id=None,
+        title="Node 1",
+        description="This is node 1",
+        image_description="Image for node 1",
+        choice_title="Choice 1",
+        choice_description="Description for choice 1",
+        is_terminal=True
+    )
+    mock_async_connection.batch.return_value = [MagicMock(rows_affected=1), MagicMock(rows_affected=1)]
+
+    result = await async_db_client.insert_story_nodes(
+        [node], "test_story_id", "test@example.com", story, "Test prompt"
+    )
+
+    statements = mock_async_connection.batch.call_args[0][0]
+    assert "INSERT INTO stories" in statements[0].sql
+    assert "ON CONFLICT(id) DO NOTHING" in statements[0].sql
+    assert statements[0].args[0] == "test_story_id"
+    assert statements[0].args[6] == "Test prompt"
+    assert "INSERT INTO story_choices" in statements[1].sql
+    assert result.rows_written == 2
+
+
+@pytest.mark.asyncio
+async def test_async_insert_story(async_db_client, mock_async_connection):
+    """Test inserting a story with the async client"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+
+    with patch("uuid.uuid4") as mock_uuid:
+        mock_uuid.return_value.__str__.return_value = "test_id"
+        story_id = await async_db_client.insert_story(story, "test@example.com", "Test prompt")
+
+    assert story_id == "test_id"
+    mock_async_connection.execute.assert_awaited_once()
+    args, kwargs = mock_async_connection.execute.call_args
+    assert "INSERT INTO stories" in args[0]
+    assert args[1][0] == "test_id"
+    assert args[1][6] == "Test prompt"
+
+
+@pytest.mark.asyncio
+async def test_async_insert_story_nodes(async_db_client, mock_async_connection):
+    """Test that the async client writes every node in a single batch"""
+    node = FinalStoryNode(
+        id="node1",
+        parent_id=None,
+        title="Node 1",
+        description="This is node 1",
+        image_description="Image for node 1",
+        choice_title="Choice 1",
+        choice_description="Description for choice 1",
+        is_terminal=True
+    )
+    mock_async_connection.batch.return_value = [MagicMock(rows_affected=1)]
+
+    result = await async_db_client.insert_story_nodes([node], "test_story_id", "test@example.com")
+
+    mock_async_connection.batch.assert_awaited_once()
+    statements = mock_async_connection.batch.call_args[0][0]
+    assert "INSERT INTO story_choices" in statements[0].sql
+    assert statements[0].args[0] == "node1"
+    assert result.rows_written == 1
+
+
+@pytest.mark.asyncio
+async def test_async_statement_reconnects_on_failure(async_db_client, mock_async_connection):
+    """Test that the async client replaces its connection after the connection fails"""
+    mock_async_connection.execute.side_effect = [
+        LibsqlError("WebSocket was closed", "HRANA_WEBSOCKET_ERROR"),
+        None,
+    ]
+
+    with patch("helpers.db.create_client", return_value=mock_async_connection) as mock_create_client:
+        await async_db_client.mark_story_as_completed("test_id")
+
+        assert mock_create_client.call_count == 2
+    mock_async_connection.close.assert_awaited_once()
+    assert mock_async_connection.execute.await_count == 2
+    assert async_db_client._pool.size == 1
+
+
+@pytest.mark.asyncio
+async def test_async_statement_raises_after_retry(async_db_client, mock_async_connection):
+    """Test that a statement whose fresh connection fails too is raised"""
+    mock_async_connection.execute.side_effect = ConnectionResetError("Connection reset")
+
+    with pytest.raises(ConnectionResetError):
+        await async_db_client.mark_story_as_completed("test_id")
+
+    assert mock_async_connection.execute.await_count == 2
+    assert async_db_client._pool.size == 0
+
+
+@pytest.mark.asyncio
+async def test_async_statement_error_keeps_the_connection(async_db_client, mock_async_connection):
+    """Test that a failing statement returns its connection to the pool"""
+    mock_async_connection.execute.side_effect = LibsqlError(
+        "UNIQUE constraint failed: stories.id", "SQLITE_CONSTRAINT"
+    )
+
+    with pytest.raises(LibsqlError):
+        await async_db_client.mark_story_as_completed("test_id")
+
+    # Not retried, and the connection is handed out again
+    assert mock_async_connection.execute.await_count == 1
+    mock_async_connection.close.assert_not_called()
+    async with async_db_client.get_connection() as conn:
+        assert conn is mock_async_connection
+    assert async_db_client._pool.size == 1
+
+
+def make_client():
+    client = AsyncMock()
+    client.closed = False
+    return client
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_connections_without_probe():
+    """Test that recently used connections are handed out without a probe"""
+    factory = MagicMock(side_effect=make_client)
+    pool = ConnectionPool(factory, max_size=2)
+
+    async with pool.connection() as conn:
+        await conn.execute("UPDATE stories SET status = 'GENERATED'")
+    async with pool.connection() as conn:
+        await conn.execute("UPDATE stories SET status = 'GENERATED'")
+
+    factory.assert_called_once()
+    executed = [call.args[0] for call in conn.execute.call_args_list]
+    assert "SELECT 1" not in executed
+    assert pool.size == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_probes_after_idle():
+    """Test that a connection idle past the probe window is checked and replaced if dead"""
+    stale, fresh = make_client(), make_client()
+    stale.execute.side_effect = LibsqlError("Stream expired", "STREAM_EXPIRED")
+    factory = MagicMock(side_effect=[stale, fresh])
+    pool = ConnectionPool(factory, max_size=1, probe_after=30)
+
+    with patch("helpers.db.time.monotonic", return_value=0):
+        async with pool.connection():
+            pass
+
+    with patch("helpers.db.time.monotonic", return_value=60):
+        async with pool.connection() as conn:
+            assert conn is fresh
+
+    stale.execute.assert_awaited_once_with("SELECT 1")
+    stale.close.assert_awaited_once()
+    assert pool.size == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_closes_idle_connections():
+    """Test that connections idle past the idle timeout are closed"""
+    first, second = make_client(), make_client()
+    factory = MagicMock(side_effect=[first, second])
+    pool = ConnectionPool(factory, max_size=1, idle_timeout=300)
+
+    with patch("helpers.db.time.monotonic", return_value=0):
+        async with pool.connection():
+            pass
+
+    with patch("helpers.db.time.monotonic", return_value=600):
+        async with pool.connection() as conn:
+            assert conn is second
+
+    first.close.assert_awaited_once()
+    first.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_pool_bounds_concurrent_checkouts():
+    """Test that concurrent checkouts get separate connections up to the max size"""
+    factory = MagicMock(side_effect=make_client)
+    pool = ConnectionPool(factory, max_size=2)
+    checked_out = []
+
+    async def checkout():
+        async with pool.connection() as conn:
+            checked_out.append(conn)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(checkout() for _ in range(4)))
+
+    # The third and fourth checkouts waited for a connection to be returned
+    assert factory.call_count == 2
+    assert len(checked_out) == 4
+    assert len(set(map(id, checked_out))) == 2
+    assert pool.size == 2
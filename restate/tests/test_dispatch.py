@@ -0,0 +1,259 @@
+import pytest
+import asyncio
+import pytest_asyncio
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from aiohttp import web
+from helpers.dispatch import (
+    DeadLetter,
+    DispatchReport,
+    MediaDispatcher,
+    get_dispatcher,
+    get_proxy_headers,
+)
+
+
+@pytest_asyncio.fixture
+async def media_server():
+    """A local endpoint that answers each request with the next scripted response"""
+    responses = []
+    requests = []
+    headers = []
+    load = {"in_flight": 0, "peak": 0}
+
+    async def handler(request):
+        requests.append(await request.json())
+        headers.append(request.headers)
+        response = responses.pop(0) if responses else 200
+        load["in_flight"] += 1
+        load["peak"] = max(load["peak"], load["in_flight"])
+        try:
+            if response == "slow":
+                # An endpoint that hasn't accepted the job by the ack timeout
+                await asyncio.sleep(1)
+                return web.Response(status=202, text="accepted")
+            await asyncio.sleep(0.02)
+            return web.Response(status=response, text="response")
+        finally:
+            load["in_flight"] -= 1
+
+    app = web.Application()
+    app.router.add_post("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    yield SimpleNamespace(
+        endpoint=f"http://127.0.0.1:{port}/",
+        responses=responses,
+        requests=requests,
+        headers=headers,
+        load=load,
+    )
+
+    await runner.cleanup()
+
+
+def make_dispatcher(endpoint, **kwargs):
+    return MediaDispatcher(
+        "images", endpoint, ack_timeout=0.2, initial_backoff=0, **kwargs
+    )
+
+
+def make_job(node_id):
+    return {"node_id": node_id, "story_id": "test_story_id", "prompt": f"Prompt for {node_id}"}
+
+
+@pytest.mark.asyncio
+async def test_dispatch_acknowledges_jobs(media_server):
+    """Test that jobs answered with a 2xx are acknowledged"""
+    media_server.responses.extend([202, 200])
+    dispatcher = make_dispatcher(media_server.endpoint)
+
+    report = await dispatcher.dispatch([make_job("node1"), make_job("node2")])
+
+    assert sorted(report.acknowledged) == ["node1", "node2"]
+    assert report.dead_letters == []
+    assert [request["node_id"] for request in media_server.requests] == ["node1", "node2"]
+
+
+@pytest.mark.asyncio
+async def test_dispatch_retries_unacknowledged_jobs(media_server):
+    """Test that a timeout or a status other than 2xx isn't taken as an acknowledgement"""
+    media_server.responses.extend(["slow", 302, 501, 202])
+    dispatcher = make_dispatcher(media_server.endpoint)
+
+    report = await dispatcher.dispatch([make_job("node1")])
+
+    assert report.acknowledged == ["node1"]
+    assert len(media_server.requests) == 4
+
+
+@pytest.mark.asyncio
+async def test_dispatch_retries_retryable_errors(media_server):
+    """Test that a busy endpoint is retried until it takes the job"""
+    media_server.responses.extend([503, 429, 200])
+    dispatcher = make_dispatcher(media_server.endpoint)
+
+    report = await dispatcher.dispatch([make_job("node1")])
+
+    assert report.acknowledged == ["node1"]
+    assert len(media_server.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_dispatch_dead_letters_after_max_attempts(media_server):
+    """Test that a job is dead lettered once it runs out of attempts"""
+    media_server.responses.extend([503] * 3)
+    dispatcher = make_dispatcher(media_server.endpoint, max_attempts=3)
+
+    report = await dispatcher.dispatch([make_job("node1")])
+
+    assert report.acknowledged == []
+    assert report.dead_letters == [
+        DeadLetter(kind="images", node_id="node1", attempts=3, error=report.dead_letters[0].error)
+    ]
+    assert "503" in report.dead_letters[0].error
+    assert len(media_server.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_dispatch_does_not_retry_rejected_jobs(media_server):
+    """Test that a job the endpoint rejects is dead lettered straight away"""
+    media_server.responses.append(422)
+    dispatcher = make_dispatcher(media_server.endpoint)
+
+    report = await dispatcher.dispatch([make_job("node1")])
+
+    assert report.dead_letters[0].attempts == 1
+    assert "422" in report.dead_letters[0].error
+    assert len(media_server.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_dispatch_connection_errors():
+    """Test that an unreachable endpoint is retried and then dead lettered"""
+    dispatcher = make_dispatcher("http://127.0.0.1:1/", max_attempts=2)
+
+    report = await dispatcher.dispatch([make_job("node1")])
+
+    assert report.dead_letters[0].attempts == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatch_bounds_concurrency(media_server):
+    """Test that deliveries share one session and never exceed the concurrency bound"""
+    dispatcher = make_dispatcher(media_server.endpoint, max_concurrency=2)
+
+    report = await dispatcher.dispatch([make_job(f"node{i}") for i in range(6)])
+    session = dispatcher._session
+    await dispatcher.dispatch([make_job("node6")])
+
+    assert len(report.acknowledged) == 6
+    assert media_server.load["peak"] == 2
+    assert dispatcher._session is session
+
+
+@pytest.mark.asyncio
+async def test_dispatch_batch(media_server):
+    """Test that a batch of jobs is sent in one request and acknowledged together"""
+    dispatcher = make_dispatcher("http://unused", batch_endpoint=media_server.endpoint)
+    jobs = [make_job("node1"), make_job("node2")]
+
+    report = await dispatcher.dispatch_batch(jobs)
+
+    assert report.acknowledged == ["node1", "node2"]
+    assert media_server.requests == [{"nodes": jobs}]
+    assert await dispatcher.dispatch_batch([]) == DispatchReport()
+
+
+@pytest.mark.asyncio
+async def test_dispatch_batch_dead_letters_every_job(media_server):
+    """Test that a batch that never gets through dead letters each of its jobs"""
+    media_server.responses.extend([503] * 2)
+    dispatcher = make_dispatcher(
+        "http://unused", batch_endpoint=media_server.endpoint, max_attempts=2
+    )
+
+    report = await dispatcher.dispatch_batch([make_job("node1"), make_job("node2")])
+
+    assert report.acknowledged == []
+    assert [dead_letter.node_id for dead_letter in report.dead_letters] == ["node1", "node2"]
+    assert all(dead_letter.attempts == 2 for dead_letter in report.dead_letters)
+    assert len(media_server.requests) == 2
+
+
+def test_backoff_is_jittered_and_capped():
+    """Test that the backoff grows exponentially up to its cap with full jitter"""
+    dispatcher = MediaDispatcher("audio", "http://test", initial_backoff=1, max_backoff=4)
+
+    with patch("helpers.dispatch.random.uniform", side_effect=lambda low, high: high):
+        assert [dispatcher.get_backoff(attempt) for attempt in range(1, 5)] == [1, 2, 4, 4]
+
+
+def test_dispatch_report_merge():
+    """Test that reports from several dispatches are combined"""
+    dead_letter = DeadLetter(kind="audio", node_id="theme", attempts=5, error="HTTP 503")
+
+    report = DispatchReport(acknowledged=["node1"]).merge(
+        DispatchReport(acknowledged=["node2"], dead_letters=[dead_letter])
+    )
+
+    assert report.acknowledged == ["node1", "node2"]
+    assert report.dead_letters == [dead_letter]
+
+
+@pytest.mark.asyncio
+async def test_dispatch_sends_headers(media_server):
+    """Test that the dispatcher's headers, e.g. the proxy auth token, go with every job"""
+    dispatcher = make_dispatcher(
+        media_server.endpoint, headers={"Modal-Key": "wk-id", "Modal-Secret": "ws-secret"}
+    )
+
+    report = await dispatcher.dispatch([make_job("node1"), make_job("node2")])
+
+    assert report.acknowledged == ["node1", "node2"]
+    for headers in media_server.headers:
+        assert headers["Modal-Key"] == "wk-id"
+        assert headers["Modal-Secret"] == "ws-secret"
+
+
+def test_get_proxy_headers():
+    """Test that the proxy auth headers are only sent when both parts are set"""
+    assert get_proxy_headers("wk-id", "ws-secret") == {
+        "Modal-Key": "wk-id",
+        "Modal-Secret": "ws-secret",
+    }
+    assert get_proxy_headers("wk-id", None) == {}
+    assert get_proxy_headers(None, None) == {}
+
+
+def test_get_dispatcher():
+    """Test that each endpoint gets a single dispatcher configured from the settings"""
+    mock_env = MagicMock()
+    mock_env.IMAGE_ENDPOINT = "http://test-image-endpoint"
+    mock_env.KOKORO_ENDPOINT = "http://test-tts-endpoint"
+    mock_env.KOKORO_BATCH_ENDPOINT = "http://test-tts-batch-endpoint"
+    mock_env.KOKORO_PROXY_TOKEN_ID = "wk-id"
+    mock_env.KOKORO_PROXY_TOKEN_SECRET = "ws-secret"
+    mock_env.IMAGE_PROXY_TOKEN_ID = None
+    mock_env.IMAGE_PROXY_TOKEN_SECRET = None
+    mock_env.DISPATCH_CONCURRENCY = 4
+    get_dispatcher.cache_clear()
+
+    with patch("helpers.dispatch.get_env", return_value=mock_env):
+        images = get_dispatcher("images")
+        audio = get_dispatcher("audio")
+
+        assert get_dispatcher("images") is images
+        assert images.endpoint == "http://test-image-endpoint"
+        assert audio.endpoint == "http://test-tts-endpoint"
+        assert audio.batch_endpoint == "http://test-tts-batch-endpoint"
+        assert images.batch_endpoint is None
+        assert images.max_concurrency == 4
+        assert audio.headers == {"Modal-Key": "wk-id", "Modal-Secret": "ws-secret"}
+        assert images.headers == {}
+
+    get_dispatcher.cache_clear()
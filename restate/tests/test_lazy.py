@@ -0,0 +1,42 @@
+import sys
+import pytest
+from helpers.lazy import lazy_import
+
+
+@pytest.fixture
+def fake_module(tmp_path, monkeypatch):
+    """A module on the path that hasn't been imported yet"""
+    (tmp_path / "fake_sdk.py").write_text("CLIENT = 'client'\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield "fake_sdk"
+    sys.modules.pop("fake_sdk", None)
+
+
+def test_lazy_import_defers_the_import(fake_module):
+    """Test that the module is only imported once one of its attributes is used"""
+    module = lazy_import(fake_module)
+
+    assert fake_module not in sys.modules
+    assert module.CLIENT == "client"
+    assert fake_module in sys.modules
+
+
+def test_lazy_import_keeps_find_spec_working():
+    """Test that lazily imported SDKs don't break find_spec, which instructor calls at import"""
+    import subprocess
+
+    # Run in a fresh interpreter so neither SDK has been imported yet
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import importlib.util; from helpers.lazy import lazy_import; "
+            "lazy_import('boto3'); lazy_import('botocore.exceptions'); "
+            "print(importlib.util.find_spec('boto3').name)",
+        ],
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "boto3"
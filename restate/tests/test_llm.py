@@ -0,0 +1,221 @@
+import pytest
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+from helpers.llm import LLMGateway, TokenBucket, get_gateway, is_overloaded
+
+
+class QuotaExceeded(Exception):
+    code = 429
+
+
+class FakeClient:
+    """An instructor client that records how many calls it has in flight"""
+
+    def __init__(self, delay=0.02, errors=None):
+        self.delay = delay
+        self.errors = list(errors or [])
+        self.calls = []
+        self.in_flight = 0
+        self.peak = 0
+        self.chat = MagicMock()
+        self.chat.completions.create = self.create
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.errors:
+                raise self.errors.pop(0)
+            return kwargs.get("messages")
+        finally:
+            self.in_flight -= 1
+
+
+def make_gateway(**kwargs):
+    return LLMGateway(initial_backoff=0, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_gateway_bounds_concurrency():
+    """Test that calls beyond the concurrency limit wait their turn"""
+    gateway = make_gateway(initial_concurrency=2, min_concurrency=1, max_concurrency=2)
+    client = FakeClient()
+
+    results = await asyncio.gather(
+        *[gateway.create(client, messages=[{"content": str(i)}]) for i in range(6)]
+    )
+
+    assert [r[0]["content"] for r in results] == [str(i) for i in range(6)]
+    assert client.peak == 2
+    assert gateway.requests == 6
+    assert gateway.stats().in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_gateway_admits_interactive_calls_first():
+    """Test that queued interactive calls go ahead of bulk calls queued before them"""
+    gateway = make_gateway(initial_concurrency=1, min_concurrency=1, max_concurrency=1)
+    client = FakeClient(delay=0.05)
+    order = []
+
+    async def call(name, priority):
+        await gateway.create(client, priority, messages=[])
+        order.append(name)
+
+    first = asyncio.create_task(call("first", "bulk"))
+    await asyncio.sleep(0.01)
+    bulk = asyncio.create_task(call("bulk", "bulk"))
+    interactive = asyncio.create_task(call("interactive", "interactive"))
+    await asyncio.sleep(0.01)
+
+    assert gateway.stats().queued == {"interactive": 1, "bulk": 1}
+
+    await asyncio.gather(first, bulk, interactive)
+    assert order == ["first", "interactive", "bulk"]
+
+
+@pytest.mark.asyncio
+async def test_gateway_backs_off_when_throttled():
+    """Test that a 429 halves the limit once and the call is retried"""
+    gateway = make_gateway(initial_concurrency=8, min_concurrency=2, max_concurrency=8)
+    client = FakeClient(errors=[QuotaExceeded("Resource exhausted")] * 3)
+
+    results = await asyncio.gather(*[gateway.create(client, messages=[]) for _ in range(3)])
+
+    assert results == [[], [], []]
+    assert len(client.calls) == 6
+    assert gateway.throttled == 3
+    # The three calls were in flight together, so the limit is only halved once
+    # before it grows back a little from the successful retries
+    assert 4 < gateway.concurrency_limit < 5
+
+
+@pytest.mark.asyncio
+async def test_gateway_grows_concurrency_on_success():
+    """Test that the limit grows additively up to the maximum"""
+    gateway = make_gateway(initial_concurrency=2, max_concurrency=3)
+    client = FakeClient(delay=0)
+
+    for _ in range(20):
+        await gateway.create(client, messages=[])
+
+    assert gateway.concurrency_limit == 3
+
+
+@pytest.mark.asyncio
+async def test_gateway_raises_other_errors():
+    """Test that errors that aren't throttling are raised without a retry"""
+    gateway = make_gateway()
+    client = FakeClient(errors=[ValueError("Invalid response")])
+
+    with pytest.raises(ValueError):
+        await gateway.create(client, messages=[])
+
+    assert len(client.calls) == 1
+    assert gateway.stats().in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_gateway_gives_up_after_max_attempts():
+    """Test that a call throttled on every attempt fails"""
+    gateway = make_gateway(max_attempts=2)
+    client = FakeClient(errors=[QuotaExceeded("Resource exhausted")] * 2)
+
+    with pytest.raises(QuotaExceeded):
+        await gateway.create(client, messages=[])
+
+    assert len(client.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_gateway_waits_for_token_budget():
+    """Test that calls wait for the token bucket to refill"""
+    gateway = make_gateway(tokens_per_minute=60_000, expected_output_tokens=100)
+    gateway._token_bucket.tokens = 0
+    client = FakeClient(delay=0)
+
+    start = time.monotonic()
+    await gateway.create(client, messages=[])
+
+    # 1,000 tokens a second, so the 100 token call waits a tenth of a second
+    assert time.monotonic() - start >= 0.09
+    assert gateway.stats().queue_wait_p50_ms >= 90
+
+
+@pytest.mark.asyncio
+async def test_gateway_client():
+    """Test that the client wrapper sends completions through the gateway"""
+    gateway = make_gateway()
+    gateway.create = AsyncMock(return_value="response")
+    client = MagicMock()
+
+    result = await gateway.client(client, "bulk").chat.completions.create(messages=[])
+
+    assert result == "response"
+    gateway.create.assert_called_once_with(client, "bulk", messages=[])
+
+
+def test_gateway_reports_cached_tokens():
+    """Test that prompt tokens served from a context cache show up in the stats"""
+    gateway = make_gateway()
+
+    gateway.record_cached_tokens(1800)
+    gateway.record_cached_tokens(0)
+
+    assert gateway.stats().cached_tokens_saved == 1800
+
+
+def test_token_bucket():
+    """Test that the bucket refills at its per minute rate"""
+    with patch("helpers.llm.time.monotonic", return_value=0):
+        bucket = TokenBucket(120)
+        bucket.take(120)
+        assert bucket.delay(2) == 1.0
+
+    with patch("helpers.llm.time.monotonic", return_value=0.5):
+        assert bucket.delay(2) == 0.5
+        # A request larger than the bucket only waits for a full bucket
+        assert bucket.delay(1000) == 59.5
+
+
+def test_is_overloaded():
+    """Test that throttling is detected through wrapped errors"""
+    try:
+        try:
+            raise QuotaExceeded("Resource exhausted")
+        except QuotaExceeded as e:
+            raise RuntimeError("Retries failed") from e
+    except RuntimeError as e:
+        wrapped = e
+
+    unavailable = Exception("Service unavailable")
+    unavailable.status_code = 503
+
+    assert is_overloaded(wrapped)
+    assert is_overloaded(unavailable)
+    assert not is_overloaded(ValueError("Invalid response"))
+
+
+def test_get_gateway():
+    """Test that the worker shares one gateway configured from the settings"""
+    mock_env = MagicMock()
+    mock_env.LLM_REQUESTS_PER_MINUTE = 100
+    mock_env.LLM_TOKENS_PER_MINUTE = 1000
+    mock_env.LLM_INITIAL_CONCURRENCY = 4
+    mock_env.LLM_MIN_CONCURRENCY = 1
+    mock_env.LLM_MAX_CONCURRENCY = 8
+    mock_env.LLM_MAX_ATTEMPTS = 3
+    mock_env.LLM_EXPECTED_OUTPUT_TOKENS = 100
+    get_gateway.cache_clear()
+
+    with patch("helpers.llm.get_env", return_value=mock_env):
+        gateway = get_gateway()
+
+        assert get_gateway() is gateway
+        assert gateway.concurrency_limit == 4
+        assert gateway.max_attempts == 3
+
+    get_gateway.cache_clear()
@@ -2,21 +2,65 @@ import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
 import asyncio
 from restate.exceptions import TerminalError
-from helpers.story import StoryOutline, StoryNodes, FinalStoryNode
-from main import run, StoryInput, wrap_async_call
+from helpers.story import StoryOutline, StoryNodes, FinalStoryNode, Branch
+from helpers.story import get_path_node_ids, get_story_node_ids
+from helpers.s3 import StoryAssets
+from helpers.dispatch import DeadLetter, DispatchReport
+from main import (
+    run,
+    expand,
+    ExpandInput,
+    StoryChoices,
+    StoryInput,
+    wrap_async_call,
+    generate_choices_and_media,
+)
 
 
 @pytest.fixture
 def mock_ctx():
     ctx = AsyncMock()
-    ctx.run = AsyncMock()
+
+    async def run(name, action, serde=None):
+        result = action()
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def sleep(*args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    ctx.run = AsyncMock(side_effect=run)
+    ctx.sleep = MagicMock(side_effect=sleep)
+    ctx.set = MagicMock()
+    ctx.key = MagicMock(return_value="test_workflow_id")
     return ctx
 
 
+@pytest.fixture
+def mock_env():
+    with patch("main.get_env") as mock_env:
+        mock_env_instance = MagicMock()
+        mock_env_instance.MEDIA_COMPLETION_MODE = "poll"
+        mock_env_instance.RESTATE_INGRESS_URL = None
+        mock_env_instance.MEDIA_TIMEOUT_SECONDS = 600
+        mock_env_instance.POLL_INITIAL_INTERVAL_SECONDS = 60
+        mock_env_instance.POLL_MAX_INTERVAL_SECONDS = 60
+        mock_env_instance.STORY_BATCH_LEVELS = False
+        mock_env_instance.STORY_CACHE = False
+        mock_env_instance.STORY_CACHE_WAIT_SECONDS = 900
+        mock_env_instance.STORY_CACHE_CLAIM_TTL_SECONDS = 1800
+        mock_env_instance.PROMPT_CACHE = False
+        mock_env.return_value = mock_env_instance
+        yield mock_env_instance
+
+
 @pytest.fixture
 def mock_db():
-    with patch("main.DatabaseClient") as mock_db_class:
-        mock_db_instance = MagicMock()
+    with patch("main.AsyncDatabaseClient") as mock_db_class:
+        mock_db_instance = AsyncMock()
         mock_db_class.return_value = mock_db_instance
         yield mock_db_instance
 
@@ -33,57 +77,76 @@ def mock_story_generator():
         yield mock_gen
 
 
+CHOICE = {
+    "choice": {"choice_title": "Choice", "choice_description": "Description"},
+    "options": [],
+    "context": "Context",
+}
+
+
 @pytest.fixture
 def mock_choices_generator():
-    with patch("main.generate_story_choices") as mock_gen:
-        nodes = [
-            FinalStoryNode(
-                id="node1",
-                parent_id=None,
-                title="Node 1",
-                description="This is node 1",
-                image_description="Image for node 1",
-                choice_title="Choice 1",
-                choice_description="Description for choice 1",
-                is_terminal=False
-            ),
-            FinalStoryNode(
-                id="node2",
-                parent_id="node1",
-                title="Node 2",
-                description="This is node 2",
-                image_description="Image for node 2",
-                choice_title="Choice 2",
-                choice_description="Description for choice 2",
-                is_terminal=True
+    nodes = [
+        FinalStoryNode(
+            id="node1",
+            parent_id=None,
+            title="Node 1",
+            description="This is node 1",
+            image_description="Image for node 1",
+            choice_title="Choice 1",
+            choice_description="Description for choice 1",
+            is_terminal=False
+        ),
+        FinalStoryNode(
+            id="node2",
+            parent_id="node1",
+            title="Node 2",
+            description="This is node 2",
+            image_description="Image for node 2",
+            choice_title="Choice 2",
+            choice_description="Description for choice 2",
+            is_terminal=True
+        )
+    ]
+
+    async def generate_story_choices(story, story_id, branches=None, **kwargs):
+        # One level per call, the root and then its only child
+        if branches is None:
+            return StoryNodes(
+                nodes=nodes[:1],
+                frontier=[Branch(path="1.1", node_id="node2", parent_id="node1", user_choices=[CHOICE])],
             )
-        ]
-        mock_gen.return_value = StoryNodes(nodes=nodes)
+        return StoryNodes(nodes=nodes[1:])
+
+    with patch("main.generate_story_choices", side_effect=generate_story_choices) as mock_gen, \
+         patch("main.get_story_node_ids", return_value=["node1", "node2"]):
         yield mock_gen
 
 
 @pytest.fixture
 def mock_image_generator():
-    with patch("main.generate_images") as mock_gen:
-        mock_gen.return_value = "Success"
+    with patch("main.generate_images", new_callable=AsyncMock) as mock_gen:
+        mock_gen.return_value = DispatchReport()
         yield mock_gen
 
 
 @pytest.fixture
 def mock_tts_generator():
-    with patch("main.generate_tts") as mock_gen:
-        mock_gen.return_value = "Success"
+    with patch("main.generate_tts", new_callable=AsyncMock) as mock_gen:
+        mock_gen.return_value = DispatchReport()
         yield mock_gen
 
 
+ALL_MISSING = StoryAssets(
+    images={"node1", "node2", "banner"}, audio={"node1", "node2", "theme"}
+)
+
+
 @pytest.fixture
 def mock_s3():
-    with patch("main.get_story_items") as mock_s3:
-        # First call returns empty, second call returns all items
-        mock_s3.side_effect = [
-            {"images": [], "audio": []},
-            {"images": ["node1", "node2", "banner"], "audio": ["node1", "node2", "theme"]}
-        ]
+    with patch("main.get_missing_assets") as mock_s3:
+        # First check finds nothing, the second finds every asset
+        mock_s3.side_effect = [ALL_MISSING, StoryAssets()]
         yield mock_s3
 
 
@@ -109,49 +172,12 @@ async def test_wrap_async_call():
 
 @pytest.mark.asyncio
 async def test_run_workflow_success(
-    mock_ctx, mock_db, mock_story_generator, mock_choices_generator,
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
     mock_image_generator, mock_tts_generator, mock_s3
 ):
     """Test the main workflow run function with successful execution"""
-    # Set up the mock context to return expected values
-    mock_ctx.run.side_effect = [
-        StoryOutline(
-            title="Test Story",
-            description="This is a test story",
-            melody="Test melody",
-            banner_image="Test banner image"
-        ),
-        "test_story_id",
-        StoryNodes(nodes=[
-            FinalStoryNode(
-                id="node1",
-                parent_id=None,
-                title="Node 1",
-                description="This is node 1",
-                image_description="Image for node 1",
-                choice_title="Choice 1",
-                choice_description="Description for choice 1",
-                is_terminal=False
-            ),
-            FinalStoryNode(
-                id="node2",
-                parent_id="node1",
-                title="Node 2",
-                description="This is node 2",
-                image_description="Image for node 2",
-                choice_title="Choice 2",
-                choice_description="Description for choice 2",
-                is_terminal=True
-            )
-        ]),
-        None,  # insert_story_nodes
-        None,  # generate_images
-        None,  # generate_tts
-        {"images": [], "audio": []},  # First S3 check
-        {"images": ["node1", "node2", "banner"], "audio": ["node1", "node2", "theme"]},  # Second S3 check
-        None,  # mark_story_as_completed
-    ]
-    
+    mock_db.insert_story.return_value = "test_story_id"
+
     # Create a story input
     story_input = StoryInput(
         prompt="Test prompt",
@@ -164,17 +190,132 @@ async def test_run_workflow_success(
     # Verify the result
     assert result == "success"
     
-    # Verify that all the expected functions were called
-    assert mock_ctx.run.call_count == 9
+    # Story, insert, banner and theme, two levels of choices and their media,
+    # insert choices, two S3 checks and completion
+    assert mock_ctx.run.call_count == 11
+    assert [call.args[0] for call in mock_ctx.run.call_args_list[2:7]] == [
+        "Dispatch Story Media",
+        "Generate Story Level 0",
+        "Dispatch Story Level 0",
+        "Generate Story Level 1",
+        "Dispatch Story Level 1",
+    ]
+    assert mock_s3.call_count == 2
+    mock_ctx.sleep.assert_called_once()
+
+    # The second check only looks for the assets the first one didn't find
+    assert mock_s3.call_args_list[1].args == (
+        "test_story_id", ALL_MISSING.images, ALL_MISSING.audio
+    )
     
     # Verify that the database functions were called
     mock_db.insert_story.assert_called_once()
     mock_db.insert_story_nodes.assert_called_once()
+    mock_db.mark_story_as_completed.assert_called_once_with("test_story_id")
+
+    # Stories are interactive unless they ask otherwise
+    mock_story_generator.assert_called_once_with("Test prompt", "interactive")
+    assert mock_choices_generator.call_args.kwargs["priority"] == "interactive"
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_polling_backs_off(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that the polling fallback doubles its interval up to the maximum"""
+    mock_env.POLL_INITIAL_INTERVAL_SECONDS = 5
+    mock_env.POLL_MAX_INTERVAL_SECONDS = 20
+    mock_s3.side_effect = [ALL_MISSING] * 4 + [StoryAssets()]
+
+    result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    intervals = [call.kwargs["delta"].total_seconds() for call in mock_ctx.sleep.call_args_list]
+    assert intervals == [5, 10, 20, 20]
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_signals(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that the workflow completes once every asset awakeable resolves"""
+    mock_env.MEDIA_COMPLETION_MODE = "signal"
+    mock_env.RESTATE_INGRESS_URL = "http://restate"
+    mock_db.insert_story.return_value = "test_story_id"
+
+    awakeables = [(f"awakeable_{i}", MagicMock()) for i in range(6)]
+    mock_ctx.awakeable = MagicMock(side_effect=awakeables)
+
+    async def wait_completed(deadline, *futures):
+        return [futures[0]], list(futures[1:])
+
+    with patch("main.restate.wait_completed", side_effect=wait_completed) as mock_wait:
+        result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    assert mock_wait.call_count == 6
+
+    # Each asset is dispatched with its own awakeable and S3 is never polled
+    image_callbacks = mock_image_generator.call_args[0][3]
+    audio_callbacks = mock_tts_generator.call_args[0][3]
+    assert mock_image_generator.call_count == 3
+    assert mock_tts_generator.call_count == 3
+    assert set(image_callbacks) == {"node1", "node2", "banner"}
+    assert set(audio_callbacks) == {"node1", "node2", "theme"}
+    mock_s3.assert_not_called()
+    mock_db.mark_story_as_completed.assert_called_once_with("test_story_id")
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_dead_letters(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that undeliverable jobs are recorded and not waited on"""
+    mock_db.insert_story.return_value = "test_story_id"
+    dead_letter = DeadLetter(kind="images", node_id="node2", attempts=5, error="HTTP 503")
+    mock_image_generator.side_effect = [DispatchReport(), DispatchReport(), DispatchReport(dead_letters=[dead_letter])]
+    mock_s3.side_effect = [StoryAssets()]
+
+    result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    # The bucket is only checked for the assets that were delivered
+    assert mock_s3.call_args.args == (
+        "test_story_id", {"node1", "banner"}, {"node1", "node2", "theme"}
+    )
+    mock_ctx.sleep.assert_not_called()
+    mock_ctx.set.assert_called_once_with("dead_letters", [dead_letter.model_dump()])
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_signals_timeout_checks_s3(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that missing signals fall back to a single S3 check at the deadline"""
+    mock_env.MEDIA_COMPLETION_MODE = "signal"
+    mock_env.RESTATE_INGRESS_URL = "http://restate"
+    mock_ctx.awakeable = MagicMock(
+        side_effect=[(f"awakeable_{i}", MagicMock()) for i in range(6)]
+    )
+    mock_s3.side_effect = [StoryAssets()]
+
+    async def wait_completed(deadline, *futures):
+        return [deadline], list(futures)
+
+    with patch("main.restate.wait_completed", side_effect=wait_completed):
+        result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    mock_s3.assert_called_once()
     mock_db.mark_story_as_completed.assert_called_once()
 
 
 @pytest.mark.asyncio
-async def test_run_workflow_story_generation_failure(mock_ctx, mock_db, mock_story_generator):
+async def test_run_workflow_story_generation_failure(mock_ctx, mock_env, mock_db, mock_story_generator):
     """Test the main workflow when story generation fails"""
     # Set up the mock context to raise an error
     mock_ctx.run.side_effect = TerminalError("Failed to generate story")
@@ -202,18 +343,10 @@ async def test_run_workflow_story_generation_failure(mock_ctx, mock_db, mock_sto
 
 
 @pytest.mark.asyncio
-async def test_run_workflow_db_insert_failure(mock_ctx, mock_db, mock_story_generator):
+async def test_run_workflow_db_insert_failure(mock_ctx, mock_env, mock_db, mock_story_generator):
     """Test the main workflow when database insertion fails"""
-    # Set up the mock context to return a story but fail on DB insert
-    mock_ctx.run.side_effect = [
-        StoryOutline(
-            title="Test Story",
-            description="This is a test story",
-            melody="Test melody",
-            banner_image="Test banner image"
-        ),
-        Exception("Database error")
-    ]
+    # The story generates but the DB insert fails
+    mock_db.insert_story.side_effect = Exception("Database error")
     
     # Create a story input
     story_input = StoryInput(
@@ -238,47 +371,13 @@ async def test_run_workflow_db_insert_failure(mock_ctx, mock_db, mock_story_gene
 
 @pytest.mark.asyncio
 async def test_run_workflow_timeout(
-    mock_ctx, mock_db, mock_story_generator, mock_choices_generator,
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
     mock_image_generator, mock_tts_generator, mock_s3
 ):
     """Test the main workflow when S3 polling times out"""
-    # Set up the mock context to return expected values but with S3 always empty
-    mock_s3.side_effect = [{"images": [], "audio": []}] * 11  # Always return empty
-    
-    mock_ctx.run.side_effect = [
-        StoryOutline(
-            title="Test Story",
-            description="This is a test story",
-            melody="Test melody",
-            banner_image="Test banner image"
-        ),
-        "test_story_id",
-        StoryNodes(nodes=[
-            FinalStoryNode(
-                id="node1",
-                parent_id=None,
-                title="Node 1",
-                description="This is node 1",
-                image_description="Image for node 1",
-                choice_title="Choice 1",
-                choice_description="Description for choice 1",
-                is_terminal=False
-            ),
-            FinalStoryNode(
-                id="node2",
-                parent_id="node1",
-                title="Node 2",
-                description="This is node 2",
-                image_description="Image for node 2",
-                choice_title="Choice 2",
-                choice_description="Description for choice 2",
-                is_terminal=True
-            )
-        ]),
-        None,  # insert_story_nodes
-        None,  # generate_images
-        None,  # generate_tts
-    ] + [{"images": [], "audio": []}] * 11  # S3 checks always return empty
+    # S3 never has any of the assets
+    mock_s3.side_effect = None
+    mock_s3.return_value = ALL_MISSING
     
     # Create a story input
     story_input = StoryInput(
@@ -292,10 +391,397 @@ async def test_run_workflow_timeout(
     # Verify the result
     assert result == "success"
     
-    # Verify that the sleep function was called multiple times
-    assert mock_ctx.sleep.call_count > 0
+    # We poll once up front and then once per minute for ten minutes
+    assert mock_s3.call_count == 11
+    assert mock_ctx.sleep.call_count == 10
     
     # Verify that the database functions were called
     mock_db.insert_story.assert_called_once()
     mock_db.insert_story_nodes.assert_called_once()
-    mock_db.mark_story_as_completed.assert_called_once()
\ No newline at end of file
+    mock_db.mark_story_as_completed.assert_called_once()
+
+
+
+@pytest.mark.asyncio
+async def test_generate_choices_and_media(mock_ctx, mock_choices_generator, mock_image_generator, mock_tts_generator):
+    """Test that each level is journaled and its media dispatched before the next level"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    dead_letter = DeadLetter(kind="audio", node_id="node2", attempts=5, error="HTTP 503")
+    mock_tts_generator.side_effect = [DispatchReport(), DispatchReport(), DispatchReport(dead_letters=[dead_letter])]
+
+    result = await generate_choices_and_media(mock_ctx, story, "test_story_id", {}, {})
+
+    assert [node.id for node in result.nodes] == ["node1", "node2"]
+    assert result.frontier == []
+    assert result.dead_letters == [dead_letter]
+
+    # The second level continues the branches the first one left
+    levels = mock_choices_generator.call_args_list
+    assert [call.kwargs["stop_depth"] for call in levels] == [0, 1]
+    assert levels[0].kwargs["branches"] is None
+    assert [branch.node_id for branch in levels[1].kwargs["branches"]] == ["node2"]
+
+    image_calls = mock_image_generator.call_args_list
+    assert image_calls[0][0][:3] == ([], "test_story_id", "Test banner image")
+    assert [[node.id for node in call[0][0]] for call in image_calls[1:]] == [["node1"], ["node2"]]
+    assert all(call[0][2] is None for call in image_calls[1:])
+
+    tts_calls = mock_tts_generator.call_args_list
+    assert tts_calls[0][0][:3] == ([], "test_story_id", "This is a test story")
+    assert [[node.id for node in call[0][0]] for call in tts_calls[1:]] == [["node1"], ["node2"]]
+
+
+@pytest.mark.asyncio
+async def test_generate_choices_and_media_stops_at_stop_depth(mock_ctx, mock_choices_generator, mock_image_generator, mock_tts_generator):
+    """Test that levels below the stop depth are left as the frontier"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+
+    result = await generate_choices_and_media(
+        mock_ctx, story, "test_story_id", {}, {}, stop_depth=0
+    )
+
+    assert [node.id for node in result.nodes] == ["node1"]
+    assert [branch.node_id for branch in result.frontier] == ["node2"]
+    assert mock_choices_generator.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_incremental(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that only the lookahead levels are generated and the rest is tracked for later"""
+    mock_db.insert_story.return_value = "test_story_id"
+    mock_ctx.object_call = AsyncMock()
+
+    with patch("main.get_story_node_ids", return_value=["node1", "node2"]) as mock_node_ids:
+        result = await run(
+            mock_ctx,
+            StoryInput(
+                prompt="Test prompt", user_email="test@example.com", max_depth=5, lookahead=1
+            ),
+        )
+
+    assert result == "success"
+    # We only wait on the assets of the levels we generated
+    mock_node_ids.assert_called_once_with("test_story_id", 1, 2)
+    assert [call.kwargs["max_depth"] for call in mock_choices_generator.call_args_list] == [5, 5]
+
+    handler = mock_ctx.object_call.call_args[0][0]
+    tree = mock_ctx.object_call.call_args.kwargs["arg"]
+    assert handler.__name__ == "track_story"
+    assert mock_ctx.object_call.call_args.kwargs["key"] == "test_story_id"
+    assert tree["lookahead"] == 1
+    assert tree["story"]["title"] == "Test Story"
+
+
+def test_story_input_lookahead():
+    """Test that a lookahead covering the whole tree generates it up front"""
+    assert not StoryInput(prompt="Test", user_email="test@example.com").incremental
+    assert not StoryInput(prompt="Test", user_email="test@example.com", lookahead=3).incremental
+    assert StoryInput(prompt="Test", user_email="test@example.com", lookahead=1).incremental
+
+
+def test_story_input_tree_size():
+    """Test that depth and branching are bounded by the size of the tree they make"""
+    from pydantic import ValidationError
+
+    assert StoryInput(prompt="Test", user_email="test@example.com", max_depth=6)
+    assert StoryInput(prompt="Test", user_email="test@example.com", max_depth=4, branching=3)
+
+    with pytest.raises(ValidationError):
+        StoryInput(prompt="Test", user_email="test@example.com", max_depth=7)
+    with pytest.raises(ValidationError):
+        StoryInput(prompt="Test", user_email="test@example.com", max_depth=10, branching=4)
+
+
+def test_story_input_incremental_tree_size():
+    """Test that an incremental story is bounded by its lookahead rather than its full depth"""
+    from pydantic import ValidationError
+
+    assert StoryInput(prompt="Test", user_email="test@example.com", max_depth=8, lookahead=2)
+    assert StoryInput(prompt="Test", user_email="test@example.com", max_depth=12, lookahead=6)
+
+    with pytest.raises(ValidationError):
+        StoryInput(prompt="Test", user_email="test@example.com", max_depth=12, lookahead=7)
+    with pytest.raises(ValidationError):
+        StoryInput(
+            prompt="Test", user_email="test@example.com", max_depth=8, lookahead=4, branching=4
+        )
+
+
+STORY_ID = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+
+def make_branch(path):
+    node_ids = get_path_node_ids(STORY_ID, path)
+    return Branch(
+        path=path,
+        node_id=node_ids[-1],
+        parent_id=node_ids[-2],
+        user_choices=[CHOICE] * (len(node_ids) - 1),
+    )
+
+
+@pytest.fixture
+def story_tree():
+    return {
+        "story": {
+            "title": "Test Story",
+            "description": "This is a test story",
+            "melody": "Test melody",
+            "banner_image": "Test banner image",
+        },
+        "user_email": "test@example.com",
+        "priority": "interactive",
+        "max_depth": 5,
+        "branching": 2,
+        "lookahead": 1,
+        "batch_levels": False,
+        "frontier": [
+            make_branch(path).model_dump(mode="json")
+            for path in ("1.1.1", "1.1.2", "1.2.1", "1.2.2")
+        ],
+    }
+
+
+@pytest.mark.asyncio
+async def test_expand(mock_ctx, mock_db, story_tree):
+    """Test that reaching a node generates the branches below it and tracks the new frontier"""
+    node_id = get_path_node_ids(STORY_ID, "1.1")[-1]
+    mock_ctx.key = MagicMock(return_value=STORY_ID)
+    mock_ctx.get = AsyncMock(return_value=story_tree)
+    expansion = StoryChoices(nodes=[], frontier=[make_branch("1.1.1.1")])
+
+    with patch("main.generate_choices_and_media", AsyncMock(return_value=expansion)) as mock_generate:
+        result = await expand(mock_ctx, ExpandInput(node_id=node_id))
+
+    assert result["expanded"] == 0
+    mock_db.mark_node_as_explored.assert_called_once_with(node_id)
+    mock_db.insert_story_nodes.assert_called_once()
+
+    args = mock_generate.call_args[0]
+    assert args[2] == STORY_ID
+    # The player is on level 1, so the tree is generated down to level 2
+    assert args[9] == 2
+    assert [branch.path for branch in args[10]] == ["1.1.1", "1.1.2"]
+
+    name, tree = mock_ctx.set.call_args[0]
+    assert name == "tree"
+    assert [branch["path"] for branch in tree["frontier"]] == ["1.2.1", "1.2.2", "1.1.1.1"]
+
+
+@pytest.mark.asyncio
+async def test_expand_within_lookahead(mock_ctx, mock_db, story_tree):
+    """Test that nothing is generated while the player is still behind the lookahead"""
+    mock_ctx.key = MagicMock(return_value=STORY_ID)
+    mock_ctx.get = AsyncMock(return_value=story_tree)
+
+    with patch("main.generate_choices_and_media", AsyncMock()) as mock_generate:
+        result = await expand(
+            mock_ctx,
+            ExpandInput(node_id=get_path_node_ids(STORY_ID, "1")[-1], mark_explored=False),
+        )
+
+    assert result["expanded"] == 0
+    mock_generate.assert_not_called()
+    mock_ctx.set.assert_not_called()
+    # Someone else playing a public story doesn't advance the owner's progress
+    mock_db.mark_node_as_explored.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_expand_unknown_story(mock_ctx, mock_db):
+    """Test that a story generated up front has nothing to expand"""
+    mock_ctx.get = AsyncMock(return_value=None)
+
+    result = await expand(mock_ctx, ExpandInput(node_id="node1"))
+
+    assert result == {"expanded": 0, "dead_letters": []}
+    mock_ctx.run.assert_not_called()
+
+
+@pytest.fixture
+def cached_entry():
+    source_story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+    root_id = get_story_node_ids(source_story_id)[0]
+    return {
+        "story_id": source_story_id,
+        "model": "gemini-2.0-flash-exp",
+        "story": {
+            "title": "Cached Story",
+            "description": "This is a cached story",
+            "melody": "Test melody",
+            "banner_image": "Test banner image",
+        },
+        "nodes": [
+            {
+                "id": root_id,
+                "parent_id": None,
+                "title": "Node 1",
+                "description": "This is node 1",
+                "image_description": "Image for node 1",
+                "choice_title": "Start",
+                "choice_description": "Start the story",
+                "is_terminal": False,
+            }
+        ],
+        "assets": [f"{source_story_id}/{root_id}.png", f"{source_story_id}/banner.png"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_prompt_cache_per_story(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that a story's prompt cache is created once and reused by every level"""
+    mock_env.PROMPT_CACHE = True
+    mock_db.insert_story.return_value = "test_story_id"
+    generate_level = mock_choices_generator.side_effect
+
+    async def generate_with_cache(*args, **kwargs):
+        nodes = await generate_level(*args, **kwargs)
+        nodes.cached_tokens_saved = 900
+        return nodes
+
+    mock_choices_generator.side_effect = generate_with_cache
+
+    with patch("main.create_prompt_cache", new_callable=AsyncMock) as mock_create, \
+         patch("main.delete_prompt_cache", new_callable=AsyncMock) as mock_delete, \
+         patch("main.tracing.set_attribute") as mock_set_attribute:
+        mock_create.return_value = "cachedContents/story"
+        result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    mock_create.assert_awaited_once()
+    assert [call.kwargs["prompt_cache"] for call in mock_choices_generator.call_args_list] == [
+        "cachedContents/story",
+        "cachedContents/story",
+    ]
+    mock_delete.assert_awaited_once_with("cachedContents/story")
+    steps = [call.args[0] for call in mock_ctx.run.call_args_list]
+    assert steps.count("Create Prompt Cache") == 1
+    assert steps.count("Delete Prompt Cache") == 1
+    # Savings are reported for the story across both levels
+    mock_set_attribute.assert_any_call("prompt_cache.tokens_saved", 1800)
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_cache_hit(mock_ctx, mock_env, mock_db, mock_story_generator, cached_entry):
+    """Test that a cached prompt is cloned instead of generated"""
+    mock_env.STORY_CACHE = True
+    new_story_id = "6f1c7e0e-8d7a-4d8b-a1a4-1c9a3c3f0b7e"
+    mock_ctx.awakeable = MagicMock(return_value=("awakeable_1", MagicMock()))
+    mock_ctx.object_call = AsyncMock(return_value={"status": "hit", "entry": cached_entry})
+
+    with patch("main.copy_story_assets") as mock_copy, \
+         patch("main.uuid.uuid4", return_value=new_story_id):
+        result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    mock_story_generator.assert_not_called()
+
+    # The story and its nodes are cloned under the new story id in one batch
+    mock_db.insert_story.assert_not_called()
+    cloned_nodes, story_id, user_email, story, prompt = mock_db.insert_story_nodes.call_args[0]
+    assert story_id == new_story_id
+    assert story.title == "Cached Story"
+    assert prompt == "Test prompt"
+    assert cloned_nodes[0].id == get_story_node_ids(new_story_id)[0]
+    assets, story_id, id_map = mock_copy.call_args[0]
+    assert assets == cached_entry["assets"]
+    assert story_id == new_story_id
+    assert id_map[cached_entry["nodes"][0]["id"]] == cloned_nodes[0].id
+    mock_db.mark_story_as_completed.assert_called_once_with(new_story_id)
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_cache_miss_stores_story(
+    mock_ctx, mock_env, mock_db, mock_story_generator, mock_choices_generator,
+    mock_image_generator, mock_tts_generator, mock_s3
+):
+    """Test that a freshly generated story is stored for the next identical prompt"""
+    mock_env.STORY_CACHE = True
+    mock_db.insert_story.return_value = "test_story_id"
+    mock_ctx.awakeable = MagicMock(return_value=("awakeable_1", MagicMock()))
+    mock_ctx.object_call = AsyncMock(return_value={"status": "miss"})
+    mock_ctx.object_send = MagicMock()
+
+    result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    mock_ctx.object_send.assert_called_once()
+    handler = mock_ctx.object_send.call_args[0][0]
+    entry = mock_ctx.object_send.call_args.kwargs["arg"]
+    assert handler.__name__ == "store"
+    assert entry["story_id"] == "test_story_id"
+    assert [node["id"] for node in entry["nodes"]] == ["node1", "node2"]
+    assert "test_story_id/banner.png" in entry["assets"]
+    assert "test_story_id/theme.mp3" in entry["assets"]
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_cache_releases_on_failure(mock_ctx, mock_env, mock_db, mock_story_generator):
+    """Test that a failed generation releases any workflows waiting on it"""
+    mock_env.STORY_CACHE = True
+    mock_db.insert_story.side_effect = Exception("Database error")
+    mock_ctx.awakeable = MagicMock(return_value=("awakeable_1", MagicMock()))
+    mock_ctx.object_call = AsyncMock(return_value={"status": "miss"})
+    mock_ctx.object_send = MagicMock()
+
+    with pytest.raises(TerminalError):
+        await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert mock_ctx.object_send.call_args[0][0].__name__ == "release"
+    assert mock_ctx.object_send.call_args.kwargs["arg"].claimant == "test_workflow_id"
+
+
+@pytest.mark.asyncio
+async def test_run_workflow_cache_waits_for_inflight(mock_ctx, mock_env, mock_db, mock_story_generator, cached_entry):
+    """Test that an identical in-flight prompt is waited on rather than regenerated"""
+    mock_env.STORY_CACHE = True
+    mock_ctx.awakeable = MagicMock(return_value=("awakeable_1", MagicMock()))
+    mock_ctx.object_call = AsyncMock(return_value={"status": "pending"})
+
+    with patch("main.restate.select", AsyncMock(return_value=["entry", cached_entry])), \
+         patch("main.copy_story_assets"), \
+         patch("main.uuid.uuid4", return_value="6f1c7e0e-8d7a-4d8b-a1a4-1c9a3c3f0b7e"):
+        result = await run(mock_ctx, StoryInput(prompt="Test prompt", user_email="test@example.com"))
+
+    assert result == "success"
+    mock_story_generator.assert_not_called()
+    lookup = mock_ctx.object_call.call_args.kwargs["arg"]
+    assert lookup.claimant == "test_workflow_id"
+    assert lookup.awakeable_id == "awakeable_1"
+    assert lookup.claim_ttl_seconds == 1800
+    mock_db.mark_story_as_completed.assert_called_once()
+
+
+def test_main_import_defers_heavy_sdks():
+    """Test that importing the worker doesn't load the Gemini or AWS SDKs"""
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import main, sys; print([m for m in ('google.ai.generativelanguage', 'botocore.client') if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,128 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from datetime import timedelta
+from helpers.prompts import StoryPrompt, as_literal, delete_cache
+from helpers.story import UserChoice
+
+
+@pytest.fixture
+def mock_genai():
+    with patch("helpers.prompts.genai") as mock_genai:
+        yield mock_genai
+
+
+@pytest.fixture
+def previous_choices():
+    choice = UserChoice(choice_title="Open the door", choice_description="See what's inside")
+    return [
+        {
+            "choice": choice,
+            "options": [
+                {"title": "Open the door", "description": "See what's inside"},
+                {"title": "Walk away", "description": "Leave it be"},
+            ],
+            "context": "You stand before a door",
+        }
+    ]
+
+
+def test_prefix_is_story_invariant():
+    """Test that the prefix holds the story but none of the per node state"""
+    prompt = StoryPrompt("Test Story", "This is a test story")
+
+    assert "Test Story" in prompt.prefix
+    assert "This is a test story" in prompt.prefix
+    assert "<good image description>" in prompt.prefix
+    assert "previous choices" not in prompt.prefix.split("remaining turns.")[1]
+
+
+def test_continuation_without_cache(mock_genai, previous_choices):
+    """Test that the prefix is sent with every call when caching is unavailable"""
+    mock_genai.caching.CachedContent.create.side_effect = Exception("Not supported")
+    prompt = StoryPrompt("Test Story", "This is a test story")
+
+    cache_name = prompt.create_cache("gemini-2.0-flash-exp", timedelta(minutes=15))
+    prompt.get_model("gemini-2.0-flash-exp", cache_name)
+    messages = prompt.continuation(previous_choices, 2)
+
+    assert cache_name is None
+    mock_genai.GenerativeModel.assert_called_once_with("gemini-2.0-flash-exp")
+    assert [message["role"] for message in messages] == ["system", "user"]
+    assert "Test Story" in messages[0]["content"]
+    assert "Choice Context: You stand before a door" in messages[1]["content"]
+    assert "User Chose: Open the door" in messages[1]["content"]
+    assert "Two distinct choices" in messages[1]["content"]
+    assert prompt.tokens_saved == 0
+
+
+def test_create_cache(mock_genai):
+    """Test that the prefix is uploaded once and referred to by name"""
+    mock_genai.caching.CachedContent.create.return_value.name = "cachedContents/story"
+    prompt = StoryPrompt("Test Story", "This is a test story")
+
+    cache_name = prompt.create_cache("gemini-2.0-flash-exp", timedelta(minutes=15), 100)
+
+    assert cache_name == "cachedContents/story"
+    create = mock_genai.caching.CachedContent.create
+    assert create.call_args.kwargs["system_instruction"] == prompt.prefix
+    assert create.call_args.kwargs["ttl"] == timedelta(minutes=15)
+
+
+def test_continuation_with_cache(mock_genai, previous_choices):
+    """Test that only the per node suffix is sent once the prefix is cached"""
+    cache = MagicMock()
+    cache.usage_metadata.total_token_count = 900
+    mock_genai.caching.CachedContent.get.return_value = cache
+    prompt = StoryPrompt("Test Story", "This is a test story")
+
+    model = prompt.get_model("gemini-2.0-flash-exp", "cachedContents/story")
+    messages = prompt.continuation(previous_choices, 0)
+    prompt.level([{"path": "1.1", "user_choices": previous_choices}], 0)
+
+    # The story's existing cache is reused rather than a new one uploaded
+    mock_genai.caching.CachedContent.get.assert_called_once_with("cachedContents/story")
+    mock_genai.caching.CachedContent.create.assert_not_called()
+    assert model == mock_genai.GenerativeModel.from_cached_content.return_value
+    assert [message["role"] for message in messages] == ["user"]
+    assert "A conclusion of the story" in messages[0]["content"]
+    assert prompt.tokens_saved == 1800
+    cache.delete.assert_not_called()
+
+
+def test_expired_cache_falls_back(mock_genai, previous_choices):
+    """Test that a cache that has expired falls back to sending the prefix"""
+    mock_genai.caching.CachedContent.get.side_effect = Exception("Not found")
+    prompt = StoryPrompt("Test Story", "This is a test story")
+
+    prompt.get_model("gemini-2.0-flash-exp", "cachedContents/story")
+    messages = prompt.continuation(previous_choices, 2)
+
+    mock_genai.GenerativeModel.assert_called_once_with("gemini-2.0-flash-exp")
+    assert [message["role"] for message in messages] == ["system", "user"]
+    assert prompt.tokens_saved == 0
+
+
+def test_prefix_below_cache_minimum(mock_genai):
+    """Test that a prefix too short for Gemini to cache is never uploaded"""
+    prompt = StoryPrompt("Test Story", "This is a test story")
+
+    cache_name = prompt.create_cache("gemini-2.0-flash-exp", timedelta(minutes=15), 32768)
+
+    assert cache_name is None
+    mock_genai.caching.CachedContent.create.assert_not_called()
+
+
+def test_delete_cache(mock_genai):
+    """Test that a story's cache is deleted by name"""
+    delete_cache("cachedContents/story")
+
+    mock_genai.caching.CachedContent.get.assert_called_once_with("cachedContents/story")
+    mock_genai.caching.CachedContent.get.return_value.delete.assert_called_once()
+
+
+def test_as_literal():
+    """Test that rendered prompts survive instructor's templating untouched"""
+    from jinja2 import Template
+
+    text = "The {{ villain }} said {% if %}"
+    assert Template(as_literal(text)).render() == text
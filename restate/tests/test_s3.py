@@ -1,84 +1,204 @@
 import pytest
 from unittest.mock import MagicMock, patch
-from helpers.s3 import get_story_items
+from botocore.exceptions import ClientError
+from helpers.s3 import (
+    StoryAssets,
+    copy_story_assets,
+    get_missing_assets,
+    get_image_variant_keys,
+    get_image_version,
+    get_s3_client,
+    get_story_items,
+    parse_asset_key,
+)
 
 
 @pytest.fixture
 def mock_boto3():
+    get_s3_client.cache_clear()
     with patch("helpers.s3.boto3") as mock_boto3:
         mock_client = MagicMock()
         mock_boto3.client.return_value = mock_client
         yield mock_client
+    get_s3_client.cache_clear()
 
 
 @pytest.fixture
 def mock_env():
-    with patch("helpers.s3.Env") as mock_env:
+    with patch("helpers.s3.get_env") as mock_env:
         mock_env_instance = MagicMock()
         mock_env_instance.AWS_ACCESS_KEY_ID = "test_access_key"
         mock_env_instance.AWS_SECRET_ACCESS_KEY = "test_secret_key"
         mock_env_instance.AWS_REGION = "test_region"
+        mock_env_instance.AUDIO_EXTENSION = "wav"
         mock_env.return_value = mock_env_instance
         yield mock_env
 
 
+def set_pages(mock_client, pages):
+    mock_client.get_paginator.return_value.paginate.return_value = pages
+
+
+def not_found(operation="HeadObject"):
+    return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation)
+
+
 def test_get_story_items_with_contents(mock_boto3, mock_env):
-    """Test getting story items when S3 returns contents"""
-    # Mock S3 response
-    mock_boto3.list_objects_v2.return_value = {
-        "Contents": [
-            {"Key": "test_story_id/node1.png"},
-            {"Key": "test_story_id/node2.png"},
-            {"Key": "test_story_id/banner.png"},
-            {"Key": "test_story_id/theme.wav"},
-            {"Key": "test_story_id/node1.wav"},
-        ]
-    }
-    
-    # Call the function
+    """Test getting story items across every page of the listing"""
+    set_pages(mock_boto3, [
+        {
+            "Contents": [
+                {"Key": "test_story_id/node1.png"},
+                {"Key": "test_story_id/node2.png"},
+                {"Key": "test_story_id/banner.png"},
+            ]
+        },
+        {
+            "Contents": [
+                {"Key": "test_story_id/theme.wav"},
+                {"Key": "test_story_id/node1.wav"},
+                {"Key": "test_story_id/notes.txt"},
+            ]
+        },
+    ])
+
     result = get_story_items("test_story_id")
-    
-    # Verify the result
-    assert "images" in result
-    assert "audio" in result
-    assert set(result["images"]) == {"node1", "node2", "banner"}
-    assert set(result["audio"]) == {"theme", "node1"}
-    
-    # Verify S3 client was created with correct parameters
-    mock_boto3.list_objects_v2.assert_called_once_with(
+
+    assert result.images == {"node1", "node2", "banner"}
+    assert result.audio == {"theme", "node1"}
+    mock_boto3.get_paginator.assert_called_once_with("list_objects_v2")
+    mock_boto3.get_paginator.return_value.paginate.assert_called_once_with(
         Bucket="restate-story", Prefix="test_story_id/"
     )
 
 
 def test_get_story_items_no_contents(mock_boto3, mock_env):
     """Test getting story items when S3 returns no contents"""
-    # Mock S3 response with no Contents
-    mock_boto3.list_objects_v2.return_value = {}
-    
-    # Call the function
+    set_pages(mock_boto3, [{}])
+
     result = get_story_items("test_story_id")
-    
-    # Verify the result
-    assert "images" in result
-    assert "audio" in result
-    assert result["images"] == []
-    assert result["audio"] == []
+
+    assert result.images == set()
+    assert result.audio == set()
 
 
 def test_get_story_items_client_error(mock_boto3, mock_env):
     """Test getting story items when S3 client raises an error"""
-    # Mock S3 client to raise an error
-    from botocore.exceptions import ClientError
-    mock_boto3.list_objects_v2.side_effect = ClientError(
+    mock_boto3.get_paginator.return_value.paginate.side_effect = ClientError(
         {"Error": {"Code": "NoSuchBucket", "Message": "The bucket does not exist"}},
         "ListObjectsV2"
     )
-    
-    # Call the function
+
     result = get_story_items("test_story_id")
-    
-    # Verify the result is a dictionary with empty lists for 'images' and 'audio'
-    assert "images" in result
-    assert "audio" in result
-    assert result["images"] == []
-    assert result["audio"] == []
\ No newline at end of file
+
+    # Callers always get the same shape back, just with nothing in it
+    assert result == StoryAssets()
+
+
+def test_s3_client_is_shared(mock_boto3, mock_env):
+    """Test that a single client is created and reused"""
+    set_pages(mock_boto3, [{}])
+
+    get_story_items("test_story_id")
+    get_story_items("test_story_id")
+
+    assert get_s3_client() is mock_boto3
+
+
+def test_parse_asset_key():
+    """Test that only direct image and audio keys of the story are parsed"""
+    assert parse_asset_key("story", "story/node1.png") == ("images", "node1")
+    assert parse_asset_key("story", "story/theme.wav") == ("audio", "theme")
+    assert parse_asset_key("story", "story/node.1.wav") == ("audio", "node.1")
+    assert parse_asset_key("story", "story/notes.txt") is None
+    assert parse_asset_key("story", "other/node1.png") is None
+    assert parse_asset_key("story", "story/nested/node1.png") is None
+
+
+def test_get_missing_assets_heads_remaining_keys(mock_boto3, mock_env):
+    """Test that a few outstanding assets are checked with HEAD requests"""
+    missing_keys = {"story/node2.png", "story/theme.wav"}
+
+    def head_object(Bucket, Key):
+        if Key in missing_keys:
+            raise not_found()
+        return {}
+
+    mock_boto3.head_object.side_effect = head_object
+
+    result = get_missing_assets("story", {"node1", "node2"}, {"node1", "theme"})
+
+    assert result.images == {"node2"}
+    assert result.audio == {"theme"}
+    assert mock_boto3.head_object.call_count == 4
+    mock_boto3.get_paginator.assert_not_called()
+
+
+def test_get_missing_assets_lists_when_many_remain(mock_boto3, mock_env):
+    """Test that a full listing is used when most assets are outstanding"""
+    images = {f"node{i}" for i in range(20)}
+    set_pages(mock_boto3, [{"Contents": [{"Key": "story/node1.png"}]}])
+
+    result = get_missing_assets("story", images, {"theme"})
+
+    assert result.images == images - {"node1"}
+    assert result.audio == {"theme"}
+    mock_boto3.head_object.assert_not_called()
+
+
+def test_get_missing_assets_nothing_expected(mock_boto3, mock_env):
+    """Test that no requests are made when nothing is outstanding"""
+    assert get_missing_assets("story", set(), set()) == StoryAssets()
+    mock_boto3.head_object.assert_not_called()
+    mock_boto3.get_paginator.assert_not_called()
+
+
+def test_copy_story_assets(mock_boto3, mock_env):
+    """Test that cached assets are copied over to the new story's keys"""
+    copied = copy_story_assets(
+        [
+            "old_story/old_node.png",
+            "old_story/old_node.811c9dc5.thumb.webp",
+            "old_story/banner.png",
+            "old_story/old_node.wav",
+        ],
+        "new_story",
+        {"old_node": "new_node"},
+    )
+
+    assert copied == [
+        "new_story/new_node.png",
+        "new_story/new_node.811c9dc5.thumb.webp",
+        "new_story/banner.png",
+        "new_story/new_node.wav",
+    ]
+    mock_boto3.copy_object.assert_any_call(
+        Bucket="restate-story",
+        CopySource={"Bucket": "restate-story", "Key": "old_story/old_node.png"},
+        Key="new_story/new_node.png",
+    )
+    assert mock_boto3.copy_object.call_count == 4
+
+
+def test_get_image_variant_keys(mock_env):
+    """Test that image variants are keyed by the FNV-1a hash of their prompt, as the image service does"""
+    mock_env.return_value.IMAGE_FORMAT = "webp"
+
+    assert get_image_version("") == "811c9dc5"
+    assert get_image_version("a") == "e40c292c"
+    assert get_image_variant_keys("story", "node1", "a") == [
+        "story/node1.e40c292c.webp",
+        "story/node1.e40c292c.thumb.webp",
+    ]
+    # The variants aren't assets we wait on
+    assert parse_asset_key("story", "story/node1.e40c292c.webp") is None
+
+
+def test_get_missing_assets_compressed_audio(mock_boto3, mock_env):
+    """Test that audio is looked up under the configured extension"""
+    mock_env.return_value.AUDIO_EXTENSION = "ogg"
+
+    get_missing_assets("story", set(), {"theme"})
+
+    mock_boto3.head_object.assert_called_once_with(Bucket="restate-story", Key="story/theme.ogg")
+    assert parse_asset_key("story", "story/theme.ogg") == ("audio", "theme")
@@ -8,34 +8,40 @@ from helpers.story import (
     StoryNodes,
     generate_story,
     generate_story_choices,
+    get_async_client,
     generate_images,
     generate_tts,
+    get_callback_payload,
+    get_story_node_ids,
+    get_node_count,
+    get_path_node_ids,
+    get_expansion,
+    StoryLevel,
+    Branch,
 )
+from helpers.dispatch import DispatchReport
 
 
 @pytest.fixture
 def mock_genai():
-    with patch("helpers.story.genai") as mock_genai:
+    with patch("helpers.story.genai") as mock_genai, \
+         patch("helpers.prompts.genai", mock_genai):
         yield mock_genai
 
 
-@pytest.fixture
-def mock_instructor():
-    with patch("helpers.story.instructor") as mock_instructor:
-        mock_client = MagicMock()
-        mock_instructor.from_gemini.return_value = mock_client
-        yield mock_client
-
-
 @pytest.fixture
 def mock_async_instructor():
+    get_async_client.cache_clear()
     with patch("helpers.story.instructor") as mock_instructor:
         mock_client = AsyncMock()
+        mock_client.on = MagicMock()
         mock_instructor.from_gemini.return_value = mock_client
         yield mock_client
+    get_async_client.cache_clear()
 
 
-def test_generate_story(mock_genai, mock_instructor):
+@pytest.mark.asyncio
+async def test_generate_story(mock_genai, mock_async_instructor):
     """Test generating a story outline"""
     # Mock the response from the LLM
     mock_response = StoryOutline(
@@ -44,17 +50,17 @@ def test_generate_story(mock_genai, mock_instructor):
         melody="Test melody",
         banner_image="Test banner image"
     )
-    mock_instructor.chat.completions.create.return_value = mock_response
+    mock_async_instructor.chat.completions.create.return_value = mock_response
     
     # Call the function
-    result = generate_story("Test prompt")
+    result = await generate_story("Test prompt")
     
     # Verify the result
     assert result == mock_response
     
     # Verify the LLM was called with the correct parameters
-    mock_instructor.chat.completions.create.assert_called_once()
-    args, kwargs = mock_instructor.chat.completions.create.call_args
+    mock_async_instructor.chat.completions.create.assert_called_once()
+    args, kwargs = mock_async_instructor.chat.completions.create.call_args
     
     # Check that the response model is correct
     assert kwargs["response_model"] == StoryOutline
@@ -85,181 +91,445 @@ async def test_generate_story_choices(mock_genai, mock_async_instructor):
         ]
     )
     
-    # Set up the mock to return different responses for different calls
-    mock_async_instructor.chat.completions.create = AsyncMock()
-    mock_async_instructor.chat.completions.create.side_effect = [
-        mock_node,  # First level
-        mock_node,  # Second level - choice 1
-        mock_node,  # Second level - choice 2
-        StoryNode(  # Third level - terminal node 1
-            title="Terminal Node 1",
-            story_description="This is terminal node 1",
-            banner_image_description="Terminal image 1",
-            user_choices=[]
-        ),
-        StoryNode(  # Third level - terminal node 2
-            title="Terminal Node 2",
-            story_description="This is terminal node 2",
-            banner_image_description="Terminal image 2",
-            user_choices=[]
-        ),
-        StoryNode(  # Third level - terminal node 3
-            title="Terminal Node 3",
-            story_description="This is terminal node 3",
-            banner_image_description="Terminal image 3",
-            user_choices=[]
-        ),
-        StoryNode(  # Third level - terminal node 4
-            title="Terminal Node 4",
-            story_description="This is terminal node 4",
-            banner_image_description="Terminal image 4",
-            user_choices=[]
+    def create(response_model, messages, context):
+        if context["remaining_turns"] > 0:
+            return mock_node
+        return StoryNode.model_validate(
+            {
+                "title": "Terminal Node",
+                "story_description": "This is a terminal node",
+                "banner_image_description": "Terminal image",
+                "user_choices": [],
+            },
+            context=context,
         )
-    ]
+
+    mock_async_instructor.chat.completions.create = AsyncMock(side_effect=create)
     
     # Call the function
     result = await generate_story_choices(story)
     
     # Verify the result
     assert isinstance(result, StoryNodes)
-    assert len(result.nodes) == 7  # 1 root + 2 second level + 4 terminal nodes
+    assert len(result.nodes) == 15  # 1 root + 2 + 4 + 8 terminal nodes
     
     # Check that we have the expected number of terminal nodes
     terminal_nodes = [node for node in result.nodes if node.is_terminal]
-    assert len(terminal_nodes) == 4
+    assert len(terminal_nodes) == 8
     
     # Check that we have the expected number of non-terminal nodes
     non_terminal_nodes = [node for node in result.nodes if not node.is_terminal]
-    assert len(non_terminal_nodes) == 3
+    assert len(non_terminal_nodes) == 7
+
+
+NODES = [
+    FinalStoryNode(
+        id="node1",
+        parent_id=None,
+        title="Node 1",
+        description="This is node 1",
+        image_description="Image for node 1",
+        choice_title="Choice 1",
+        choice_description="Description for choice 1",
+        is_terminal=False
+    ),
+    FinalStoryNode(
+        id="node2",
+        parent_id="node1",
+        title="Node 2",
+        description="This is node 2",
+        image_description="Image for node 2",
+        choice_title="Choice 2",
+        choice_description="Description for choice 2",
+        is_terminal=True
+    )
+]
+
+
+@pytest.fixture
+def mock_dispatcher():
+    dispatcher = MagicMock()
+    dispatcher.batch_endpoint = None
+    dispatcher.dispatch = AsyncMock(return_value=DispatchReport(acknowledged=["node1"]))
+    dispatcher.dispatch_batch = AsyncMock(return_value=DispatchReport(acknowledged=["node1"]))
+    with patch("helpers.story.get_dispatcher", return_value=dispatcher) as mock_get:
+        yield mock_get, dispatcher
 
 
 @pytest.mark.asyncio
-async def test_generate_images(monkeypatch):
-    """Test generating images for story nodes"""
-    # Create mock nodes
-    nodes = [
-        FinalStoryNode(
-            id="node1",
-            parent_id=None,
-            title="Node 1",
-            description="This is node 1",
-            image_description="Image for node 1",
-            choice_title="Choice 1",
-            choice_description="Description for choice 1",
-            is_terminal=False
-        ),
-        FinalStoryNode(
-            id="node2",
-            parent_id="node1",
-            title="Node 2",
-            description="This is node 2",
-            image_description="Image for node 2",
-            choice_title="Choice 2",
-            choice_description="Description for choice 2",
-            is_terminal=True
-        )
+async def test_generate_images(mock_dispatcher):
+    """Test that an image job is dispatched for every node plus the banner"""
+    mock_get, dispatcher = mock_dispatcher
+
+    result = await generate_images(NODES, "test_story_id", "Banner image description")
+
+    assert result == dispatcher.dispatch.return_value
+    mock_get.assert_called_once_with("images")
+    jobs = dispatcher.dispatch.call_args[0][0]
+    assert [job["node_id"] for job in jobs] == ["node1", "node2", "banner"]
+    assert [job["prompt"] for job in jobs] == [
+        "Image for node 1", "Image for node 2", "Banner image description"
     ]
-    
-    # Mock the aiohttp ClientSession
-    mock_session = AsyncMock()
-    mock_response = AsyncMock()
-    mock_response.text = AsyncMock(return_value="Success")
-    mock_session.__aenter__.return_value = mock_session
-    mock_session.post.return_value.__aenter__.return_value = mock_response
-    
-    # Mock the Env class
+    assert all(job["story_id"] == "test_story_id" for job in jobs)
+
+
+@pytest.mark.asyncio
+async def test_generate_tts(mock_dispatcher):
+    """Test that a narration job is dispatched for every node plus the theme"""
+    mock_get, dispatcher = mock_dispatcher
+
+    result = await generate_tts(NODES, "test_story_id", "Story description")
+
+    assert result == dispatcher.dispatch.return_value
+    mock_get.assert_called_once_with("audio")
+    jobs = dispatcher.dispatch.call_args[0][0]
+    assert [job["node_id"] for job in jobs] == ["node1", "node2", "theme"]
+    assert [job["prompt"] for job in jobs] == [
+        "This is node 1", "This is node 2", "Story description"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_generate_tts_batch(mock_dispatcher):
+    """Test that narration goes out in one request when there's a batch endpoint"""
+    mock_get, dispatcher = mock_dispatcher
+    dispatcher.batch_endpoint = "http://test-tts-batch-endpoint"
+
+    result = await generate_tts(NODES, "test_story_id", "Story description")
+
+    assert result == dispatcher.dispatch_batch.return_value
+    dispatcher.dispatch.assert_not_called()
+    jobs = dispatcher.dispatch_batch.call_args[0][0]
+    assert [job["node_id"] for job in jobs] == ["node1", "node2", "theme"]
+
+
+def test_get_callback_payload():
+    """Test that awakeable ids are turned into Restate ingress callbacks"""
     mock_env = MagicMock()
-    mock_env.IMAGE_ENDPOINT = "http://test-image-endpoint"
-    
-    # Patch the required modules
-    with patch("helpers.story.aiohttp.ClientSession", return_value=mock_session), \
-         patch("helpers.story.Env", return_value=mock_env):
-        
-        # Call the function
-        result = await generate_images(nodes, "test_story_id", "Banner image description")
-        
-        # Verify the result
-        assert result == "Success"
-        
-        # Verify that post was called for each node plus the banner
-        assert mock_session.post.call_count == 3
-        
-        # Check the calls
-        calls = mock_session.post.call_args_list
-        
-        # First two calls should be for the nodes
-        assert calls[0][0][0] == "http://test-image-endpoint"
-        assert "node1" in str(calls[0][1]["json"])
-        
-        assert calls[1][0][0] == "http://test-image-endpoint"
-        assert "node2" in str(calls[1][1]["json"])
-        
-        # Last call should be for the banner
-        assert calls[2][0][0] == "http://test-image-endpoint"
-        assert "banner" in str(calls[2][1]["json"])
+    mock_env.RESTATE_INGRESS_URL = "http://restate-ingress"
+    mock_env.RESTATE_INGRESS_TOKEN = "test-token"
+
+    with patch("helpers.story.get_env", return_value=mock_env):
+        assert get_callback_payload(None) == {}
+        assert get_callback_payload("sign_1abc") == {
+            "callback_url": "http://restate-ingress/restate/awakeables/sign_1abc/resolve",
+            "callback_token": "test-token",
+        }
+
+
+
+def test_get_story_node_ids():
+    """Test that node ids are deterministic and cover the whole tree"""
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+    node_ids = get_story_node_ids(story_id)
+
+    assert len(node_ids) == 15
+    assert len(set(node_ids)) == 15
+    assert node_ids == get_story_node_ids(story_id)
+    assert get_story_node_ids(story_id, max_depth=1) == node_ids[:3]
+
+    wider = get_story_node_ids(story_id, max_depth=2, branching=3)
+    assert len(wider) == get_node_count(2, 3) == 13
+    assert get_node_count(3) == len(node_ids)
+    assert wider[:2] == node_ids[:2]
+
+
+def test_get_path_node_ids():
+    """Test that a path resolves to the same ids as the whole tree"""
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+    node_ids = get_story_node_ids(story_id)
+
+    assert get_path_node_ids(story_id, "1") == node_ids[:1]
+    assert get_path_node_ids(story_id, "1.2.1") == [node_ids[0], node_ids[2], node_ids[5]]
+
+
+def make_choices(count, remaining_turns):
+    return [] if remaining_turns == 0 else [
+        {"choice_title": f"Choice {i + 1}", "choice_description": f"Description {i + 1}"}
+        for i in range(count)
+    ]
 
 
 @pytest.mark.asyncio
-async def test_generate_tts(monkeypatch):
-    """Test generating text-to-speech for story nodes"""
-    # Create mock nodes
-    nodes = [
-        FinalStoryNode(
-            id="node1",
-            parent_id=None,
-            title="Node 1",
-            description="This is node 1",
-            image_description="Image for node 1",
-            choice_title="Choice 1",
-            choice_description="Description for choice 1",
-            is_terminal=False
-        ),
-        FinalStoryNode(
-            id="node2",
-            parent_id="node1",
-            title="Node 2",
-            description="This is node 2",
-            image_description="Image for node 2",
-            choice_title="Choice 2",
-            choice_description="Description for choice 2",
-            is_terminal=True
+async def test_generate_story_choices_incrementally(mock_genai, mock_async_instructor):
+    """Test that levels below the stop depth are returned as branches and expanded later"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+    def create(response_model, messages, context):
+        return StoryNode.model_validate(
+            {
+                "title": "Node",
+                "story_description": "Description",
+                "banner_image_description": "Image",
+                "user_choices": make_choices(context["choices"], context["remaining_turns"]),
+            },
+            context=context,
         )
+
+    mock_async_instructor.chat.completions.create = AsyncMock(side_effect=create)
+    node_ids = get_story_node_ids(story_id)
+
+    result = await generate_story_choices(story, story_id, stop_depth=1)
+
+    assert [node.id for node in result.nodes] == node_ids[:3]
+    assert [branch.node_id for branch in result.frontier] == node_ids[3:7]
+    assert [branch.path for branch in result.frontier] == ["1.1.1", "1.1.2", "1.2.1", "1.2.2"]
+    assert all(branch.depth == 2 for branch in result.frontier)
+
+    # Branches are kept in the workflow's state, so they must survive a roundtrip
+    branches = [Branch.model_validate_json(b.model_dump_json()) for b in result.frontier[:2]]
+    expanded = await generate_story_choices(story, story_id, branches=branches)
+
+    assert expanded.frontier == []
+    assert [node.id for node in expanded.nodes] == [
+        node_ids[3], node_ids[7], node_ids[8], node_ids[4], node_ids[9], node_ids[10]
     ]
-    
-    # Mock the aiohttp ClientSession
-    mock_session = AsyncMock()
-    mock_response = AsyncMock()
-    mock_response.text = AsyncMock(return_value="Success")
-    mock_session.__aenter__.return_value = mock_session
-    mock_session.post.return_value.__aenter__.return_value = mock_response
-    
-    # Mock the Env class
-    mock_env = MagicMock()
-    mock_env.KOKORO_ENDPOINT = "http://test-tts-endpoint"
-    
-    # Patch the required modules
-    with patch("helpers.story.aiohttp.ClientSession", return_value=mock_session), \
-         patch("helpers.story.Env", return_value=mock_env):
-        
-        # Call the function
-        result = await generate_tts(nodes, "test_story_id", "Story description")
-        
-        # Verify the result
-        assert result == "Success"
-        
-        # Verify that post was called for each node plus the theme
-        assert mock_session.post.call_count == 3
-        
-        # Check the calls
-        calls = mock_session.post.call_args_list
-        
-        # First two calls should be for the nodes
-        assert calls[0][0][0] == "http://test-tts-endpoint"
-        assert "node1" in str(calls[0][1]["json"])
-        
-        assert calls[1][0][0] == "http://test-tts-endpoint"
-        assert "node2" in str(calls[1][1]["json"])
-        
-        # Last call should be for the theme
-        assert calls[2][0][0] == "http://test-tts-endpoint"
-        assert "theme" in str(calls[2][1]["json"])
\ No newline at end of file
+    assert expanded.nodes[0].parent_id == node_ids[1]
+    assert [node.is_terminal for node in expanded.nodes].count(True) == 4
+
+
+@pytest.mark.asyncio
+async def test_generate_deep_story_choices(mock_genai, mock_async_instructor):
+    """Test that a tree with more inner nodes than semaphore slots still finishes"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+    def create(response_model, messages, context):
+        return StoryNode.model_validate(
+            {
+                "title": "Node",
+                "story_description": "Description",
+                "banner_image_description": "Image",
+                "user_choices": make_choices(context["choices"], context["remaining_turns"]),
+            },
+            context=context,
+        )
+
+    mock_async_instructor.chat.completions.create = AsyncMock(side_effect=create)
+
+    # 63 inner nodes, more than the 50 calls a single tree may have in flight
+    result = await asyncio.wait_for(
+        generate_story_choices(story, story_id, max_depth=6), timeout=10
+    )
+
+    assert len(result.nodes) == 127
+    assert set(node.id for node in result.nodes) == set(get_story_node_ids(story_id, 6))
+
+
+@pytest.mark.asyncio
+async def test_generate_story_choices_by_level_incrementally(mock_genai, mock_async_instructor):
+    """Test that batched generation stops at the stop depth and honours the branching"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+    def create(response_model, messages, context):
+        assert "Three distinct choices" in messages[-1]["content"]
+        return StoryLevel.model_validate(
+            {
+                "branches": [
+                    {
+                        "path": path,
+                        "title": f"Node {path}",
+                        "story_description": "Description",
+                        "banner_image_description": "Image",
+                        "user_choices": make_choices(
+                            context["choices"], context["remaining_turns"]
+                        ),
+                    }
+                    for path in context["paths"]
+                ]
+            },
+            context=context,
+        )
+
+    mock_async_instructor.chat.completions.create = AsyncMock(side_effect=create)
+    node_ids = get_story_node_ids(story_id, max_depth=4, branching=3)
+
+    result = await generate_story_choices(
+        story, story_id, batch_levels=True, max_depth=4, branching=3, stop_depth=1
+    )
+
+    assert mock_async_instructor.chat.completions.create.call_count == 2
+    assert [node.id for node in result.nodes] == node_ids[:4]
+    assert [branch.node_id for branch in result.frontier] == node_ids[4:13]
+
+    expanded = await generate_story_choices(
+        story,
+        story_id,
+        batch_levels=True,
+        max_depth=4,
+        branching=3,
+        stop_depth=2,
+        branches=result.frontier[:3],
+    )
+
+    assert [node.id for node in expanded.nodes] == node_ids[4:7]
+    assert len(expanded.frontier) == 9
+
+
+def test_get_expansion():
+    """Test that only the branches within the lookahead of the player are expanded"""
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+    choice = {
+        "choice": {"choice_title": "Choice", "choice_description": "Description"},
+        "options": [],
+        "context": "Context",
+    }
+    frontier = [
+        Branch(
+            path=path,
+            node_id=get_path_node_ids(story_id, path)[-1],
+            parent_id=get_path_node_ids(story_id, path)[-2],
+            user_choices=[choice] * path.count("."),
+        )
+        for path in ("1.1.1", "1.1.2", "1.2.1", "1.2.2")
+    ]
+    node_id = get_path_node_ids(story_id, "1.1")[-1]
+
+    targets, stop_depth = get_expansion(story_id, frontier, node_id, lookahead=1)
+    assert [branch.path for branch in targets] == ["1.1.1", "1.1.2"]
+    assert stop_depth == 2
+
+    # The player is on the root, so the tree is already a level deep below them
+    targets, stop_depth = get_expansion(story_id, frontier, frontier[0].parent_id, 2)
+    assert targets == frontier[:2]
+
+    targets, stop_depth = get_expansion(story_id, frontier, get_path_node_ids(story_id, "1")[0], 1)
+    assert targets == [] and stop_depth == 1
+
+    assert get_expansion(story_id, frontier, "unknown", 1) == ([], None)
+
+
+@pytest.mark.asyncio
+async def test_generate_story_choices_a_level_at_a_time(mock_genai, mock_async_instructor):
+    """Test that continuing each level's frontier builds the same tree as one call"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+    def create(response_model, messages, context):
+        return StoryNode.model_validate(
+            {
+                "title": "Node",
+                "story_description": "Description",
+                "banner_image_description": "Image",
+                "user_choices": make_choices(context["choices"], context["remaining_turns"]),
+            },
+            context=context,
+        )
+
+    mock_async_instructor.chat.completions.create = AsyncMock(side_effect=create)
+
+    nodes, branches = [], None
+    for depth in range(4):
+        level = await generate_story_choices(
+            story, story_id, stop_depth=depth, branches=branches
+        )
+        assert len(level.nodes) == 2**depth
+        nodes.extend(level.nodes)
+        branches = level.frontier
+
+    assert branches == []
+    assert [node.id for node in nodes] == get_story_node_ids(story_id)
+
+    # Parents are always generated before their children
+    seen = set()
+    for node in nodes:
+        assert node.parent_id is None or node.parent_id in seen
+        seen.add(node.id)
+
+
+@pytest.mark.asyncio
+async def test_generate_story_choices_by_level(mock_genai, mock_async_instructor):
+    """Test that batched generation makes one call per tree level"""
+    story = StoryOutline(
+        title="Test Story",
+        description="This is a test story",
+        melody="Test melody",
+        banner_image="Test banner image"
+    )
+    story_id = "0b8f7a52-3c55-4b39-9a0a-6f0f39c0c3c1"
+
+    def create(response_model, messages, context):
+        assert response_model == StoryLevel
+        remaining_turns = context["remaining_turns"]
+        return StoryLevel.model_validate(
+            {
+                "branches": [
+                    {
+                        "path": path,
+                        "title": f"Node {path}",
+                        "story_description": "Description",
+                        "banner_image_description": "Image",
+                        "user_choices": []
+                        if remaining_turns == 0
+                        else [
+                            {"choice_title": "Choice 1", "choice_description": "Description 1"},
+                            {"choice_title": "Choice 2", "choice_description": "Description 2"},
+                        ],
+                    }
+                    for path in context["paths"]
+                ]
+            },
+            context=context,
+        )
+
+    mock_async_instructor.chat.completions.create = AsyncMock(side_effect=create)
+
+    result = await generate_story_choices(story, story_id, batch_levels=True)
+
+    assert mock_async_instructor.chat.completions.create.call_count == 4
+    assert [node.id for node in result.nodes] == get_story_node_ids(story_id)
+    assert result.nodes[-1].title == "Node 1.2.2.2"
+    assert result.nodes[-1].choice_title == "Choice 2"
+    assert [node.is_terminal for node in result.nodes].count(True) == 8
+
+
+def test_story_level_validation():
+    """Test that every requested branch must be continued exactly once"""
+    from pydantic import ValidationError
+
+    branch = {
+        "path": "1.1",
+        "title": "Node",
+        "story_description": "Description",
+        "banner_image_description": "Image",
+        "user_choices": [
+            {"choice_title": "Choice 1", "choice_description": "Description 1"},
+            {"choice_title": "Choice 2", "choice_description": "Description 2"},
+        ],
+    }
+
+    with pytest.raises(ValidationError):
+        StoryLevel.model_validate(
+            {"branches": [branch]},
+            context={"paths": ["1.1", "1.2"], "remaining_turns": 2},
+        )
+
+    # Per node validation still applies to every branch
+    with pytest.raises(ValidationError):
+        StoryLevel.model_validate(
+            {"branches": [{**branch, "user_choices": branch["user_choices"][:1]}]},
+            context={"paths": ["1.1"], "remaining_turns": 2},
+        )
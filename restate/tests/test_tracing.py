@@ -0,0 +1,165 @@
+import pytest
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+from helpers import tracing
+
+
+@pytest.fixture
+def exported():
+    """Collects the spans of every trace instead of exporting them"""
+    spans = []
+    with patch("helpers.tracing.export", side_effect=spans.extend):
+        yield spans
+
+
+def by_name(spans):
+    return {span.name: span for span in spans}
+
+
+def test_trace_records_nested_spans(exported):
+    """Test that spans are recorded as children of the span they were opened in"""
+    with tracing.trace("cyoa", key="workflow_id") as root:
+        with tracing.span("step", step=True) as step:
+            with tracing.span("db.insert_story"):
+                tracing.add_event("db.reconnect", error="closed")
+            tracing.set_attribute("statements", 3)
+
+    spans = by_name(exported)
+    assert set(spans) == {"cyoa", "step", "db.insert_story"}
+    assert len({span.trace_id for span in exported}) == 1
+    assert root.parent_id is None
+    assert spans["step"].parent_id == root.span_id
+    assert spans["db.insert_story"].parent_id == step.span_id
+    assert spans["db.insert_story"].events[0]["name"] == "db.reconnect"
+    assert spans["step"].attributes == {"step": True, "statements": 3}
+    assert all(span.end_ns >= span.start_ns for span in exported)
+
+
+def test_trace_id_follows_the_workflow(exported):
+    """Test that replays of the same workflow land in the same trace"""
+    with tracing.trace("cyoa", key="workflow_id") as first:
+        pass
+    with tracing.trace("cyoa", key="workflow_id") as second:
+        pass
+    with tracing.trace("cyoa", key="other_workflow_id") as other:
+        pass
+
+    assert first.trace_id == second.trace_id != other.trace_id
+    assert len(first.trace_id) == 32 and len(first.span_id) == 16
+
+
+def test_span_records_errors(exported):
+    """Test that a failed block marks its span and still raises"""
+    with pytest.raises(ValueError):
+        with tracing.trace("cyoa"):
+            with tracing.span("gemini.generate_story"):
+                raise ValueError("Invalid story")
+
+    assert "Invalid story" in by_name(exported)["gemini.generate_story"].error
+
+
+def test_spans_outside_a_trace_are_not_recorded(exported):
+    """Test that instrumented code works without a trace"""
+    with tracing.span("s3.head_object") as span:
+        tracing.add_event("page")
+
+    assert span.events[0]["name"] == "page"
+    assert exported == []
+
+
+@pytest.mark.asyncio
+async def test_traced_and_acquire(exported):
+    """Test the decorator on sync and async functions and the semaphore wait span"""
+
+    @tracing.traced("db.mark_story_as_completed")
+    async def mark_story_as_completed():
+        return "done"
+
+    @tracing.traced("s3.list_objects")
+    def get_story_items():
+        return "items"
+
+    semaphore = asyncio.Semaphore(1)
+    with tracing.trace("cyoa"):
+        async with tracing.acquire(semaphore):
+            assert await mark_story_as_completed() == "done"
+            assert get_story_items() == "items"
+    assert not semaphore.locked()
+
+    spans = by_name(exported)
+    assert {"semaphore.wait", "db.mark_story_as_completed", "s3.list_objects"} <= set(spans)
+    assert mark_story_as_completed.__name__ == "mark_story_as_completed"
+
+
+def test_bind_carries_the_trace_to_threads(exported):
+    """Test that spans opened on executor threads join the caller's trace"""
+
+    def head(key):
+        with tracing.span("s3.head_object", key=key):
+            return key
+
+    with tracing.trace("cyoa") as root:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(tracing.bind(head), ["a", "b", "c"])) == ["a", "b", "c"]
+
+    heads = [span for span in exported if span.name == "s3.head_object"]
+    assert len(heads) == 3
+    assert all(span.parent_id == root.span_id for span in heads)
+
+
+def test_export_file(exported, tmp_path):
+    """Test that spans are appended to the trace file as JSON lines"""
+    mock_env = MagicMock()
+    mock_env.TRACE_FILE = str(tmp_path / "traces.jsonl")
+
+    with tracing.trace("cyoa", key="workflow_id"):
+        with tracing.span("step"):
+            pass
+
+    with patch("helpers.tracing.get_env", return_value=mock_env):
+        tracing.export_file(exported)
+        tracing.export_file(exported)
+
+    lines = [json.loads(line) for line in open(mock_env.TRACE_FILE)]
+    assert [line["name"] for line in lines] == ["step", "cyoa", "step", "cyoa"]
+    assert lines[0]["duration_ms"] >= 0
+
+
+def test_export_is_disabled_by_default():
+    """Test that no exporter runs unless one is configured"""
+    mock_env = MagicMock()
+    mock_env.TRACE_EXPORTER = "none"
+
+    with patch("helpers.tracing.get_env", return_value=mock_env), \
+         patch("helpers.tracing.threading.Thread") as mock_thread:
+        with tracing.trace("cyoa"):
+            pass
+
+    mock_thread.assert_not_called()
+
+
+def test_to_otlp():
+    """Test that spans are encoded for an OTLP/HTTP collector"""
+    spans = []
+    with patch("helpers.tracing.export", side_effect=spans.extend):
+        with pytest.raises(RuntimeError):
+            with tracing.trace("cyoa", key="workflow_id"):
+                with tracing.span("dispatch.images", node_id="banner", attempts=2, delivered=False):
+                    tracing.add_event("dispatch.retry", attempt=1)
+                    raise RuntimeError("HTTP 503")
+
+    otlp = tracing.to_otlp(spans)
+    encoded = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    dispatch = next(span for span in encoded if span["name"] == "dispatch.images")
+    root = next(span for span in encoded if span["name"] == "cyoa")
+
+    assert dispatch["traceId"] == root["traceId"]
+    assert dispatch["parentSpanId"] == root["spanId"]
+    assert dispatch["status"]["code"] == 2
+    assert {"key": "node_id", "value": {"stringValue": "banner"}} in dispatch["attributes"]
+    assert {"key": "attempts", "value": {"intValue": "2"}} in dispatch["attributes"]
+    assert {"key": "delivered", "value": {"boolValue": False}} in dispatch["attributes"]
+    assert dispatch["events"][0]["name"] == "dispatch.retry"
+    json.dumps(otlp)